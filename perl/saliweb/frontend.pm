@@ -2,7 +2,8 @@ package saliweb::frontend::IncomingJob;
 
 use IO::Socket;
 use Fcntl ':flock';
-use File::Path 'rmtree';
+use File::Path qw(rmtree make_path);
+use Digest::MD5 qw(md5_hex);
 
 sub new {
     my ($invocant, $frontend, $given_name, $email) = @_;
@@ -170,7 +171,13 @@ sub generate_random_passwd {
 
 sub _get_job_directory {
   my ($jobname, $config) = @_;
-  return $config->{directories}->{INCOMING} . "/" . $jobname;
+  my $incoming = $config->{directories}->{INCOMING};
+  if ($config->{directories}->{sharded}) {
+    # Sharded (ab/cd/jobname) layout; this must match the backend
+    my $digest = md5_hex($jobname);
+    $incoming .= "/" . substr($digest, 0, 2) . "/" . substr($digest, 2, 2);
+  }
+  return $incoming . "/" . $jobname;
 }
 
 sub _get_resumed_job {
@@ -207,6 +214,10 @@ sub try_job_name {
                                  "Cannot execute: " . $dbh->errstr);
   my @data = $query->fetchrow_array();
   if ($data[0] == 0) {
+    if ($config->{directories}->{sharded}) {
+      my ($vol, $parent, $file) = File::Spec->splitpath($jobdir);
+      make_path($parent);
+    }
     mkdir($jobdir) or throw saliweb::frontend::InternalError(
                             "Cannot make job directory $jobdir: $!");
     $query->execute($jobname)
@@ -1647,7 +1658,9 @@ sub read_ini_file {
     } elsif (/^\s*(\S+?)\s*[=:]\s*(\S+)\s*$/) {
       my $key = lc $1;
       my $value = $2;
-      if ($section eq 'directories' and $key ne 'install') {
+      if ($section eq 'directories' and $key eq 'sharded') {
+        $value = ($value =~ /^(1|yes|true|on)$/i) ? 1 : 0;
+      } elsif ($section eq 'directories' and $key ne 'install') {
         $key = uc $key;
       }
       $contents->{$section}->{$key} = $value;
@@ -1 +1,18 @@
-pass
+import hashlib
+import os.path
+import sys
+
+
+def _get_job_shard(name):
+    """Get the subdirectory (e.g. 'ab/cd') that holds the directory for
+       the named job in the sharded job directory layout. This is used by
+       both the backend and the Python frontend, and must match the Perl
+       frontend's calculation."""
+    # The hash only spreads jobs between directories, so it need not be
+    # secure (this also allows its use on FIPS-restricted systems)
+    if sys.version_info >= (3, 9):
+        md5 = hashlib.md5(name.encode('utf-8'), usedforsecurity=False)
+    else:
+        md5 = hashlib.md5(name.encode('utf-8'))
+    digest = md5.hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
@@ -8,16 +8,29 @@ import datetime
 import shutil
 import time
 import configparser
+import contextlib
+import concurrent.futures
+import functools
+import collections
 import traceback
 import signal
 import socket
 import logging
+import multiprocessing
 import threading
+import heapq
 import urllib.request
 import urllib.parse
+import getpass
+import pickle
+import queue
+import xml.etree.ElementTree
 import saliweb.web_service
 import saliweb.backend.events
 import saliweb.backend.cluster
+import saliweb.backend.engines
+import saliweb.backend.mover
+import saliweb.backend.archiver
 from saliweb.backend.events import _JobThread
 from email.mime.text import MIMEText
 
@@ -58,6 +71,12 @@ class _SigTermError(Exception):
     pass
 
 
+class _StateFileNotDoneError(Exception):
+    """Exception raised if a job's Runner reports that it finished but the
+       job-state file does not (yet) agree."""
+    pass
+
+
 class _AdminFailError(Exception):
     """Exception for a job marked as FAILED by the administrator"""
     def __str__(self):
@@ -154,8 +173,8 @@ class _JobState(object):
 
 class _JobMetadata(object):
     """A dictionary-like class that holds job metadata (a database row).
-       Objects also keep track of whether metadata needs to be pushed back to
-       the database to keep things synchronized.
+       Objects also keep track of which fields have changed and so need to be
+       pushed back to the database to keep things synchronized.
        Keys cannot be removed or added."""
 
     def __init__(self, keys, values):
@@ -164,10 +183,14 @@ class _JobMetadata(object):
         self.mark_synced()
 
     def needs_sync(self):
-        return self.__needs_sync
+        return len(self.__dirty) > 0
+
+    def dirty_keys(self):
+        """Get the keys whose values have changed since the last sync"""
+        return [k for k in self.__dict if k in self.__dirty]
 
     def mark_synced(self):
-        self.__needs_sync = False
+        self.__dirty = set()
 
     def __getitem__(self, key):
         return self.__dict[key]
@@ -175,7 +198,7 @@ class _JobMetadata(object):
     def __setitem__(self, key, value):
         old = self.__dict[key]
         if old != value:
-            self.__needs_sync = True
+            self.__dirty.add(key)
             self.__dict[key] = value
 
     def keys(self):
@@ -275,13 +298,30 @@ class Config(object):
         p.stdin.close()
         p.wait()  # ignore return code for now
 
+    # Default location of the database server's socket, by engine
+    _default_sockets = {'mysql': '/var/lib/mysql/mysql.sock',
+                        'postgresql': '/var/run/postgresql'}
+
     def _populate_database(self, config):
         self.database = {}
+        if config.has_option('database', 'engine'):
+            engine = config.get('database', 'engine').lower()
+        else:
+            engine = 'mysql'
+        if engine not in saliweb.backend.engines.engines:
+            raise ConfigError("Unknown database engine %s; should be one "
+                              "of %s" % (engine, ", ".join(
+                                  sorted(saliweb.backend.engines.engines))))
+        self.database['engine'] = engine
         self.database['db'] = config.get('database', 'db')
+        if engine == 'sqlite' and not os.path.isabs(self.database['db']) \
+           and self._config_dir:
+            self.database['db'] = os.path.abspath(
+                os.path.join(self._config_dir, self.database['db']))
         try:
             self.database['socket'] = config.get('database', 'socket')
         except configparser.NoOptionError:
-            self.database['socket'] = '/var/lib/mysql/mysql.sock'
+            self.database['socket'] = self._default_sockets.get(engine)
         for key in ('backend_config', 'frontend_config'):
             fname = config.get('database', key)
             if not os.path.isabs(fname) and self._config_dir:
@@ -297,6 +337,9 @@ class Config(object):
         if config.has_option('limits', 'concurrent_tasks'):
             self.limits['concurrent_tasks'] = config.getint('limits',
                                                             'concurrent_tasks')
+        if config.has_option('limits', 'running_tasks'):
+            self.limits['running_tasks'] = config.getint('limits',
+                                                         'running_tasks')
 
     def _read_db_auth(self, end='back'):
         filename = self.database[end + 'end_config']
@@ -333,6 +376,19 @@ class Config(object):
             self.directories['FAILED'] = config.get('directories', 'FAILED')
         else:
             self.directories['FAILED'] = self.directories['COMPLETED']
+        if config.has_option('directories', 'sharded'):
+            self.sharded_directories = config.getboolean('directories',
+                                                         'sharded')
+        else:
+            self.sharded_directories = False
+
+    def _get_job_directory(self, state, name):
+        """Get the directory that the named job should use in the given
+           state, in either the flat or the sharded layout."""
+        topdir = self.directories[state]
+        if self.sharded_directories:
+            topdir = os.path.join(topdir, _get_job_shard(name))
+        return os.path.normpath(os.path.join(topdir, name))
 
     def _populate_backend(self, config):
         self.backend = {}
@@ -340,6 +396,26 @@ class Config(object):
         self.backend['check_minutes'] = config.getint('backend',
                                                       'check_minutes')
         self.backend['user'] = config.get('backend', 'user')
+        if config.has_option('backend', 'hook_workers'):
+            self.backend['hook_workers'] = config.getint('backend',
+                                                         'hook_workers')
+        else:
+            self.backend['hook_workers'] = 0
+        if config.has_option('backend', 'move_workers'):
+            self.backend['move_workers'] = config.getint('backend',
+                                                         'move_workers')
+        else:
+            self.backend['move_workers'] = 0
+        if config.has_option('backend', 'oldjob_workers'):
+            self.backend['oldjob_workers'] = config.getint('backend',
+                                                           'oldjob_workers')
+        else:
+            self.backend['oldjob_workers'] = 0
+        if config.has_option('backend', 'group_commit'):
+            self.backend['group_commit'] = config.getint('backend',
+                                                         'group_commit')
+        else:
+            self.backend['group_commit'] = 1
 
     def _populate_frontends(self, config):
         self.frontends = {}
@@ -361,27 +437,134 @@ class Config(object):
                               "expire time (%s)"
                               % (config.get('oldjobs', 'archive'),
                                  config.get('oldjobs', 'expire')))
+        if config.has_option('oldjobs', 'history'):
+            self.oldjobs['history'] = config.getboolean('oldjobs', 'history')
+        else:
+            self.oldjobs['history'] = False
+        if config.has_option('oldjobs', 'compress'):
+            compress = config.get('oldjobs', 'compress').lower()
+        else:
+            compress = 'none'
+        compressions = sorted(saliweb.backend.archiver.compressions)
+        if compress == 'none':
+            compress = None
+        elif compress not in compressions:
+            raise ConfigError("Unknown archive compression %s; should be "
+                              "one of none, %s"
+                              % (compress, ", ".join(compressions)))
+        else:
+            try:
+                saliweb.backend.archiver.check_compression(compress)
+            except ImportError as detail:
+                raise ConfigError("Archive compression %s cannot be used: %s"
+                                  % (compress, detail))
+        self.oldjobs['compress'] = compress
 
     def _get_time_delta(self, config, section, option):
-        raw = config.get(section, option)
+        return _parse_time_delta(config.get(section, option))
+
+
+def _notify_incoming(config, names):
+    """Wake up the web service and let it know that the named jobs are
+       now in the INCOMING state, using a single message."""
+    try:
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect(config.socket)
+        msg = " ".join("INCOMING %s" % name for name in names)
+        s.sendall(msg.encode('utf-8'))
+        s.close()
+    except socket.error:
+        pass
+
+
+def _parse_time_delta(raw):
+    """Parse a time interval such as 24h or 30d into a timedelta."""
+    try:
+        if raw.endswith('h'):
+            return datetime.timedelta(seconds=float(raw[:-1]) * 60 * 60)
+        elif raw.endswith('d'):
+            return datetime.timedelta(days=float(raw[:-1]))
+        elif raw.endswith('w'):
+            return datetime.timedelta(days=float(raw[:-1]) * 7)
+        elif raw.endswith('m'):
+            return datetime.timedelta(days=float(raw[:-1]) * 30)
+        elif raw.endswith('y'):
+            return datetime.timedelta(days=float(raw[:-1]) * 365)
+        elif raw.upper() == 'NEVER':
+            return None
+    except ValueError:
+        pass
+    raise ValueError("Time deltas must be 'NEVER' or numbers followed "
+                     "by h, d, w, m or y (for hours, days, weeks, months, "
+                     "or years), e.g. 24h, 30d, 1w, 3m, 1y; got " + raw)
+
+
+def _glob_to_like(pattern):
+    """Convert a glob pattern such as job* (as used by :mod:`fnmatch`) to a
+       SQL LIKE pattern, with ! as the escape character. Character sets
+       such as [abc] cannot be expressed with LIKE, so match any single
+       character; the pattern may thus match more names than the glob."""
+    like = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            like.append('%')
+        elif c == '?':
+            like.append('_')
+        elif c == '[':
+            # Find the end of the set, as fnmatch does; an unterminated
+            # set is just a literal [
+            j = i
+            if j < len(pattern) and pattern[j] == '!':
+                j += 1
+            if j < len(pattern) and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j < 0:
+                like.append('[')
+            else:
+                like.append('_')
+                i = j + 1
+        elif c in '%_!':
+            like.append('!' + c)
+        else:
+            like.append(c)
+    return ''.join(like)
+
+
+# Names of the subdirectories used in the sharded job directory layout
+_shard_re = re.compile('[0-9a-f]{2}$')
+_get_job_shard = saliweb._get_job_shard
+
+
+def _modified_since(directory, cutoff):
+    """Return True if `directory`, or anything under it, was modified at or
+       after the time `cutoff`. The search stops as soon as such an entry
+       is found. :exc:`OSError` is raised if `directory` cannot be read;
+       entries below it that disappear during the search are ignored."""
+    if os.stat(directory).st_mtime >= cutoff:
+        return True
+    subdirs = []
+    with os.scandir(directory) as it:
+        entries = list(it)
+    while True:
+        for entry in entries:
+            try:
+                if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+                    return True
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+            except OSError:
+                pass
+        if not subdirs:
+            return False
         try:
-            if raw.endswith('h'):
-                return datetime.timedelta(seconds=float(raw[:-1]) * 60 * 60)
-            elif raw.endswith('d'):
-                return datetime.timedelta(days=float(raw[:-1]))
-            elif raw.endswith('w'):
-                return datetime.timedelta(days=float(raw[:-1]) * 7)
-            elif raw.endswith('m'):
-                return datetime.timedelta(days=float(raw[:-1]) * 30)
-            elif raw.endswith('y'):
-                return datetime.timedelta(days=float(raw[:-1]) * 365)
-            elif raw.upper() == 'NEVER':
-                return None
-        except ValueError:
-            pass
-        raise ValueError("Time deltas must be 'NEVER' or numbers followed "
-                         "by h, d, w, m or y (for hours, days, weeks, months, "
-                         "or years), e.g. 24h, 30d, 1w, 3m, 1y; got " + raw)
+            with os.scandir(subdirs.pop()) as it:
+                entries = list(it)
+        except OSError:
+            entries = []
 
 
 class MySQLField(object):
@@ -441,24 +624,90 @@ class MySQLField(object):
         return schema
 
 
+class MySQLIndex(object):
+    """Description of an index on one or more fields in a MySQL database
+       table. Each index must have a unique `name` (e.g. 'state_time_index')
+       and a list of the names of the `fields` it covers, in order
+       (e.g. ['state', 'submit_time'])."""
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = tuple(fields)
+
+    def __eq__(self, other):
+        return self.name == other.name and self.fields == other.fields
+
+    def __ne__(self, other):
+        return not self == other
+
+    def get_schema(self, table):
+        """Get the SQL statement needed to add this index to the
+           given table."""
+        return "CREATE INDEX %s ON %s (%s)" % (self.name, table,
+                                               ", ".join(self.fields))
+
+
 class Database(object):
     """Management of the job database.
        Can be subclassed to add extra columns to the tables for
-       service-specific metadata, or to use a different database engine.
+       service-specific metadata, or to use a different database engine
+       (see :meth:`get_engine`).
        `jobcls` should be a subclass of :class:`Job`, which will be used to
        instantiate new job objects.
     """
     _jobtable = 'jobs'
     _dependtable = 'dependencies'
+    _historytable = 'expired_jobs'
+
+    # Number of rows to fetch at a time when streaming results
+    _stream_batch_size = 1000
+
+    # Maximum number of idle database connections to keep open
+    _pool_size = 4
+
+    # Maximum number of job names to look up in a single query (some
+    # engines limit the number of query parameters)
+    _max_names_per_query = 500
 
     def __init__(self, jobcls):
         self._jobcls = jobcls
         self._fields = []
+        self._indexes = []
+        # If True, expired jobs are kept in the history table
+        self._history = False
+        # If True, job directories are moved in the background
+        # (see set_background_moves)
+        self._background_moves = False
+        # In-memory copy of the dependencies table, loaded on first use
+        self._dependency_graph = None
+        # Named tuple classes used by _get_job_rows, keyed by field names
+        self._row_classes = {}
+        # Maximum number of job changes to group into one transaction
+        # (see set_group_commit)
+        self._group_commit = 1
+        # Statements executed in the current unit of work, if any
+        self._uow_journal = None
+        self._uow_changes = 0
+        # True if changes have been made outside of a unit of work that
+        # are not yet committed (these cannot be made again if the
+        # connection is lost)
+        self._unjournaled_writes = False
         # Set up fields for dependencies table
         self._dependfields = [MySQLField('child', 'VARCHAR(40)', index=True,
                                          null=False),
                               MySQLField('parent', 'VARCHAR(40)', index=True,
                                          null=False)]
+        # Set up fields for the history table; only enough information is
+        # kept to identify an expired job
+        self._historyfields = [MySQLField('name', 'VARCHAR(40)',
+                                          key='PRIMARY', null=False),
+                               MySQLField('user', 'VARCHAR(40)'),
+                               MySQLField('passwd', 'CHAR(10)'),
+                               MySQLField('contact_email', 'VARCHAR(100)'),
+                               MySQLField('submit_time', 'DATETIME',
+                                          null=False),
+                               MySQLField('end_time', 'DATETIME'),
+                               MySQLField('expire_time', 'DATETIME')]
         # Add fields used by all web services
         states = ",".join("'%s'" % x for x in _JobState.get_valid_states())
         self.add_field(MySQLField('name', 'VARCHAR(40)', key='PRIMARY',
@@ -478,8 +727,16 @@ class Database(object):
         self.add_field(MySQLField('end_time', 'DATETIME'))
         self.add_field(MySQLField('archive_time', 'DATETIME'))
         self.add_field(MySQLField('expire_time', 'DATETIME'))
-        self.add_field(MySQLField('runner_id', 'VARCHAR(200)'))
+        self.add_field(MySQLField('runner_id', 'VARCHAR(200)', index=True))
         self.add_field(MySQLField('failure', 'TEXT'))
+        # Indexes for the queries made by the backend to find incoming jobs
+        # (in submit order) and old jobs to archive or expire
+        self.add_index(MySQLIndex('state_submit_index',
+                                  ['state', 'submit_time']))
+        self.add_index(MySQLIndex('state_archive_index',
+                                  ['state', 'archive_time']))
+        self.add_index(MySQLIndex('state_expire_index',
+                                  ['state', 'expire_time']))
 
     def add_field(self, field):
         """Add a new field (typically a :class:`MySQLField` object) to each
@@ -487,80 +744,366 @@ class Database(object):
            immediately after creating the :class:`Database` object."""
         self._fields.append(field)
 
+    def add_index(self, index):
+        """Add a new index (typically a :class:`MySQLIndex` object) to the
+           jobs table. This is only needed for indexes covering more than
+           one field; to index a single field, pass `index=True` to its
+           :class:`MySQLField` instead."""
+        self._indexes.append(index)
+
+    def _get_indexes(self):
+        """Get all indexes expected by the backend, as a list of
+           (table name, :class:`MySQLIndex`) tuples."""
+        indexes = []
+        for table, fields in ((self._jobtable, self._fields),
+                              (self._dependtable, self._dependfields)):
+            indexes.extend((table, MySQLIndex(f.name + '_index', [f.name]))
+                           for f in fields if f.index)
+        indexes.extend((self._jobtable, i) for i in self._indexes)
+        return indexes
+
+    def _get_table_indexes(self, table):
+        """Get all indexes currently present on the given database table,
+           as a dict of index name: tuple of field names."""
+        return self._engine.get_table_indexes(self._execute, table)
+
+    def _get_missing_indexes(self):
+        """Get all indexes expected by the backend that are not present in
+           the database (or that cover different fields), as a list of
+           (table name, :class:`MySQLIndex`) tuples."""
+        present = {}
+        missing = []
+        for table, index in self._get_indexes():
+            if table not in present:
+                present[table] = self._get_table_indexes(table)
+            missing.extend((table, i) for i in
+                           self._get_missing_table_indexes([index],
+                                                           present[table]))
+        return missing
+
+    @staticmethod
+    def _get_missing_table_indexes(indexes, present):
+        """Get those of the given :class:`MySQLIndex` objects that are not
+           in `present` (a dict of index name: tuple of field names for a
+           database table) or that cover different fields."""
+        return [index for index in indexes
+                if present.get(index.name) != index.fields]
+
+    def _add_index(self, table, index):
+        """Add the given index to a (possibly live) database table. Any
+           existing index with the same name is replaced."""
+        if index.name in self._get_table_indexes(table):
+            self._execute(self._engine.get_drop_index_schema(table,
+                                                             index.name))
+        self._execute(self._engine.get_index_schema(table, index,
+                                                    online=True))
+        self.conn.commit()
+
     def set_track_hostname(self):
         """Add extra fields to support tracking the user's hostname"""
         self.add_field(MySQLField('hostname', 'VARCHAR(400)'))
 
+    def set_background_moves(self):
+        """Add extra fields to record job directories that are being moved
+           in the background (see :meth:`Job._change_state`), so that
+           moves interrupted by a crash can be recovered."""
+        self._background_moves = True
+        self.add_field(MySQLField('moving_to', 'TEXT'))
+
+    def set_expired_history(self):
+        """Move jobs out of the jobs table and into a separate, compact
+           history table when they expire, so that the jobs table only
+           grows with the number of active jobs."""
+        self._history = True
+
+    def set_group_commit(self, max_changes):
+        """Group changes to jobs made while the backend processes a single
+           event into one database transaction, rather than committing each
+           change separately, so that processing many jobs at once needs
+           far fewer (expensive) commits. A transaction is committed after
+           at most `max_changes` changes, to limit the amount of work that
+           is not yet visible to the frontend.
+
+           If the connection to the database is lost, uncommitted changes
+           are made again on a new connection (see :meth:`_unit_of_work`).
+           If the backend itself crashes, however, any uncommitted changes
+           are lost. Job directories are moved before each change is
+           written, so a job may then be recorded in the database with its
+           old state and directory although its directory has already
+           moved, or be left in a transient state such as PREPROCESSING.
+           Such jobs are reported (or, if in a transient state, failed) by
+           the sanity checks when the backend next starts."""
+        self._group_commit = max_changes
+
+    @contextlib.contextmanager
+    def _unit_of_work(self, max_changes=None):
+        """Context manager to group all job changes made in its body into
+           as few transactions as possible (see :meth:`set_group_commit`;
+           `max_changes`, if given, overrides the configured limit).
+           Job directories are moved before each change is written, so the
+           changes made so far are always kept (and committed) even if
+           an exception is raised or the database connection is lost.
+           Every change is recorded in a journal until it is committed, so
+           that it can be made again on a new connection."""
+        if max_changes is None:
+            max_changes = self._group_commit
+        if max_changes <= 1 or self._uow_journal is not None:
+            yield
+            return
+        self._uow_journal = []
+        self._uow_changes = 0
+        old_group_commit, self._group_commit = self._group_commit, max_changes
+        try:
+            yield
+        finally:
+            # Keep the changes made so far, even if an exception was raised
+            # (a failed statement has not changed anything)
+            try:
+                self._commit_journal()
+            finally:
+                self._uow_journal = None
+                self._group_commit = old_group_commit
+
+    def _replay(self, journal):
+        """Execute again all statements in the given journal."""
+        for query, args in journal:
+            c = self._engine.get_cursor(self.conn)
+            c.execute(query, args)
+
+    def _write(self, query, args=()):
+        """Execute a query that changes the job tables, as for
+           :meth:`_execute`. The change will be committed by a subsequent
+           call to :meth:`_commit`."""
+        c = self._execute(query, args)
+        if self._uow_journal is None:
+            self._unjournaled_writes = True
+        else:
+            self._uow_journal.append((query, args))
+        return c
+
+    def _commit(self):
+        """Commit changes made by :meth:`_write`; in a unit of work (see
+           :meth:`_unit_of_work`) this is deferred until the end of the
+           unit or until enough changes have been made."""
+        if self._uow_journal is None:
+            self.conn.commit()
+            self._unjournaled_writes = False
+        else:
+            self._uow_changes += 1
+            if self._uow_changes >= self._group_commit:
+                self._flush_unit_of_work()
+
+    def _commit_journal(self):
+        """Commit all changes made so far in the current unit of work. If
+           the connection is lost while committing, the changes are made
+           again on a new connection and committed there. (If the commit
+           did in fact reach the server, this repeats changes that were
+           already made; this is harmless, since every statement that is
+           journaled sets fields to fixed values, or deletes or replaces
+           rows.)"""
+        try:
+            self.conn.commit()
+        except self._engine.errors as err:
+            if (not self._engine.is_disconnect(err)
+                    or self._unjournaled_writes):
+                raise
+            # Replays the journal
+            self._reconnect()
+            self.conn.commit()
+        self._unjournaled_writes = False
+
+    def _flush_unit_of_work(self):
+        """Commit all changes made so far in the current unit of work."""
+        self._commit_journal()
+        self._uow_journal[:] = []
+        self._uow_changes = 0
+
+    def _commit_now(self):
+        """Make sure that all changes made by :meth:`_write` so far are
+           committed, even in a unit of work."""
+        if self._uow_journal is not None:
+            self._flush_unit_of_work()
+
+    def _get_job_table(self, state):
+        """Get the table that holds jobs in the given state, and the names
+           of its fields."""
+        if state == 'EXPIRED' and self._history:
+            return self._historytable, [x.name for x in self._historyfields]
+        else:
+            return self._jobtable, [x.name for x in self._fields]
+
+    def get_engine(self, config):
+        """Get the :class:`~saliweb.backend.engines.SQLEngine` object used
+           to talk to the database. By default, this is chosen by the
+           'engine' option in the [database] section of the configuration
+           file (MySQL if not given). Override this method in a subclass to
+           use a custom engine."""
+        engine = config.database.get('engine', 'mysql')
+        return saliweb.backend.engines.engines[engine]()
+
     def _connect(self, config):
         """Set up the connection to the database. Usually called from the
            :class:`WebService` object."""
-        import MySQLdb
-        self._OperationalError = MySQLdb.OperationalError
-        self._placeholder = '%s'
         self.config = config
-        self.conn = MySQLdb.connect(user=config.database['user'],
-                                    db=config.database['db'],
-                                    unix_socket=config.database['socket'],
-                                    passwd=config.database['passwd'])
-        self.conn.set_character_set('utf8')
-        c = self.conn.cursor()
-        # Make sure that our SELECTs see jobs added by the frontend
-        c.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        self._engine = self.get_engine(config)
+        self._placeholder = self._engine.placeholder
+        self._pool = saliweb.backend.engines._ConnectionPool(
+            self._engine, config, self._pool_size)
+        self.conn = self._pool.get()
+
+    def _reconnect(self):
+        """Replace the connection to the database, after it was lost."""
+        saliweb.backend.engines._close_quietly(self.conn)
+        # Any idle connections probably went away too
+        self._pool.clear()
+        self.conn = self._pool.get()
+        self._unjournaled_writes = False
+        # Uncommitted changes in the current unit of work were lost too
+        if self._uow_journal:
+            self._replay(self._uow_journal)
 
     def _drop_tables(self):
         """Drop all tables in the database used to hold job state."""
-        c = self.conn.cursor()
-        c.execute('DROP TABLE IF EXISTS ' + self._jobtable)
-        c.execute('DROP TABLE IF EXISTS ' + self._dependtable)
+        self._execute('DROP TABLE IF EXISTS ' + self._jobtable)
+        self._execute('DROP TABLE IF EXISTS ' + self._dependtable)
+        if self._history:
+            self._execute('DROP TABLE IF EXISTS ' + self._historytable)
         self.conn.commit()
 
     def _delete_tables(self):
         """Delete all tables in the database used to hold job state."""
-        c = self.conn.cursor()
-        c.execute('DELETE FROM ' + self._jobtable)
-        c.execute('DELETE FROM ' + self._dependtable)
+        self._execute('DELETE FROM ' + self._jobtable)
+        self._execute('DELETE FROM ' + self._dependtable)
+        if self._history:
+            self._execute('DELETE FROM ' + self._historytable)
         self.conn.commit()
 
     def _create_tables(self):
         """Create all tables in the database to hold job state."""
-        c = self.conn.cursor()
-        schema = ', '.join(x.get_schema() for x in self._fields)
-        c.execute('CREATE TABLE %s (%s)' % (self._jobtable, schema))
-        for field in self._fields:
-            if field.index:
-                c.execute('CREATE INDEX %s_index ON %s (%s)'
-                          % (field.name, self._jobtable, field.name))
-
-        schema = ', '.join(x.get_schema() for x in self._dependfields)
-        c.execute('CREATE TABLE %s (%s)' % (self._dependtable, schema))
+        tables = [(self._jobtable, self._fields),
+                  (self._dependtable, self._dependfields)]
+        if self._history:
+            tables.append((self._historytable, self._historyfields))
+        for table, fields in tables:
+            schema = ', '.join(self._engine.get_field_schema(x)
+                               for x in fields)
+            self._execute('CREATE TABLE %s (%s)' % (table, schema))
+        for table, index in self._get_indexes():
+            self._execute(self._engine.get_index_schema(table, index))
         self.conn.commit()
 
-    def _execute(self, query, args=()):
+    def _execute(self, query, args=(), stream=False):
         """Open a database cursor and execute the given query. The cursor
            object is returned. If the connection to the database has been
-           lost, try to restablish it."""
-        c = self.conn.cursor()
+           lost, try to restablish it. If `stream` is True, the results are
+           read from the server as they are fetched from the cursor, rather
+           than all at once; the cursor must be closed once all
+           results have been fetched. The query is only tried again on a
+           new connection if that would not lose any changes (i.e. all
+           uncommitted changes are in a unit of work, and so can be
+           made again)."""
+        engine = self._engine
+        if stream and engine.stream_separate_connection:
+            return self._execute_stream(query, args)
+        c = engine.get_cursor(self.conn, stream)
         try:
             c.execute(query, args)
-        except self._OperationalError as err:
-            # Catch a MySQLdb.OperationalError with code 2006
-            # ("server has gone away"); any other kind of error is
-            # fatal and so is passed on
-            if hasattr(err, 'args') and isinstance(err.args, tuple) \
-               and len(err.args) >= 1 and err.args[0] == 2006:
-                self._connect(self.config)
-                c = self.conn.cursor()
-                c.execute(query, args)
-            else:
+        except engine.errors as err:
+            # If the connection was lost, try again on a new connection;
+            # any other kind of error is fatal and so is passed on
+            if not engine.is_disconnect(err):
                 raise
+            lost_writes = self._unjournaled_writes
+            self._reconnect()
+            if lost_writes:
+                raise
+            c = engine.get_cursor(self.conn, stream)
+            c.execute(query, args)
         return c
 
+    def _execute_stream(self, query, args):
+        """Execute the given query, streaming results using a separate
+           connection from the pool (so that other queries can be made
+           while the results are read)."""
+        engine = self._engine
+        # Other connections cannot see uncommitted changes
+        if self._uow_journal:
+            self._flush_unit_of_work()
+        conn = self._pool.get()
+        try:
+            try:
+                c = engine.get_cursor(conn, stream=True)
+                c.execute(query, args)
+            except engine.errors as err:
+                if not engine.is_disconnect(err):
+                    raise
+                saliweb.backend.engines._close_quietly(conn)
+                self._pool.clear()
+                conn = self._pool.get()
+                c = engine.get_cursor(conn, stream=True)
+                c.execute(query, args)
+        except BaseException:
+            # Don't leak the connection if the query could not be run
+            saliweb.backend.engines._close_quietly(conn)
+            raise
+        return saliweb.backend.engines._PooledCursor(c, conn, self._pool)
+
     def _count_all_jobs_in_state(self, state):
         """Return a count of all the jobs in the given job state."""
-        c = self._execute('SELECT COUNT(*) FROM %s WHERE state=%s'
-                          % (self._jobtable, self._placeholder), (state,))
+        table, fields = self._get_job_table(state)
+        if table == self._historytable:
+            c = self._execute('SELECT COUNT(*) FROM ' + table)
+        else:
+            c = self._execute('SELECT COUNT(*) FROM %s WHERE state=%s'
+                              % (table, self._placeholder), (state,))
         return c.fetchone()[0]
 
+    def _quote_fields(self, fields):
+        """Get a comma-separated list of the given field names, quoted
+           if necessary for the database engine."""
+        return ', '.join(self._engine.quote_identifier(f) for f in fields)
+
+    def _set_fields(self, fields):
+        """Get the SET clause of an UPDATE statement for the given
+           field names."""
+        return ' SET ' + ', '.join(self._engine.quote_identifier(f) + '='
+                                   + self._placeholder for f in fields)
+
+    def _count_jobs_in_state_by(self, state, fields):
+        """Return a count of all the jobs in the given job state, grouped
+           by the given database fields. This is returned as a dict where
+           the keys are tuples of field values."""
+        fields = self._quote_fields(fields)
+        c = self._execute('SELECT %s, COUNT(*) FROM %s WHERE state=%s '
+                          'GROUP BY %s' % (fields, self._jobtable,
+                                           self._placeholder, fields),
+                          (state,))
+        return dict((tuple(row[:-1]), row[-1]) for row in c)
+
+    def _get_next_old_job_time(self):
+        """Get the earliest time (or None) at which any completed job is due
+           to be archived, or any archived job is due to expire."""
+        times = []
+        for state, field in (('COMPLETED', 'archive_time'),
+                             ('ARCHIVED', 'expire_time')):
+            c = self._execute('SELECT %s FROM %s WHERE state=%s AND %s IS '
+                              'NOT NULL ORDER BY %s LIMIT 1'
+                              % (field, self._jobtable, self._placeholder,
+                                 field, field), (state,))
+            row = c.fetchone()
+            if row is not None:
+                times.append(row[0])
+        return min(times) if times else None
+
+    def _count_jobs_by_state(self):
+        """Return a count of the jobs in each state (other than EXPIRED),
+           as a dict keyed by state name."""
+        c = self._execute('SELECT state, COUNT(*) FROM %s WHERE state!=%s '
+                          'GROUP BY state' % (self._jobtable,
+                                              self._placeholder),
+                          ('EXPIRED',))
+        return dict((row[0], row[1]) for row in c)
+
     def _get_job_dependencies(self):
         """Get all job dependencies.
            This is returned as a dict of child:[parent,...] pairs,
@@ -576,87 +1119,414 @@ class Database(object):
                 depends[child] = [parent]
         return depends
 
+    def _get_dependency_graph(self):
+        """Get the in-memory graph of job dependencies, reading it from the
+           database the first time this is called."""
+        if self._dependency_graph is None:
+            self._dependency_graph = _DependencyGraph(
+                self._get_job_dependencies())
+        return self._dependency_graph
+
+    def _refresh_job_dependencies(self, children):
+        """Reread the dependencies of the given jobs from the database (e.g.
+           for newly submitted jobs) and update the in-memory graph."""
+        graph = self._get_dependency_graph()
+        children = list(children)
+        if not children:
+            return
+        depends = dict((child, []) for child in children)
+        # Keep the number of query parameters within database limits
+        for i in range(0, len(children), self._max_names_per_query):
+            chunk = children[i:i + self._max_names_per_query]
+            c = self._execute(
+                'SELECT child, parent FROM %s WHERE child IN (%s)'
+                % (self._dependtable,
+                   ', '.join([self._placeholder] * len(chunk))), chunk)
+            for child, parent in c:
+                depends[child].append(parent)
+        for child, parents in depends.items():
+            graph.set_parents(child, parents)
+
+    def _check_dependency_graph(self):
+        """Make sure the in-memory graph of job dependencies matches the
+           database, and reload it if not. Return True if it matched."""
+        depends = self._get_job_dependencies()
+        graph = self._dependency_graph
+        if graph is None or graph.matches(depends):
+            return True
+        newgraph = _DependencyGraph(depends)
+        # Jobs no longer waiting on any other job are now ready
+        newgraph.ready = graph.ready | (set(graph.parents)
+                                        - set(newgraph.parents))
+        self._dependency_graph = newgraph
+        return False
+
+    def _pop_ready_jobs(self):
+        """Return the names of all jobs that were waiting on other jobs,
+           but have become ready to run since the last call."""
+        if self._dependency_graph is None:
+            return set()
+        return self._dependency_graph.pop_ready()
+
     def _get_all_jobs_in_state(self, state, name=None, after_time=None,
-                               runner_id=None, order_by=None):
+                               runner_id=None, order_by=None, fields=None,
+                               stream=False, user=None,
+                               submitted_before=None, limit=None,
+                               name_patterns=None, names=None):
         """Get all the jobs in the given job state, as a generator of
            :class:`Job` objects (or a subclass, as given by the `jobcls`
            argument to the :class:`Database` constructor).
            If `name` is specified, only jobs which match the given name are
            returned.
+           If `names` is specified, only jobs with any of the given names
+           are returned.
+           If `name_patterns` is specified, only jobs whose names match
+           any of the given glob patterns (such as job*) are returned;
+           the match is done by the database, so is not exact (see
+           :func:`_glob_to_like`) and the caller should check the names
+           with :mod:`fnmatch`.
            If `after_time` is specified, only jobs where the time (given in
            the database column of the same name) is less than the current
            system time are returned.
            If `runner_id` is specified, only jobs which match the given
            runner ID are returned.
+           If `user` is specified, only jobs submitted by the given user
+           are returned.
+           If `submitted_before` is specified, only jobs submitted before
+           the given (UTC) datetime are returned.
            If `order_by` is specified, the jobs are returned sorted by the
            given column.
+           If `limit` is specified, at most that many jobs are returned.
+           If `fields` is specified, only the given database columns (plus
+           the job name) are read, and the metadata of the returned jobs
+           contains only these fields.
+           If `stream` is True, results are read from the database in
+           batches as the returned generator is consumed, rather than all
+           at once, so that large tables can be read in bounded memory.
+           The caller must not make any other database queries until the
+           generator is exhausted.
+           If expired jobs are kept in the history table, EXPIRED jobs are
+           read from that table, and contain only the fields it stores.
         """
-        fields = [x.name for x in self._fields]
-        query = 'SELECT ' + ', '.join(fields) + ' FROM ' + self._jobtable
-        wheres = ['state=' + self._placeholder]
+        fields, rows = self._select_jobs_in_state(
+            state, name=name, after_time=after_time, runner_id=runner_id,
+            order_by=order_by, fields=fields, stream=stream, user=user,
+            submitted_before=submitted_before, limit=limit,
+            name_patterns=name_patterns, names=names)
+        for row in rows:
+            metadata = _JobMetadata(fields, row)
+            yield self._jobcls(self, metadata, _JobState(state))
+
+    def _get_jobs_by_name(self, state, names):
+        """Get all the jobs in the given job state that have any of the
+           given names, as a generator of :class:`Job` objects."""
+        names = list(names)
+        for i in range(0, len(names), self._max_names_per_query):
+            yield from self._get_all_jobs_in_state(
+                state, names=names[i:i + self._max_names_per_query])
+
+    def _get_job_rows(self, state, fields=(), order_by=None, stream=False):
+        """Get all the jobs in the given job state, as for
+           :meth:`_get_all_jobs_in_state`, but as a generator of lightweight
+           read-only named tuples rather than :class:`Job` objects.
+           These contain only the given `fields` plus the job name and
+           state, and so are much cheaper to create for bulk scans of the
+           job table."""
+        fields, rows = self._select_jobs_in_state(
+            state, order_by=order_by, fields=fields, stream=stream)
+        key = tuple(fields)
+        rowcls = self._row_classes.get(key)
+        if rowcls is None:
+            rowcls = self._row_classes[key] = collections.namedtuple(
+                '_JobRow', fields)
+        for row in rows:
+            yield rowcls._make(row)
+
+    def _get_job_names(self, state):
+        """Get the names of all jobs in the given job state, as a set.
+           This reads only the name column, so is cheaper than
+           :meth:`_get_job_rows` when nothing else is needed."""
+        table = self._get_job_table(state)[0]
+        if table == self._historytable:
+            c = self._execute('SELECT name FROM ' + table)
+        else:
+            c = self._execute('SELECT name FROM %s WHERE state=%s'
+                              % (table, self._placeholder), (state,))
+        return set(row[0] for row in c)
+
+    def _get_moving_jobs(self):
+        """Get the names of all jobs whose directories are being moved in
+           the background (see :meth:`set_background_moves`), as a dict
+           of name: state."""
+        if not self._background_moves:
+            return {}
+        c = self._execute('SELECT name, state FROM %s WHERE moving_to '
+                          'IS NOT NULL' % self._jobtable)
+        return dict((row[0], row[1]) for row in c)
+
+    def _select_jobs_in_state(self, state, name=None, after_time=None,
+                              runner_id=None, order_by=None, fields=None,
+                              stream=False, user=None,
+                              submitted_before=None, limit=None,
+                              name_patterns=None, names=None):
+        """Query the database for jobs in the given state (see
+           :meth:`_get_all_jobs_in_state`). Return the names of the fields
+           read, and a generator of the database rows."""
+        table, all_fields = self._get_job_table(state)
+        if fields is None:
+            fields = all_fields
+        else:
+            fields = ['name', 'state'] + [f for f in fields
+                                          if f not in ('name', 'state')]
+        if table == self._historytable:
+            # There is no state column in the history table, and fields
+            # not kept in the history are not available
+            fields = [f for f in fields if f in all_fields]
+            query = 'SELECT ' + self._quote_fields(fields) + ', ' \
+                + self._placeholder + ' FROM ' + table
+            fields = fields + ['state']
+            wheres = []
+        else:
+            query = 'SELECT ' + self._quote_fields(fields) + ' FROM ' + table
+            wheres = ['state=' + self._placeholder]
         params = [state]
         if name is not None:
             wheres.append('name=' + self._placeholder)
             params.append(name)
+        if names is not None:
+            if not names:
+                # No job can match an empty list (and "IN ()" is not valid)
+                wheres.append('1=0')
+            else:
+                wheres.append('name IN (%s)' % ', '.join(
+                    [self._placeholder] * len(names)))
+                params.extend(names)
+        if name_patterns:
+            like = "name LIKE %s ESCAPE '!'" % self._placeholder
+            wheres.append('(' + ' OR '.join([like] * len(name_patterns))
+                          + ')')
+            params.extend(_glob_to_like(p) for p in name_patterns)
         if runner_id is not None:
             wheres.append('runner_id=' + self._placeholder)
             params.append(runner_id)
+        if user is not None:
+            wheres.append(self._engine.quote_identifier('user') + '='
+                          + self._placeholder)
+            params.append(user)
+        if submitted_before is not None:
+            wheres.append('submit_time < ' + self._placeholder)
+            params.append(submitted_before)
         if after_time is not None:
             wheres.append(after_time + ' IS NOT NULL')
-            wheres.append(after_time + ' < UTC_TIMESTAMP()')
-        query += ' WHERE ' + ' AND '.join(wheres)
+            wheres.append(after_time + ' < ' + self._engine.utc_timestamp)
+        if wheres:
+            query += ' WHERE ' + ' AND '.join(wheres)
         if order_by:
             query += ' ORDER BY ' + order_by
+        if limit is not None:
+            query += ' LIMIT %d' % limit
 
         # Use regular cursor rather than MySQLdb.cursors.DictCursor, so we stay
-        # reasonably database-independent
-        c = self._execute(query, params)
-        for row in c:
-            metadata = _JobMetadata(fields, row)
-            yield self._jobcls(self, metadata, _JobState(state))
+        # database-independent
+        c = self._execute(query, params, stream=stream)
+        if stream:
+            return fields, self._stream_rows(c)
+        else:
+            return fields, c
+
+    def _stream_rows(self, c):
+        """Yield all rows from the given streaming cursor, and close it."""
+        try:
+            while True:
+                rows = c.fetchmany(self._stream_batch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            c.close()
 
     def _delete_job(self, metadata, state):
         """Delete a job from the job state table."""
-        c = self.conn.cursor()
-        query = 'DELETE FROM ' + self._jobtable \
-                + ' WHERE name=' + self._placeholder
-        c.execute(query, [metadata['name']])
+        table, fields = self._get_job_table(state)
+        query = 'DELETE FROM ' + table + ' WHERE name=' + self._placeholder
+        self._write(query, [metadata['name']])
         query = 'DELETE FROM %s WHERE parent=%s OR child=%s' \
                 % (self._dependtable, self._placeholder, self._placeholder)
-        c.execute(query, [metadata['name']]*2)
-        self.conn.commit()
+        self._write(query, [metadata['name']]*2)
+        self._commit()
+        if self._dependency_graph is not None:
+            self._dependency_graph.remove_job(metadata['name'])
         metadata.mark_synced()
 
     def _update_job(self, metadata, state):
-        """Update a job in the job state table."""
-        query = 'UPDATE ' + self._jobtable + ' SET ' \
-                + ', '.join(x + '=' + self._placeholder
-                            for x in metadata.keys()) \
+        """Update a job in the job state table. Only fields that have changed
+           are written."""
+        table, fields = self._get_job_table(state)
+        keys = [k for k in metadata.dirty_keys() if k in fields]
+        if keys:
+            query = 'UPDATE ' + table + self._set_fields(keys) \
                 + ' WHERE name=' + self._placeholder
-        self._execute(query, list(metadata.values()) + [metadata['name']])
+            self._write(query,
+                        [metadata[x] for x in keys] + [metadata['name']])
         if state == 'COMPLETED':
             self._remove_dependency_on(metadata['name'])
-        self.conn.commit()
+        self._commit()
         metadata.mark_synced()
 
     def _remove_dependency_on(self, jobname):
-        c = self.conn.cursor()
         query = 'DELETE FROM %s WHERE parent=%s' \
                 % (self._dependtable, self._placeholder)
-        c.execute(query, [jobname])
+        self._write(query, [jobname])
+        if self._dependency_graph is not None:
+            self._dependency_graph.remove_parent(jobname)
 
     def _change_job_state(self, metadata, oldstate, newstate):
         """Change the job state in the database. This has the side effect of
            updating the job (as if :meth:`_update_job` were called)."""
-        query = 'UPDATE ' + self._jobtable + ' SET ' \
-                + ', '.join(x + '=' + self._placeholder
-                            for x in list(metadata.keys()) + ['state']) \
+        keys = metadata.dirty_keys()
+        query = 'UPDATE ' + self._jobtable \
+            + self._set_fields(keys + ['state']) \
+            + ' WHERE name=' + self._placeholder
+        self._write(query, [metadata[x] for x in keys]
+                    + [newstate, metadata['name']])
+        if newstate == 'COMPLETED':
+            self._remove_dependency_on(metadata['name'])
+        self._commit()
+        metadata.mark_synced()
+
+    def _expire_job(self, metadata):
+        """Update a job that has just moved to the EXPIRED state (as for
+           :meth:`_update_job`) and, if enabled, move it from the jobs
+           table to the history table."""
+        keys = metadata.dirty_keys()
+        if keys:
+            query = 'UPDATE ' + self._jobtable + self._set_fields(keys) \
                 + ' WHERE name=' + self._placeholder
-        self._execute(
-            query, list(metadata.values()) + [newstate, metadata['name']])
-        self.conn.commit()
+            self._write(query,
+                        [metadata[x] for x in keys] + [metadata['name']])
+        if self._history:
+            self._move_jobs_to_history([metadata['name']])
+        self._commit()
         metadata.mark_synced()
 
+    def _move_jobs_to_history(self, names):
+        """Copy the named jobs from the jobs table into the history table,
+           and then remove them from the jobs table. The caller is
+           responsible for committing the transaction."""
+        fields = [x.name for x in self._historyfields]
+        where = ' WHERE name IN (%s)' % ', '.join([self._placeholder]
+                                                  * len(names))
+        # Replace any existing row, so that expiry never fails if the
+        # frontend reused the name of an expired job
+        select = 'SELECT %s FROM %s' % (self._quote_fields(fields),
+                                        self._jobtable)
+        self._write(self._engine.get_replace_select(
+            self._historytable, fields, 'name', select + where), names)
+        self._write('DELETE FROM ' + self._jobtable + where, names)
+
+    def _move_expired_jobs_to_history(self, limit):
+        """Move up to `limit` jobs that expired before the history table
+           was enabled into the history table. Return the number of jobs
+           moved."""
+        c = self._execute('SELECT name FROM %s WHERE state=%s LIMIT %d'
+                          % (self._jobtable, self._placeholder, limit),
+                          ('EXPIRED',))
+        names = [row[0] for row in c.fetchall()]
+        if names:
+            self._move_jobs_to_history(names)
+            self._commit()
+        return len(names)
+
+
+class SchedulingPolicy(object):
+    """Decide the order in which incoming jobs are started. This default
+       policy starts jobs in the order in which they were submitted.
+       To change the policy, assign an instance of this class (or a
+       subclass) to :attr:`WebService.scheduling_policy`."""
+
+    def order_jobs(self, webservice, jobs):
+        """Given an iterable of :class:`Job` objects that are ready to run,
+           ordered by submit time, return an iterable of the same jobs in the
+           order in which they should be started. This should be lazy
+           where possible, since usually only the first few jobs are
+           started."""
+        return jobs
+
+
+class FairShareSchedulingPolicy(SchedulingPolicy):
+    """Scheduling policy that shares running job slots fairly between
+       users, so that a single user submitting a large number of jobs cannot
+       prevent other users' jobs from starting. Each incoming job is assigned
+       to the user who submitted it, identified by the first of the given
+       database `fields` that is set for the job (by default 'user',
+       'contact_email', and, if tracked, 'hostname'). Jobs are then started
+       round-robin between users, favoring users with fewer running jobs
+       (weighted by :meth:`get_weight`). Each user's jobs are started in the
+       order in which they were submitted. Unlike the default policy, this
+       is not lazy: all incoming jobs are read before the first is started,
+       since the oldest job of any user may be the next one to run."""
+
+    def __init__(self, fields=None):
+        self.fields = fields
+
+    def _get_fields(self, webservice):
+        if self.fields is not None:
+            return tuple(self.fields)
+        elif webservice.config.track_hostname:
+            return ('user', 'contact_email', 'hostname')
+        else:
+            return ('user', 'contact_email')
+
+    def _get_key(self, fields, values):
+        for field, value in zip(fields, values):
+            if value:
+                return (field, value)
+
+    def get_weight(self, key):
+        """Get the weight of the given user, given as a (field, value)
+           tuple, e.g. ('user', 'foo'), or None if the job submitter is
+           not known. Users with larger weights get a larger share of the
+           running job slots. Weights must be positive; by default all
+           users have a weight of 1."""
+        return 1
+
+    def _get_checked_weight(self, key):
+        weight = self.get_weight(key)
+        if not weight > 0:
+            raise ValueError("Weight of user %s must be positive, not %s"
+                             % (key, weight))
+        return weight
+
+    def order_jobs(self, webservice, jobs):
+        fields = self._get_fields(webservice)
+        nrunning = {}
+        for values, count in webservice.db._count_jobs_in_state_by(
+                'RUNNING', fields).items():
+            key = self._get_key(fields, values)
+            nrunning[key] = nrunning.get(key, 0) + count
+        # Get jobs for each user, in submit order (this reads all jobs)
+        user_jobs = {}
+        for job in jobs:
+            key = self._get_key(fields, [job._metadata[f] for f in fields])
+            user_jobs.setdefault(key, []).append(job)
+        # Pick the user with the lowest weighted running count each time,
+        # breaking ties in favor of the user whose oldest incoming job (when
+        # this method was called) was submitted first
+        heap = []
+        weights = {}
+        for order, (key, ujobs) in enumerate(user_jobs.items()):
+            ujobs.reverse()
+            weights[key] = self._get_checked_weight(key)
+            heap.append((nrunning.get(key, 0) / weights[key], order, key))
+        heapq.heapify(heap)
+        while heap:
+            share, order, key = heapq.heappop(heap)
+            ujobs = user_jobs[key]
+            yield ujobs.pop()
+            if ujobs:
+                heapq.heappush(heap, (share + 1. / weights[key], order, key))
+
 
 class WebService(object):
     """Top-level class used by all web services. Pass in a :class:`Config`
@@ -666,16 +1536,65 @@ class WebService(object):
 
     _system_socket_file = '/var/run/webservices.socket'
 
+    #: Maximum number of periodic checks between polls of a running job
+    #: that is not being waited on by its Runner
+    _max_completion_poll_backoff = 4
+
+    #: Maximum number of jobs expired before the history table was enabled
+    #: to move to the history table in each pass over old jobs
+    _max_history_moves = 1000
+
+    #: Maximum number of jobs to archive, and to expire, in each pass over
+    #: old jobs; any more are left to the next pass, so that other events
+    #: can be handled in between
+    _max_old_jobs = 1000
+
+    #: Number of archived or expired jobs to commit to the database in each
+    #: transaction
+    _old_jobs_group_commit = 100
+
     #: Version number of the service, or None.
     version = None
 
+    #: Policy used to decide which incoming jobs to start first;
+    #: see :class:`SchedulingPolicy`.
+    scheduling_policy = SchedulingPolicy()
+
     def __init__(self, config, db):
         self.config = config
         self.config._read_db_auth('back')
         self.__state_file_handle = None
+        self._completion_polls = {}
+        # Jobs waiting for their job-state file to be updated, by runner ID
+        self._deferred_completions = {}
+        #: Number of times a job completion check was deferred because
+        #: the job-state file was not yet updated
+        self.state_file_deferrals = 0
+        self._event_queue = saliweb.backend.events._EventQueue()
+        # Job tasks waiting for a hook to finish in another process
+        self._job_tasks = {}
+        self._hook_pool = None
+        self._move_queue = None
+        # True if there may be incoming jobs that we did not start last time
+        # (e.g. because of job limits); if so, new jobs cannot be started
+        # ahead of them
+        self._incoming_backlog = True
+        # True if there may be expired jobs in the jobs table that should
+        # be moved to the history table
+        self._expired_backlog = config.oldjobs['history']
+        # Time at which the next check for old jobs is scheduled, if any
+        self._old_jobs_due = None
+        # True if the last pass over old jobs left some that are already due
+        self._more_old_jobs = False
         self.db = db
         if self.config.track_hostname:
             self.db.set_track_hostname()
+        if self.config.oldjobs['history']:
+            self.db.set_expired_history()
+        if self.config.backend['move_workers'] > 0:
+            self.db.set_background_moves()
+        if self.config.backend['group_commit'] > 1:
+            self.db.set_group_commit(self.config.backend['group_commit'])
         self.db._connect(config)
 
     def get_running_pid(self):
@@ -829,18 +1748,24 @@ have done this, delete the state file (%s) to reenable runs.
                 # reacquire lock
                 self._write_state_file()
             self._register(up=True)
+            clean_shutdown = False
             try:
                 try:
                     self._do_periodic_actions(s)
                 except _SigTermError:
-                    pass  # Expected, so just swallow it
+                    # Expected, so just swallow it
+                    clean_shutdown = True
             finally:
                 # Don't let any further SigTerm exceptions through
                 signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                if clean_shutdown:
+                    self._write_clean_shutdown_marker()
                 if self.__state_file_handle:
                     del self.__state_file_handle  # close and unlock the file
                     os.unlink(self.config.backend['state_file'])
                 self._close_socket(s)
+                if self._hook_pool is not None:
+                    self._hook_pool.shutdown(wait=False)
                 self._register(up=False)
         except Exception as detail:
             self._handle_fatal_error(detail)
@@ -867,63 +1792,151 @@ have done this, delete the state file (%s) to reenable runs.
 
     def _sanity_check(self):
         """Do basic sanity checking of the web service"""
-        self._filesystem_sanity_check()
+        self._recover_moves()
+        self._filesystem_sanity_check(self._read_clean_shutdown_marker())
         self._job_sanity_check()
 
+    def _recover_moves(self):
+        """Finish (or undo) any background moves of job directories that
+           were interrupted when the backend last stopped."""
+        for name, state in self.db._get_moving_jobs().items():
+            job = self.get_job_by_name(state, name)
+            if job:
+                job._recover_move()
+
+    def _get_clean_shutdown_marker(self):
+        """Get the name of the file written when the backend shuts down
+           cleanly."""
+        return self.config.backend['state_file'] + '.clean'
+
+    def _write_clean_shutdown_marker(self):
+        """Record that the backend shut down cleanly, together with the
+           number of jobs in each state, so that the next startup can skip
+           checking job directories that have not changed since."""
+        try:
+            with open(self._get_clean_shutdown_marker(), 'w') as fh:
+                for state, count in self.db._count_jobs_by_state().items():
+                    print(state, count, file=fh)
+        except Exception as detail:
+            # Not fatal; the next startup will simply check everything
+            self._log("Could not write clean shutdown marker: %s" % detail)
+
+    def _read_clean_shutdown_marker(self):
+        """Read and remove the marker written by the last clean shutdown.
+           Return a (time, counts) tuple, where `time` is the time the
+           marker was written and `counts` the number of jobs in each
+           state, or None if there is no marker (e.g. if the backend did
+           not shut down cleanly)."""
+        fname = self._get_clean_shutdown_marker()
+        try:
+            with open(fname) as fh:
+                mtime = os.fstat(fh.fileno()).st_mtime
+                counts = {}
+                for line in fh:
+                    state, count = line.split()
+                    counts[state] = int(count)
+        except (OSError, ValueError):
+            return None
+        finally:
+            # Only good for a single startup
+            try:
+                os.unlink(fname)
+            except OSError:
+                pass
+        return mtime, counts
+
     def _job_sanity_check(self):
         """Check for jobs in incorrect states"""
         for state in ('PREPROCESSING', 'POSTPROCESSING', 'FINALIZING'):
-            for job in self.db._get_all_jobs_in_state(state):
-                job._sanity_check()
-
-    def _filesystem_sanity_check(self):
-        """Check that filesystem is consistent with the database"""
-        # Get list of all unique directory names for job states
+            # Jobs should rarely be found in these states, so only make
+            # full Job objects if they are
+            for row in list(self.db._get_job_rows(state)):
+                job = self.get_job_by_name(state, row.name)
+                if job:
+                    job._sanity_check()
+
+    # Number of threads used to check for job directories on disk
+    _sanity_check_workers = 16
+
+    def _filesystem_sanity_check(self, clean_shutdown=None):
+        """Check that filesystem is consistent with the database.
+           If `clean_shutdown` is given (see
+           :meth:`_read_clean_shutdown_marker`), only job directories that
+           have changed since the last clean shutdown are checked."""
+        # Get list of all unique directory names for job states, and the
+        # states that use each directory
         states = _JobState.get_valid_states()
         states.remove('EXPIRED')
-        directories = dict.fromkeys(self.config.directories[x] for x in states)
-        # Build a list of all job directories; error out if 'garbage' files
-        # are found in any top-level directory
-        jobdirs = {}
-        garbage = []
-        baddirs = []
-        for dir in directories:
-            if not os.path.isdir(dir):
-                baddirs.append(dir)
-            for f in glob.glob(os.path.join(dir, '*')):
-                if not os.path.isdir(f):
-                    garbage.append(f)
-                else:
-                    jobdirs[f] = None
+        directories = {}
+        for state in states:
+            directories.setdefault(self.config.directories[state],
+                                   []).append(state)
+        baddirs = [d for d in directories if not os.path.isdir(d)]
         if len(baddirs) > 0:
             raise SanityError("The following job directories were not found. "
                               "The service will not function correctly "
                               "without them: %s" % ", ".join(baddirs))
+        if clean_shutdown is not None:
+            changed = self._get_changed_directories(directories,
+                                                    *clean_shutdown)
+        else:
+            changed = directories
+        # Get the directories of all jobs in the database for each state
+        dbdirs = {}
+        for state in [st for dir in changed for st in changed[dir]]:
+            for job in self.db._get_job_rows(
+                    state, fields=['directory', 'expire_time'], stream=True):
+                if job.directory is None:
+                    raise SanityError("Job %s (in state %s) has no directory; "
+                                      "please delete it" % (job.name, state))
+                dbdirs[os.path.normpath(job.directory)] = job
+        # Build a list of all job directories that aren't in the database;
+        # error out if 'garbage' files are found in any top-level (or shard)
+        # directory
+        jobdirs = {}
+        garbage = []
+        for dir in changed:
+            for entry in self._scan_job_directories(dir, dbdirs):
+                if entry.is_dir():
+                    path = os.path.normpath(entry.path)
+                    # Remove from list of database directories. Directories
+                    # not in this list still need to be checked, since if
+                    # the directories in the configuration file were
+                    # changed, old jobs may still live in the old locations
+                    if dbdirs.pop(path, None) is None:
+                        jobdirs[path] = None
+                else:
+                    garbage.append(entry.path)
         if len(garbage) > 0:
             raise SanityError("The following files were found in job "
                               "directories. They need to be removed, since "
                               "their presence may interfere with the correct "
                               "operation of the service: %s"
-                              % ", ".join(garbage))
-
-        # Get all jobs from the database for each state
-        for state in states:
-            for job in self.db._get_all_jobs_in_state(state):
-                dir = job.directory
-                if dir is None:
-                    raise SanityError("Job %s (in state %s) has no directory; "
-                                      "please delete it" % (job.name, state))
-                # Check to make sure directory exists
-                if not os.path.exists(dir):
-                    raise SanityError("Directory %s for job %s does not "
-                                      "exist" % (dir, job.name))
-                # Remove from list of filesystem directories
-                # Note that we don't ensure that the directory is *in* this
-                # list, since if the directories in the configuration file
-                # were changed, old jobs may still live in the old locations
-                jobdirs.pop(os.path.normpath(dir), None)
+                              % ", ".join(sorted(garbage)))
+        unseen = list(dbdirs.values())
+        # Check to make sure all other directories exist
+        with concurrent.futures.ThreadPoolExecutor(
+                self._sanity_check_workers) as executor:
+            exists = list(executor.map(os.path.exists,
+                                       [job.directory for job in unseen]))
+        now = _utcnow()
+        for job, exist in zip(unseen, exists):
+            if (not exist and job.state == 'ARCHIVED'
+                    and job.expire_time is not None
+                    and job.expire_time <= now):
+                # The backend probably stopped while expiring the job, after
+                # removing its directory; expiry will be completed when old
+                # jobs are next processed (see Job._try_expire)
+                continue
+            if not exist:
+                raise SanityError("Directory %s for job %s does not "
+                                  "exist" % (job.directory, job.name))
         # Check to see if any directories are left that weren't in the db
         if len(jobdirs) > 0:
+            if changed is not directories:
+                # The directories might belong to jobs whose state we didn't
+                # check, so check everything
+                return self._filesystem_sanity_check()
             raise SanityError("The following directories were found on disk "
                               "that don't have a matching entry in the job "
                               "database. Please remove these directories, "
@@ -931,6 +1944,48 @@ have done this, delete the state file (%s) to reenable runs.
                               "correct operation of the service: %s"
                               % ", ".join(jobdirs.keys()))
 
+    def _scan_job_directories(self, topdir, known):
+        """Yield an :class:`os.DirEntry` for each job directory (and any
+           other file) in the top-level directory `topdir`. Job directories
+           can either be in `topdir` itself (the flat layout) or two levels
+           of shard directories below it (e.g. `topdir/ab/cd/jobname`; the
+           sharded layout), and both can be used at the same time. A
+           directory whose name looks like a shard is only treated as one
+           if it is not in `known`, a collection of normalized job
+           directory paths."""
+        def scan(dir, depth):
+            with os.scandir(dir) as it:
+                for entry in it:
+                    if entry.name.startswith('.'):
+                        continue
+                    if (depth < 2 and _shard_re.match(entry.name)
+                            and entry.is_dir()
+                            and (depth > 0 or os.path.normpath(entry.path)
+                                 not in known)):
+                        yield from scan(entry.path, depth + 1)
+                    else:
+                        yield entry
+        return scan(topdir, 0)
+
+    def _get_changed_directories(self, directories, marker_time, counts):
+        """Given a dict of job directories and the job states that use
+           each one, return a dict containing only those directories that
+           (or whose jobs) might have changed since the clean shutdown
+           marker was written at `marker_time`, when `counts` jobs were in
+           each state."""
+        current = self.db._count_jobs_by_state()
+        changed = {}
+        for dir, states in directories.items():
+            # Adding or removing a job directory changes the mtime of
+            # its parent (in the sharded layout, only the first job
+            # directory in a new shard changes the mtime of the top-level
+            # directory, but the job counts catch jobs that were moved)
+            if (os.stat(dir).st_mtime >= marker_time
+                    or any(current.get(st, 0) != counts.get(st, 0)
+                           for st in states)):
+                changed[dir] = states
+        return changed
+
     def _make_socket(self):
         """Create the socket used by the frontend to talk to us."""
         sockfile = self.config.socket
@@ -956,9 +2011,55 @@ have done this, delete the state file (%s) to reenable runs.
         sock.close()
         os.unlink(sockfile)
 
+    def _get_old_jobs(self, state, after_time):
+        """Get a list of up to _max_old_jobs jobs in the given state whose
+           `after_time` has passed, oldest first."""
+        limit = self._max_old_jobs
+        jobs = list(self.db._get_all_jobs_in_state(
+            state, after_time=after_time, order_by=after_time, limit=limit))
+        if len(jobs) >= limit:
+            self._more_old_jobs = True
+        return jobs
+
+    def _run_old_job_tasks(self, tasks):
+        """Run old job tasks (see :meth:`Job._try_archive`). Each task is
+           a generator that yields callables that only touch the filesystem
+           (such as removing a job directory). All of the tasks are run
+           (in this thread) up to their first such callable, then the
+           callables are run together (in parallel, if oldjob_workers is
+           set), and then each task is resumed with the result, and so on
+           until all of the tasks are done."""
+        def run(action):
+            try:
+                return action(), None
+            except Exception as detail:
+                return None, detail
+        pending = [(task, None, None) for task in tasks]
+        while pending:
+            actions = []
+            for task, result, exception in pending:
+                try:
+                    if exception is None:
+                        action = task.send(result)
+                    else:
+                        action = task.throw(exception)
+                except StopIteration:
+                    continue
+                actions.append((task, action))
+            workers = self.config.backend['oldjob_workers']
+            if workers > 0 and len(actions) > 1:
+                with concurrent.futures.ThreadPoolExecutor(
+                        workers) as executor:
+                    results = list(executor.map(run,
+                                                [a for t, a in actions]))
+            else:
+                results = [run(a) for t, a in actions]
+            pending = [(task, result, exception) for (task, a),
+                       (result, exception) in zip(actions, results)]
+
     def _get_oldjob_interval(self):
-        """Get the time in seconds between checks for expired or archived
-           jobs."""
+        """Get the time in seconds between checks for expired jobs to move
+           to the history table, while there is a backlog of them."""
         oldjob_interval = min(self.config.oldjobs['archive'],
                               self.config.oldjobs['expire']) / 10
         return oldjob_interval.seconds + oldjob_interval.days * 24 * 60 * 60
@@ -974,19 +2075,71 @@ have done this, delete the state file (%s) to reenable runs.
            overridden to record debugging information somewhere."""
         pass
 
+    def _schedule_periodic_check(self):
+        """Schedule the next periodic check for incoming or completed jobs,
+           check_minutes from now."""
+        self._event_queue.put(
+            saliweb.backend.events._PeriodicCheckEvent(self),
+            delay=self.config.backend['check_minutes'] * 60)
+
+    def _schedule_cleanup_incoming_jobs(self):
+        """Schedule the next cleanup of abandoned incoming jobs."""
+        self._event_queue.put(
+            saliweb.backend.events._CleanupIncomingJobsEvent(self),
+            delay=self._get_cleanup_incoming_job_times()[0])
+
+    # Time in seconds to wait before checking again for old jobs that
+    # are already due (e.g. if the database server's clock is behind ours)
+    _old_jobs_retry_delay = 60.
+
+    def _schedule_old_jobs(self, due=None):
+        """Schedule a check for jobs to archive or expire at the time `due`
+           (a UTC datetime), unless a check is already scheduled before
+           then. If `due` is not given, the last scheduled check has just
+           run, so schedule the next one for when the next job (of any
+           in the database) is due to be archived or expired."""
+        if due is None:
+            self._old_jobs_due = None
+            if self._more_old_jobs:
+                # Carry on with the jobs that are already due as soon as
+                # any other waiting events have been handled
+                self._old_jobs_due = due = _utcnow()
+                self._event_queue.put(
+                    saliweb.backend.events._OldJobsEvent(self, due))
+                return
+            due = self.db._get_next_old_job_time()
+            if self._expired_backlog:
+                backlog_due = _utcnow() + datetime.timedelta(
+                    seconds=self._get_oldjob_interval())
+                due = backlog_due if due is None else min(due, backlog_due)
+            if due is None:
+                return
+        now = _utcnow()
+        delay = (due - now).total_seconds()
+        if delay <= 0.:
+            delay = self._old_jobs_retry_delay
+            due = now + datetime.timedelta(seconds=delay)
+        if self._old_jobs_due is not None and self._old_jobs_due <= due:
+            return
+        self._old_jobs_due = due
+        self._event_queue.put(saliweb.backend.events._OldJobsEvent(self, due),
+                              delay=delay)
+
     def _do_periodic_actions(self, sock):
         """Do periodic actions necessary to process jobs. Incoming jobs are
            processed whenever the frontend asks us to (or, failing that,
            every check_minutes); completed jobs are checked for every
-           check_minutes; and archived and expired jobs are also
-           checked periodically."""
+           check_minutes; and archived and expired jobs are handled when
+           they are due. All of these except incoming jobs are scheduled
+           as delayed events in the event queue, so no thread has to
+           wait for them."""
         self._log("Started do_periodic_actions")
         eq = saliweb.backend.events._EventQueue()
         self._event_queue = eq
-        saliweb.backend.events._PeriodicCheck(self).start()
         saliweb.backend.events._IncomingJobs(self, sock).start()
-        saliweb.backend.events._OldJobs(self).start()
-        saliweb.backend.events._CleanupIncomingJobs(self).start()
+        self._schedule_periodic_check()
+        self._schedule_cleanup_incoming_jobs()
+        self._schedule_old_jobs()
 
         while True:
             # During the get, SIGTERM should cleanly terminate the daemon
@@ -996,79 +2149,309 @@ have done this, delete the state file (%s) to reenable runs.
             # Need to set a timeout so that SIGTERM can interrupt us here
             event = eq.get(timeout=3600)
             signal.signal(signal.SIGTERM, signal.SIG_IGN)
-            self._log("Got event %s" % str(event))
+            self._log("Got event %s (waited %.3fs; %d more queued)"
+                      % (str(event), eq.stats['last_wait'],
+                         eq.stats['depth']))
             if event is not None:
-                event.process()
-
-    def _process_incoming_jobs(self):
-        """Check for any incoming jobs, and run each one."""
-        numrunning = self.db._count_all_jobs_in_state('RUNNING')
+                with self.db._unit_of_work():
+                    event.process()
+                    self._queue_ready_jobs()
+
+    def _run_job_task(self, task, kind):
+        """Run a job task, a generator from :class:`Job` that yields each
+           hook method it needs to run (see :meth:`Job._call_hook`).
+           `kind` is 'run' or 'complete'. If the backend is configured with
+           hook_workers, each hook is run in a child process, while this
+           method returns immediately, and the task is resumed (in the
+           main thread) by a _JobHookEvent once the hook finishes. Otherwise,
+           hooks are run in this process and the task runs to completion."""
+        self._job_tasks[task] = kind
+        self._continue_job_task(task, None, None)
+
+    def _continue_job_task(self, task, result, exception):
+        """Resume a job task, passing in the result of its last hook (or
+           the exception it raised)."""
+        while True:
+            try:
+                if exception is None:
+                    hook = task.send(result)
+                else:
+                    hook = task.throw(exception)
+            except StopIteration:
+                del self._job_tasks[task]
+                return
+            except BaseException:
+                del self._job_tasks[task]
+                raise
+            if isinstance(hook, _JobMove):
+                self._submit_move(task, hook)
+                return
+            if self.config.backend['hook_workers'] > 0:
+                self._submit_hook(task, hook)
+                return
+            try:
+                result, exception = hook.run(), None
+            except Exception as detail:
+                result, exception = None, detail
+
+    def _get_hook_pool(self):
+        """Get the pool of worker processes used to run hooks. The workers
+           are started by a fork server, not forked from this process, so
+           that they inherit neither the database connection nor any locks
+           held by other threads. Each worker imports the main program
+           (the script that runs the service) as a module, so that script
+           must only run the service under an ``if __name__ == '__main__'``
+           guard, as the scripts generated by the build system do."""
+        if self._hook_pool is None:
+            ctx = multiprocessing.get_context('forkserver')
+            ctx.set_forkserver_preload(['saliweb.backend'])
+            self._hook_pool = concurrent.futures.ProcessPoolExecutor(
+                self.config.backend['hook_workers'], mp_context=ctx)
+        return self._hook_pool
+
+    def _submit_hook(self, task, hook):
+        """Run a hook in a worker process (see :meth:`_get_hook_pool`).
+           The job task is resumed by a _JobHookEvent once it finishes."""
+        try:
+            future = self._get_hook_pool().submit(_run_hook_in_child, hook)
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker process died; start again with a new pool
+            self._hook_pool = None
+            future = self._get_hook_pool().submit(_run_hook_in_child, hook)
+        future.add_done_callback(functools.partial(self._hook_done,
+                                                   task, hook))
+
+    def _hook_done(self, task, hook, future):
+        """Called (in another thread) when a hook finishes in a worker
+           process."""
+        try:
+            outcome = future.result()
+        except concurrent.futures.process.BrokenProcessPool:
+            outcome = (False, RuntimeError("Hook process for %s exited "
+                                           "unexpectedly"
+                                           % hook.meth.__name__), None)
+        except Exception as detail:
+            outcome = (False, detail, None)
+        self._event_queue.put(saliweb.backend.events._JobHookEvent(
+            self, task, hook, outcome))
+
+    def _finish_hook(self, task, hook, outcome):
+        """Handle a hook that finished in a child process, and resume the
+           job task that ran it."""
+        ok, value, state = outcome
+        if state is not None:
+            hook.job._set_hook_state(state)
+        if ok:
+            self._continue_job_task(task, value, None)
+        else:
+            self._continue_job_task(task, None, value)
+
+    # Number of threads used to copy the files in each job directory
+    # that is moved to another filesystem
+    _move_copy_workers = 8
+
+    def _submit_move(self, task, move):
+        """Move (or remove) a job directory in the background, using a pool
+           of worker threads (see :meth:`Job._change_state`). `task` is
+           resumed once the move finishes."""
+        if self._move_queue is None:
+            self._move_queue = queue.Queue()
+            for i in range(self.config.backend['move_workers']):
+                saliweb.backend.events._MoveWorker(self,
+                                                   self._move_queue).start()
+        self._move_queue.put((task, move))
+
+    def _finish_move(self, task, move, outcome):
+        """Handle a job directory move that finished in the background, and
+           resume the job task that requested it."""
+        ok, value = outcome
+        if ok:
+            self._continue_job_task(task, value, None)
+        else:
+            self._continue_job_task(task, None, value)
+
+    def _process_incoming_jobs(self, names=None):
+        """Check for any incoming jobs, and run each one. If `names` is
+           given, only the incoming jobs with those names are checked,
+           unless there are older incoming jobs still waiting to start."""
+        if names is not None:
+            # Newly submitted jobs may depend on other jobs, so make sure
+            # these are known before any of the jobs are considered (even
+            # if all incoming jobs are then checked)
+            self.db._refresh_job_dependencies(names)
+            if self._incoming_backlog:
+                names = None
+        # Jobs still being preprocessed will also run soon
+        numstarting = sum(1 for k in self._job_tasks.values() if k == 'run')
+        numrunning = self.db._count_all_jobs_in_state('RUNNING') + numstarting
         maxrunning = self.config.limits['running']
         self._log("_process_incoming_jobs; %d jobs running out of %d"
                   % (numrunning, maxrunning))
         # Save doing an extra SQL SELECT if we're already at the maximum
         if numrunning >= maxrunning:
+            self._incoming_backlog = True
             return
-        depends = self.db._get_job_dependencies()
-        for job in self.db._get_all_jobs_in_state('INCOMING',
-                                                  order_by='submit_time'):
-            if job.name not in depends:
-                self._log("_process_incoming_jobs; trying to run job %s"
-                          % job.name)
-                job._try_run(self)
-                numrunning += 1
-                if numrunning >= maxrunning:
-                    self._log("_process_incoming_jobs; job limit reached")
+        maxtasks = self.config.limits.get('running_tasks')
+        if maxtasks is not None:
+            # We don't know how many tasks a job has until it is started,
+            # so count each job that is still starting as a single task
+            numtasks = self._count_running_tasks() + numstarting
+            self._log("_process_incoming_jobs; %d tasks running out of %d"
+                      % (numtasks, maxtasks))
+            if numtasks >= maxtasks:
+                self._incoming_backlog = True
+                return
+        depends = self.db._get_dependency_graph()
+        if names is None:
+            self._incoming_backlog = False
+            jobs = self.db._get_all_jobs_in_state('INCOMING',
+                                                  order_by='submit_time')
+        else:
+            jobs = sorted(self.db._get_jobs_by_name('INCOMING', names),
+                          key=lambda job: job._metadata['submit_time'])
+        jobs = self._filter_depends(jobs, depends)
+        for job in self.scheduling_policy.order_jobs(self, jobs):
+            self._log("_process_incoming_jobs; trying to run job %s"
+                      % job.name)
+            job._try_run(self)
+            numrunning += 1
+            if numrunning >= maxrunning:
+                self._log("_process_incoming_jobs; job limit reached")
+                self._incoming_backlog = True
+                return
+            if maxtasks is not None:
+                numtasks += job._get_task_count()
+                if numtasks >= maxtasks:
+                    self._log("_process_incoming_jobs; task limit reached")
+                    self._incoming_backlog = True
                     return
         self._log("_process_incoming_jobs done")
 
+    def _filter_depends(self, jobs, depends):
+        """Skip any incoming jobs that are waiting on other jobs. (These
+           will be checked again once they become ready; see
+           :meth:`_queue_ready_jobs`.)"""
+        return (job for job in jobs if job.name not in depends)
+
+    def _queue_ready_jobs(self):
+        """Check for any jobs that were waiting on other jobs, but have just
+           become ready, and try to start them."""
+        ready = self.db._pop_ready_jobs()
+        if ready:
+            self._event_queue.put(
+                saliweb.backend.events._IncomingJobsEvent(self, ready))
+
+    def _check_dependencies(self):
+        """Make sure that the job dependencies used by the backend are
+           consistent with the database."""
+        if not self.db._check_dependency_graph():
+            self._log("_check_dependencies; job dependency graph was "
+                      "out of date")
+
+    def _count_running_tasks(self):
+        """Return the total number of tasks in all running jobs."""
+        # Only the runner IDs are needed, so don't make full Job objects
+        return sum(Job._runner_id_task_count(row.runner_id)
+                   for row in self.db._get_job_rows('RUNNING',
+                                                    fields=['runner_id']))
+
+    # Number of threads used to check and remove abandoned incoming jobs
+    _cleanup_workers = 8
+
     def _cleanup_incoming_jobs(self):
         """Clean up any incoming job directories that have been abandoned."""
         incoming_dir = self.config.directories['INCOMING']
-        incoming_dirs = dict.fromkeys(os.listdir(incoming_dir))
-        if len(incoming_dirs) == 0:
+        if len(os.listdir(incoming_dir)) == 0:
             return
-        # Remove jobs that have been successfully submitted
-        for job in self.db._get_all_jobs_in_state('INCOMING'):
-            try:
-                incoming_dirs.pop(job.name)
-            except KeyError:
-                pass
+        # Skip jobs that have been successfully submitted, and those that
+        # have moved on but whose directories are still being moved out
+        submitted = self.db._get_job_names('INCOMING')
+        submitted.update(self.db._get_moving_jobs())
+        # Flat-layout directories of submitted jobs are not shards
+        known = frozenset(os.path.normpath(os.path.join(incoming_dir, name))
+                          for name in submitted if _shard_re.match(name))
         # Remove any directories that haven't been modified
         max_age = self._get_cleanup_incoming_job_times()[1]
-        for d in incoming_dirs.keys():
-            self._cleanup_dir(os.path.join(incoming_dir, d), max_age)
+        dirs = [entry.path
+                for entry in self._scan_job_directories(incoming_dir, known)
+                if entry.name not in submitted]
+        if len(dirs) <= 1:
+            for d in dirs:
+                self._cleanup_dir(d, max_age)
+            return
+        with concurrent.futures.ThreadPoolExecutor(
+                self._cleanup_workers) as executor:
+            list(executor.map(self._cleanup_dir, dirs,
+                              [max_age] * len(dirs)))
 
     def _cleanup_dir(self, dir, age):
-        """Remove directory if it hasn't been accessed in age seconds."""
+        """Remove directory if neither it nor anything in it (including
+           in subdirectories) has been modified in age seconds."""
         try:
-            s = os.stat(dir)
+            if _modified_since(dir, time.time() - age):
+                return
         except OSError:
             return
-        newest = s.st_mtime
-        for f in os.listdir(dir):
-            try:
-                s = os.stat(os.path.join(dir, f))
-            except OSError:
-                continue
-            newest = max(newest, s.st_mtime)
-        dir_age = time.time() - newest
-        if dir_age > age:
-            shutil.rmtree(dir, ignore_errors=True)
+        shutil.rmtree(dir, ignore_errors=True)
 
     def _process_completed_jobs(self):
-        """Check for any jobs that have just completed, and process them."""
-        for job in self.db._get_all_jobs_in_state('RUNNING'):
-            job._try_complete(self)
+        """Check for any jobs that have just completed, and process them.
+           Jobs that are being waited on by their Runner are skipped, since
+           a _CompletedJobEvent will be sent when they finish. Other jobs
+           (e.g. those started by a previous run of the backend) are polled,
+           less often the longer they keep running."""
+        polls = {}
+        backoffs = {}
+        # Only read what is needed to decide which jobs to poll, and only
+        # make full Job objects for those
+        for row in self.db._get_job_rows('RUNNING', fields=['runner_id']):
+            runner_id = row.runner_id
+            if (Job._runner_id_is_waited(runner_id)
+                    or runner_id in self._deferred_completions):
+                continue
+            skip, backoff = self._completion_polls.get(runner_id, (0, 1))
+            if skip > 0:
+                polls[runner_id] = (skip - 1, backoff)
+            else:
+                backoffs[row.name] = backoff
+        due = [(job, backoffs[job.name])
+               for job in self.db._get_jobs_by_name('RUNNING', backoffs)]
+        # Get the status of all due jobs from each Runner in one go
+        runners = {}
+        for job, backoff in due:
+            try:
+                runnercls, jobid = job._get_runner()
+            except (AttributeError, ValueError, KeyError):
+                continue
+            runners.setdefault(runnercls, []).append(jobid)
+        for runnercls, jobids in runners.items():
+            runnercls._prefetch_status(jobids)
+        try:
+            for job, backoff in due:
+                job._try_complete(self)
+                if job._get_state() == 'RUNNING':
+                    backoff = min(backoff * 2,
+                                  self._max_completion_poll_backoff)
+                    polls[job._metadata['runner_id']] = (backoff - 1, backoff)
+        finally:
+            for runnercls in runners:
+                runnercls._clear_status_cache()
+        self._completion_polls = polls
 
     def _process_old_jobs(self):
-        """Check for any old job results and archive or delete them."""
-        for job in self.db._get_all_jobs_in_state('COMPLETED',
-                                                  after_time='archive_time'):
-            job._try_archive()
-        for job in self.db._get_all_jobs_in_state('ARCHIVED',
-                                                  after_time='expire_time'):
-            job._try_expire()
+        """Check for any old job results and archive or delete them.
+           At most _max_old_jobs jobs are archived (and expired) in each
+           call, oldest first."""
+        self._more_old_jobs = False
+        with self.db._unit_of_work(max_changes=self._old_jobs_group_commit):
+            jobs = self._get_old_jobs('COMPLETED', 'archive_time')
+            self._run_old_job_tasks([job._try_archive() for job in jobs])
+            jobs = self._get_old_jobs('ARCHIVED', 'expire_time')
+            self._run_old_job_tasks([job._try_expire() for job in jobs])
+        if self._expired_backlog:
+            limit = self._max_history_moves
+            if self.db._move_expired_jobs_to_history(limit) < limit:
+                self._expired_backlog = False
 
 
 class Job(object):
@@ -1090,6 +2473,19 @@ class Job(object):
         self._db = db
         self._metadata = metadata
         self.__state = state
+        # State that can be set by hook methods
+        self.__skip_run = False
+        self.__reschedule_run = False
+        self.__reschedule_data = None
+
+    def __getstate__(self):
+        # Jobs are pickled to run hooks in worker processes (see
+        # WebService._get_hook_pool). The database connection cannot be
+        # shared with those, so only pass the configuration.
+        state = self.__dict__.copy()
+        state['_db'] = _DetachedDatabase(self._db.config)
+        state.pop('logger', None)
+        return state
 
     @classmethod
     def register_runner_class(cls, runnercls):
@@ -1161,26 +2557,54 @@ class Job(object):
         self._metadata['runner_id'] = runner_id
         self._sync_metadata()
 
+    def _call_hook(self, meth, *args):
+        """Run a hook method in the job directory, like
+           :meth:`_run_in_job_directory`, and return its result. This is a
+           generator to be used (via 'yield from') by a job task, so that
+           the :class:`WebService` can run hooks from several jobs in
+           parallel."""
+        return (yield _JobHook(self, meth, args))
+
+    def _get_hook_state(self):
+        """Get the job state that can be modified by a hook method."""
+        return (dict(zip(self._metadata.keys(), self._metadata.values())),
+                self.__skip_run, self.__reschedule_run,
+                self.__reschedule_data)
+
+    def _set_hook_state(self, state):
+        """Update the job with state modified by a hook method (as returned
+           by :meth:`_get_hook_state`) in another process."""
+        metadata, skip_run, reschedule_run, reschedule_data = state
+        for key, value in metadata.items():
+            self._metadata[key] = value
+        self.__skip_run = skip_run
+        self.__reschedule_run = reschedule_run
+        self.__reschedule_data = reschedule_data
+
     def _try_run(self, webservice):
         """Take an incoming job and try to start running it."""
+        webservice._run_job_task(self._run_task(webservice), 'run')
+
+    def _run_task(self, webservice):
+        """Job task (see :meth:`_call_hook`) to start running the job."""
         try:
             self._frontend_sanity_check()
             self._metadata['preprocess_time'] = _utcnow()
-            self.__set_state('PREPROCESSING')
+            yield from self._change_state('PREPROCESSING')
             # Delete job-state file, if present from a previous run
             try:
                 os.unlink(self._get_job_state_file())
             except OSError:
                 pass
             self.__skip_run = False
-            self._run_in_job_directory(self.preprocess)
+            yield from self._call_hook(self.preprocess)
             if self.__skip_run:
                 self._sync_metadata()
-                self._mark_job_completed()
+                yield from self._mark_job_completed(webservice)
             else:
                 self._metadata['run_time'] = _utcnow()
-                self.__set_state('RUNNING')
-                runner = self._run_in_job_directory(self.run)
+                yield from self._change_state('RUNNING')
+                runner = yield from self._call_hook(self.run)
                 self._start_runner(runner, webservice)
         except Exception as detail:
             self._fail(detail)
@@ -1207,35 +2631,72 @@ class Job(object):
         except IOError:
             return False   # if the file does not exist, job is still running
 
+    def _get_runner(self):
+        """Return the :class:`Runner` class used to run this job, and the
+           job ID assigned by that Runner."""
+        runner_id = self._metadata['runner_id']
+        runner_name, jobid = runner_id.split(':', 1)
+        return self._runners[runner_name], jobid
+
+    def _get_task_count(self):
+        """Return the number of tasks (e.g. in an SGE array job) that this
+           job's :class:`Runner` is running. This is 1 if the job has not
+           been started yet."""
+        return self._runner_id_task_count(self._metadata['runner_id'])
+
+    @classmethod
+    def _runner_id_task_count(cls, runner_id):
+        """Return the number of tasks that the :class:`Runner` is running
+           for the job with the given runner ID (see :meth:`_get_task_count`).
+        """
+        try:
+            runner_name, jobid = runner_id.split(':', 1)
+            runnercls = cls._runners[runner_name]
+        except (AttributeError, ValueError, KeyError):
+            return 1
+        return runnercls._get_task_count(jobid)
+
+    @classmethod
+    def _runner_id_is_waited(cls, runner_id):
+        """Return True only if a thread is waiting for the job with the
+           given runner ID to finish (and so will notify the backend
+           when it does)."""
+        try:
+            runner_name, jobid = runner_id.split(':', 1)
+            runnercls = cls._runners[runner_name]
+        except (AttributeError, ValueError, KeyError):
+            return False
+        waited_jobs = getattr(runnercls, '_waited_jobs', None)
+        return waited_jobs is not None and jobid in waited_jobs
+
     def _get_runner_results(self):
         """Return job results if the job's :class:`Runner` indicates the
            job finished, or None if that cannot be determined."""
-        runner_id = self._metadata['runner_id']
-        runner_name, jobid = runner_id.split(':', 1)
-        runnercls = self._runners[runner_name]
+        runnercls, jobid = self._get_runner()
         return runnercls._check_completed(jobid, self.directory)
 
-    def _get_job_results(self):
+    def _get_job_results(self, recheck=None):
         """Return job results (or True if no explicit results) only if the
            job has just finished running. This is not the case until the
            :class:`Runner` reports the job has finished (if it is able to)
            and the state file has been updated, since the state file is
            created when the first task in a multi-task SGE job finishes,
-           so other SGE tasks may still be running."""
+           so other SGE tasks may still be running.
+           If the Runner reports the job has finished but the state file
+           does not, :exc:`_StateFileNotDoneError` is raised so that the check
+           can be repeated later, unless `recheck` (the event for the
+           previous such check) has reached its deadline."""
         batch_done = self._get_runner_results()
         state_file_done = self._job_state_file_done()
         if state_file_done and batch_done is not False:
             return batch_done or True
         elif batch_done and not state_file_done:
-            # This usually means the batch job failed; check state file again,
-            # since the batch job may have just finished, after the first
-            # check above; we may have to wait a little while for
+            # This usually means the batch job failed; but check state file
+            # again later, since the batch job may have just finished, after
+            # the check above; we may have to wait a little while for
             # NFS caching, etc.
-            for tries in range(8):
-                state_file_done = self._job_state_file_done()
-                if state_file_done:
-                    return batch_done or True
-                time.sleep(self._state_file_wait_time)
+            if recheck is None or time.time() < recheck.deadline:
+                raise _StateFileNotDoneError()
             raise RunnerError(
                  "Runner claims job %s is complete, but "
                  "job-state file in job directory (%s) claims it "
@@ -1245,39 +2706,74 @@ class Job(object):
                  % (self._metadata['runner_id'], self._metadata['directory']))
         return False
 
-    def _try_complete(self, webservice, run_exception=None):
-        """Take a running job, see if it completed, and if so, process it."""
+    def _defer_completion(self, webservice, recheck):
+        """Arrange for the job's completion to be checked again later,
+           without blocking the processing of other events. Checks are
+           repeated with increasing delays, until 8 times the state file
+           wait time has passed since the first check."""
+        runner_id = self._metadata['runner_id']
+        if recheck is None and runner_id in webservice._deferred_completions:
+            return  # a check is already scheduled
+        now = time.time()
+        if recheck is None:
+            deadline = now + self._state_file_wait_time * 8
+            delay = self._state_file_wait_time / 8.
+        else:
+            deadline = recheck.deadline
+            delay = recheck.delay * 2
+        delay = max(0., min(delay, self._state_file_wait_time, deadline - now))
+        e = saliweb.backend.events._StateFileRecheckEvent(
+                webservice, self.name, runner_id, deadline, delay)
+        webservice._deferred_completions[runner_id] = e
+        webservice.state_file_deferrals += 1
+        webservice._event_queue.put(e, delay=delay)
+
+    def _try_complete(self, webservice, run_exception=None, recheck=None):
+        """Take a running job, see if it completed, and if so, process it.
+           `recheck`, if given, is the event for a deferred check."""
+        webservice._run_job_task(
+            self._complete_task(webservice, run_exception, recheck),
+            'complete')
+
+    def _complete_task(self, webservice, run_exception, recheck):
+        """Job task (see :meth:`_call_hook`) to process a completed job."""
         try:
             self._assert_state('RUNNING')
             # If the Runner caught an exception, raise it here
             if run_exception is not None:
                 raise run_exception
-            results = self._get_job_results()
+            try:
+                results = self._get_job_results(recheck)
+            except _StateFileNotDoneError:
+                self._defer_completion(webservice, recheck)
+                return
             if not results:
                 return
             # Delete job-state file; no longer needed
             os.unlink(self._get_job_state_file())
             self._metadata['postprocess_time'] = _utcnow()
-            self.__set_state('POSTPROCESSING')
+            yield from self._change_state('POSTPROCESSING')
             self.__reschedule_run = False
             if results is True:
-                self._run_in_job_directory(self.postprocess)
+                yield from self._call_hook(self.postprocess)
             else:
-                self._run_in_job_directory(self.postprocess, results)
+                yield from self._call_hook(self.postprocess, results)
             if self.__reschedule_run:
-                self.__set_state('RUNNING')
-                runner = self._run_in_job_directory(self.rerun,
+                yield from self._change_state('RUNNING')
+                runner = yield from self._call_hook(self.rerun,
                                                     self.__reschedule_data)
                 self._start_runner(runner, webservice)
             else:
                 self._metadata['finalize_time'] = _utcnow()
-                self.__set_state('FINALIZING')
-                self._run_in_job_directory(self.finalize)
-                self._mark_job_completed()
+                yield from self._change_state('FINALIZING')
+                yield from self._call_hook(self.finalize)
+                yield from self._mark_job_completed(webservice)
         except Exception as detail:
             self._fail(detail)
 
-    def _mark_job_completed(self):
+    def _mark_job_completed(self, webservice):
+        """Job task (see :meth:`_call_hook`) to move the job to the
+           COMPLETED state."""
         endtime = _utcnow()
         self._metadata['end_time'] = endtime
         archive_time = self._db.config.oldjobs['archive']
@@ -1288,24 +2784,48 @@ class Job(object):
             expire_time = endtime + expire_time
         self._metadata['archive_time'] = archive_time
         self._metadata['expire_time'] = expire_time
-        self.__set_state('COMPLETED')
-        self._run_in_job_directory(self.complete)
+        yield from self._change_state('COMPLETED')
+        if archive_time is not None:
+            webservice._schedule_old_jobs(archive_time)
+        yield from self._call_hook(self.complete)
         self._sync_metadata()
-        self._run_in_job_directory(self.send_job_completed_email)
+        yield from self._call_hook(self.send_job_completed_email)
 
     def _try_archive(self):
+        """Old job task (see :meth:`WebService._run_old_job_tasks`) to
+           archive the job. Packing of the job directory is slow on network
+           filesystems, so is yielded to be run alongside that of other
+           jobs."""
         try:
             self.__set_state('ARCHIVED')
             self._run_in_job_directory(self.archive)
+            compress = self._db.config.oldjobs['compress']
+            if compress is not None and self.directory is not None:
+                try:
+                    yield functools.partial(
+                        saliweb.backend.archiver.pack_directory,
+                        self.directory, compress)
+                except Exception as detail:
+                    # The job is fine, just not compressed
+                    msg = "Could not compress archived job directory: %s" \
+                          % detail
+                    self._run_in_job_directory(
+                        lambda: self.logger.error(msg))
             self._sync_metadata()
         except Exception as detail:
             self._fail(detail)
 
     def _try_expire(self):
+        """Old job task (see :meth:`WebService._run_old_job_tasks`) to
+           expire the job. Removal of the job directory is yielded to be
+           run alongside that of other jobs."""
         try:
+            self._assert_state('ARCHIVED')
+            yield functools.partial(_remove_expired_directory,
+                                    self._metadata['directory'])
             self.__set_state('EXPIRED')
             self.expire()
-            self._sync_metadata()
+            self._db._expire_job(self._metadata)
         except Exception as detail:
             self._fail(detail)
 
@@ -1314,32 +2834,118 @@ class Job(object):
         if self._metadata.needs_sync():
             self._db._update_job(self._metadata, self._get_state())
 
-    def __set_state(self, state):
+    def _change_state(self, state):
+        """Job task (see :meth:`_call_hook`) to change the job state to
+           `state`. If the backend is configured with move_workers, the
+           job directory is moved in the background (see
+           :class:`_JobMove`): the job changes state immediately, but stays
+           in its old directory (from which the frontend can still serve it)
+           until the move is complete.
+           While the move is in progress, the directory it is moving to is
+           recorded (and committed) in the 'moving_to' field, so that the
+           move can be recovered if the backend stops (see
+           :meth:`_recover_move`)."""
+        if self._db.config.backend['move_workers'] <= 0:
+            self.__set_state(state)
+            return
+        source = self._metadata['directory']
+        destination = None
+        if source is not None:
+            destination = self.__get_state_directory(state)
+        if destination is None or destination == source:
+            self.__set_state(state, move=False)
+            return
+        self._metadata['moving_to'] = destination
+        self.__set_state(state, move=False)
+        self._db._commit_now()
+        try:
+            copied = yield _JobMove(self, source, destination)
+        except BaseException:
+            self._metadata['moving_to'] = None
+            raise
+        self._metadata['directory'] = destination
+        # If the directory was copied, the old one still needs to be
+        # removed; only do so once the new location has been committed
+        self._metadata['moving_to'] = source if copied else None
+        self._sync_metadata()
+        if copied:
+            self._db._commit_now()
+            try:
+                yield _JobMove(self, source, None)
+            except OSError as detail:
+                # The job has already moved, so just tell the admin
+                self._db.config.send_admin_email(
+                    "Could not remove old job directory",
+                    "Job %s was moved to %s, but its old directory %s could "
+                    "not be removed: %s" % (self.name, destination, source,
+                                            detail))
+            self._metadata['moving_to'] = None
+            self._sync_metadata()
+
+    def _recover_move(self):
+        """Clean up after a background move of the job directory (see
+           :meth:`_change_state`) that was interrupted when the backend
+           stopped. Whichever of the old and new directories is complete
+           is kept, preferring the directory for the job's current state,
+           and the other is removed. Jobs that were about to start running
+           when interrupted are failed."""
+        try:
+            state = self._get_state()
+            old = self._metadata['directory']
+            new = self._metadata['moving_to']
+            partial = saliweb.backend.mover.get_partial_directory(new)
+            if os.path.exists(partial):
+                shutil.rmtree(partial)
+            keep = self.__get_state_directory(state)
+            if keep not in (old, new) or not os.path.exists(keep):
+                keep = [d for d in (old, new) if os.path.exists(d)]
+                keep = keep[0] if keep else None
+            for d in (old, new):
+                if d != keep and os.path.exists(d):
+                    shutil.rmtree(d)
+            self._metadata['directory'] = keep
+            self._metadata['moving_to'] = None
+            self._sync_metadata()
+            if keep is None:
+                raise SanityError("Directory of job %s was lost while it was "
+                                  "being moved from %s to %s"
+                                  % (self.name, old, new))
+            if state == 'RUNNING' and self._metadata['runner_id'] is None:
+                raise SanityError("Job %s was moved to the RUNNING state, "
+                                  "but the backend stopped before it was "
+                                  "started" % self.name)
+        except Exception as detail:
+            self._fail(detail)
+
+    def __get_state_directory(self, state):
+        """Get the directory the job should use in the given state."""
+        if state == 'INCOMING':
+            # The only way to go into INCOMING state is from the FAILED
+            # state (via resubmit). Since it's going to go from there back
+            # to running, and the failed/running directories are often
+            # on cluster storage (while incoming has to be on modbase)
+            # avoid a potentially expensive copy from network to modbase
+            # and then back to network by cheating and putting the job in
+            # the PREPROCESSING directory already.
+            state = 'PREPROCESSING'
+        return self._db.config._get_job_directory(state, self.name)
+
+    def __set_state(self, state, move=True):
         """Change the job state to `state`. It is the caller's responsibility
-           to catch exceptions from this method and call :meth:`_fail`."""
+           to catch exceptions from this method and call :meth:`_fail`.
+           If `move` is False, the job directory is left where it is
+           (see :meth:`_change_state`)."""
         oldstate = self._get_state()
         self.__state.transition(state)
         if state == 'EXPIRED':
-            shutil.rmtree(self._metadata['directory'])
+            # The directory has already been removed by _try_expire
             self._metadata['directory'] = None
-        elif self._metadata['directory'] is not None:
+        elif move and self._metadata['directory'] is not None:
             # move job to different directory if necessary
-            if state == 'INCOMING':
-                # The only way to go into INCOMING state is from the FAILED
-                # state (via resubmit). Since it's going to go from there back
-                # to running, and the failed/running directories are often
-                # on cluster storage (while incoming has to be on modbase)
-                # avoid a potentially expensive copy from network to modbase
-                # and then back to network by cheating and putting the job in
-                # the PREPROCESSING directory already.
-                directory = os.path.join(
-                                 self._db.config.directories['PREPROCESSING'],
-                                 self.name)
-            else:
-                directory = os.path.join(self._db.config.directories[state],
-                                         self.name)
-            directory = os.path.normpath(directory)
+            directory = self.__get_state_directory(state)
             if directory != self._metadata['directory']:
+                if self._db.config.sharded_directories:
+                    os.makedirs(os.path.dirname(directory), exist_ok=True)
                 shutil.move(self._metadata['directory'], directory)
                 self._metadata['directory'] = directory
         self._db._change_job_state(self._metadata, oldstate, state)
@@ -1373,7 +2979,8 @@ class Job(object):
            If an exception in turn occurs in this method, it is considered an
            unrecoverable error (and is usually handled by :class:`WebService`.
         """
-        err = traceback.format_exc()
+        err = getattr(reason, '_hook_traceback', None) \
+            or traceback.format_exc()
         if err is None or err == 'None\n' or err == 'NoneType: None\n':
             err = str(reason)
         reason = "Python exception:\n" + err
@@ -1403,22 +3010,21 @@ class Job(object):
 
     def resubmit(self):
         """Make a FAILED job eligible for running again."""
+        if self._resubmit():
+            # Wake up the web service and let it know a new incoming
+            # job is present
+            _notify_incoming(self._db.config, [self.name])
+
+    def _resubmit(self):
+        """Move a FAILED job back to the INCOMING state, without waking up
+           the web service. Return True on success."""
         self._assert_state('FAILED')
         try:
             self.__set_state('INCOMING')
-            # Wake up the web service and let it know a new incoming
-            # job is present
-            try:
-                s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-                s.connect(self._db.config.socket)
-                msg = "INCOMING %s" % self.name
-                msg = msg.encode('utf-8')
-                s.send(msg)
-                s.close()
-            except socket.error:
-                pass
+            return True
         except Exception as detail:
             self._fail(detail)
+            return False
 
     def admin_fail(self, email):
         """Force a job into the FAILED state. This is intended to be used
@@ -1428,8 +3034,13 @@ class Job(object):
 
     def delete(self):
         """Delete the job directory and database row."""
-        if self._metadata['directory']:
+        if self._metadata.get('directory'):
             shutil.rmtree(self._metadata['directory'])
+        self._delete_row()
+
+    def _delete_row(self):
+        """Delete the job's database row (the directory must already have
+           been deleted)."""
         self._db._delete_job(self._metadata, self._get_state())
         self._metadata = None
 
@@ -1485,7 +3096,9 @@ class Job(object):
     def archive(self):
         """Do any necessary processing when an old completed job reaches its
            archive time. Does nothing by default, but can be overridden by
-           the user to compress files, etc.
+           the user to compress files, etc. (If the 'compress' option is set
+           in the configuration file, the whole job directory is packed into
+           a single compressed file after this method returns.)
            This method should not be called directly."""
 
     def expire(self):
@@ -1559,12 +3172,134 @@ class Job(object):
                    doc="URL containing job results (read-only)")
     service_name = property(lambda x: x._db.config.service_name,
                             doc="Web service name (read-only)")
-    directory = property(lambda x: x._metadata['directory'],
+    directory = property(lambda x: x._metadata.get('directory'),
                          doc="Current job working directory (read-only)")
     config = property(lambda x: x._db.config,
                       doc=":class:`Config` object (read-only)")
 
 
+class _JobHook(object):
+    """A call to a :class:`Job` hook method (see :meth:`Job._call_hook`)."""
+    def __init__(self, job, meth, args):
+        self.job = job
+        self.meth = meth
+        self.args = args
+
+    def run(self):
+        """Run the hook in this process"""
+        return self.job._run_in_job_directory(self.meth, *self.args)
+
+
+def _remove_expired_directory(directory):
+    """Remove the directory of a job that is being expired. The directory
+       may already have been removed, if the backend stopped after doing so
+       but before the job was recorded as expired."""
+    if os.path.lexists(directory):
+        shutil.rmtree(directory)
+
+
+def _run_hook_in_child(hook):
+    """Run a hook in a worker process (see
+       :meth:`WebService._get_hook_pool`). Return a tuple of a success
+       flag, the hook's return value (or exception), and the job state
+       modified by the hook (see :meth:`Job._get_hook_state`)."""
+    try:
+        out = (True, hook.run(), hook.job._get_hook_state())
+    except Exception as detail:
+        detail._hook_traceback = traceback.format_exc()
+        out = (False, detail, hook.job._get_hook_state())
+    try:
+        pickle.dumps(out)
+    except Exception as detail:
+        err = RuntimeError("Could not pass results of %s back from hook "
+                           "process: %s" % (hook.meth.__name__, detail))
+        out = (False, err, None)
+    return out
+
+
+class _DetachedDatabase(object):
+    """Stand-in for the :class:`Database` of a :class:`Job` whose hook is
+       run in a worker process. Only the configuration is available."""
+    def __init__(self, config):
+        self.config = config
+
+
+class _JobMove(object):
+    """A move of a job's directory from `source` to `destination`, run in
+       the background (see :meth:`Job._change_state`). If `destination`
+       is None, the (already copied) `source` directory is removed."""
+    def __init__(self, job, source, destination):
+        self.job = job
+        self.source = source
+        self.destination = destination
+
+    def run(self, workers):
+        """Do the move, copying up to `workers` files in parallel. Return
+           True if the source directory was copied (and so still needs to
+           be removed)."""
+        if self.destination is None:
+            shutil.rmtree(self.source)
+        else:
+            return saliweb.backend.mover.move_directory(
+                self.source, self.destination, workers)
+
+
+class _DependencyGraph(object):
+    """In-memory copy of the job dependencies table, indexed by both
+       child and parent job name. It also keeps track of child jobs
+       that are no longer waiting on any parent."""
+    def __init__(self, depends):
+        # Map from child to set of parents, and vice versa
+        self.parents = {}
+        self.children = {}
+        self.ready = set()
+        for child, parents in depends.items():
+            self.set_parents(child, parents)
+
+    def __contains__(self, child):
+        return child in self.parents
+
+    def matches(self, depends):
+        """Return True if the graph matches the given dict of
+           child:[parent,...] pairs (see Database._get_job_dependencies)"""
+        return self.parents == dict((child, set(parents))
+                                    for child, parents in depends.items())
+
+    def set_parents(self, child, parents):
+        self._remove_child(child)
+        if parents:
+            self.parents[child] = set(parents)
+            for parent in parents:
+                self.children.setdefault(parent, set()).add(child)
+
+    def _remove_child(self, child):
+        for parent in self.parents.pop(child, ()):
+            children = self.children[parent]
+            children.discard(child)
+            if not children:
+                del self.children[parent]
+
+    def remove_parent(self, parent):
+        """Remove all dependencies on the given parent job"""
+        for child in self.children.pop(parent, ()):
+            parents = self.parents[child]
+            parents.discard(parent)
+            if not parents:
+                del self.parents[child]
+                self.ready.add(child)
+
+    def remove_job(self, name):
+        """Remove all dependencies of, and on, the given job"""
+        self._remove_child(name)
+        self.remove_parent(name)
+        self.ready.discard(name)
+
+    def pop_ready(self):
+        ready = self.ready
+        self.ready = set()
+        return ready
+
+
 class _LockedJobDict(object):
     """A dictionary of job IDs which can be accessed by multiple threads"""
     def __init__(self):
@@ -1600,6 +3335,21 @@ class Runner(object):
        unique name for this class, and call :meth:`Job.register_runner_class`
        passing this class."""
 
+    @classmethod
+    def _prefetch_status(cls, jobids):
+        """Get the status of all of the given jobs at once, so that
+           subsequent calls to _check_completed for these jobs are cheap.
+           Does nothing by default."""
+
+    @classmethod
+    def _clear_status_cache(cls):
+        """Forget any status obtained by _prefetch_status."""
+
+    @classmethod
+    def _get_task_count(cls, jobid):
+        """Return the number of tasks in the given job. Defaults to 1."""
+        return 1
+
 
 class ClusterRunner(Runner):
     """Base class to run a set of commands on a compute cluster.
@@ -1622,6 +3372,9 @@ class ClusterRunner(Runner):
        and/or :meth:`set_name` to set the job name.
     """
 
+    _reaper = None
+    _status_cache = None
+
     def __init__(self, script, interpreter='/bin/sh'):
         Runner.__init__(self)
         self._opts = ''
@@ -1702,10 +3455,61 @@ class ClusterRunner(Runner):
             runid = s.runJob(jt)
             jobids = [runid]
         s.deleteJobTemplate(jt)
-        saliweb.backend.cluster._DRMAAJobWaiter(webservice, jobids,
-                                                self, runid).start()
+        self._get_reaper().add(webservice, jobids, runid)
         return runid
 
+    @classmethod
+    def _get_reaper(cls):
+        """Get the thread that waits for all jobs run by this class."""
+        if cls._reaper is None:
+            cls._reaper = saliweb.backend.cluster._DRMAAReaper(cls)
+            cls._reaper.start()
+        return cls._reaper
+
+    @classmethod
+    def _prefetch_status(cls, jobids):
+        """Get the status of all of the given bulk jobs using a single call
+           to the queuing system. If this fails, each job's status is instead
+           queried individually by _check_completed."""
+        bulk = [cls._get_bulk_job_id(j) for j in jobids
+                if cls._task_separator in j]
+        if not bulk:
+            return
+        try:
+            cls._status_cache = (frozenset(bulk), cls._get_queued_jobs())
+        except (OSError, ValueError):
+            cls._status_cache = None
+
+    @classmethod
+    def _clear_status_cache(cls):
+        cls._status_cache = None
+
+    @classmethod
+    def _get_bulk_job_id(cls, jobid):
+        """Get the queuing system's ID for a bulk job run ID"""
+        return jobid.split(cls._task_separator, 1)[0]
+
+    @classmethod
+    def _get_task_count(cls, jobid):
+        """Return the number of tasks in the given job, which for bulk jobs
+           is encoded in the run ID (see _Tasks.get_run_id)."""
+        if cls._task_separator not in jobid:
+            return 1
+        tasks = jobid.split(cls._task_separator, 1)[1]
+        return saliweb.backend.cluster._Tasks._count_run_id_tasks(tasks)
+
+    @classmethod
+    def _check_bulk_completed(cls, jobid):
+        """Return True if the cluster reports that the given bulk job has
+           finished, False if it is still running, or None if the status
+           cannot be determined.
+        """
+        bulkid = cls._get_bulk_job_id(jobid)
+        cache = cls._status_cache
+        if cache is not None and bulkid in cache[0]:
+            return bulkid not in cache[1]
+        return cls._check_single_bulk_completed(bulkid)
+
     @classmethod
     def _check_completed(cls, jobid, directory):
         """Return True if the cluster reports that the given job has finished,
@@ -1768,7 +3572,23 @@ class SGERunner(ClusterRunner):
         return self._opts + ' -w n -b no'
 
     @classmethod
-    def _check_bulk_completed(cls, jobid):
+    def _get_queued_jobs(cls):
+        """Return the IDs of all of our jobs that SGE still knows about."""
+        p = subprocess.Popen([cls._qstat, '-xml', '-u', getpass.getuser()],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=cls._env, universal_newlines=True)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise OSError("qstat returned %d (%s)" % (p.returncode, err))
+        try:
+            root = xml.etree.ElementTree.fromstring(out)
+        except xml.etree.ElementTree.ParseError as detail:
+            raise ValueError("Could not parse qstat output: %s" % detail)
+        return frozenset(e.text.strip()
+                         for e in root.iter('JB_job_number'))
+
+    @classmethod
+    def _check_single_bulk_completed(cls, jobid):
         """Return True if SGE reports that the given bulk job has finished,
            False if it is still running, or None if the status cannot be
            determined.
@@ -1776,8 +3596,6 @@ class SGERunner(ClusterRunner):
         # Unfortunately DRMAA1 only allows us to query individual tasks, and
         # looping over all tasks in a large parallel job is very inefficient,
         # so use qstat instead and parse the output.
-        m = re.match(r'(\S+)\.(\d+)\-(\d+):(\d+)$', jobid)
-        jobid = m.group(1)
         p = subprocess.Popen([cls._qstat, '-j', jobid], stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT, env=cls._env,
                              universal_newlines=True)
@@ -1815,7 +3633,20 @@ class SLURMRunner(ClusterRunner):
         self._write_script_body(fh)
 
     @classmethod
-    def _check_bulk_completed(cls, jobid):
+    def _get_queued_jobs(cls):
+        """Return the IDs of all of our jobs that SLURM still knows about."""
+        p = subprocess.Popen([cls._squeue, '-h', '-o', '%F',
+                              '-u', getpass.getuser()],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             env=cls._env, universal_newlines=True)
+        out, err = p.communicate()
+        if p.returncode != 0:
+            raise OSError("squeue returned %d (%s)" % (p.returncode, err))
+        return frozenset(line.strip() for line in out.split('\n')
+                         if line.strip())
+
+    @classmethod
+    def _check_single_bulk_completed(cls, jobid):
         """Return True if SLURM reports that the given bulk job has finished,
            False if it is still running, or None if the status cannot be
            determined.
@@ -1823,8 +3654,6 @@ class SLURMRunner(ClusterRunner):
         # Unfortunately DRMAA1 only allows us to query individual tasks, and
         # looping over all tasks in a large parallel job is very inefficient,
         # so use squeue instead and parse the output.
-        m = re.match(r'(\S+)_(\d+)\-(\d+):(\d+)$', jobid)
-        jobid = m.group(1)
         p = subprocess.Popen([cls._squeue, '-j', jobid],
                              stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT, env=cls._env,
@@ -1847,6 +3676,7 @@ class WyntonSGERunner(SGERunner):
     """
     _runner_name = 'wyntonsge'
     _drmaa = None
+    _reaper = None
     _env = {'SGE_CELL': 'wynton',
             'SGE_ROOT': '/opt/sge',
             'DRMAA_LIBRARY_PATH':
@@ -1866,6 +3696,7 @@ class WyntonAGERunner(SGERunner):
     """
     _runner_name = 'wyntonage'
     _drmaa = None
+    _reaper = None
     _env = {'SGE_CELL': 'wynton',
             'SGE_ROOT': '/opt/age',
             'SGE_QMASTER_PORT': '26444',
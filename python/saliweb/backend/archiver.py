@@ -0,0 +1,120 @@
+"""Packing of archived job directories into a single compressed file.
+   See the 'compress' option in the [oldjobs] section of the configuration
+   file."""
+
+import contextlib
+import tarfile
+import shutil
+import uuid
+import re
+import os
+
+# Suffix of the archive file for each supported compression method
+_suffixes = {'gzip': 'gz', 'bzip2': 'bz2', 'xz': 'xz', 'zstd': 'zst'}
+
+#: Supported compression methods
+compressions = frozenset(_suffixes.keys())
+
+#: Name of the file listing the contents of the archive
+index_name = 'archive.index'
+
+# Files written by an unfinished pack have a reserved prefix and a unique
+# token, so that they cannot be confused with the job's own files
+_partial_prefix = '.saliweb-pack-'
+_partial_re = re.compile(re.escape(_partial_prefix)
+                         + r'[0-9a-f]{32}\.(tar\.\w+|index)$')
+
+
+def get_archive_name(compression):
+    """Get the name of the archive file made with the given compression."""
+    return 'archive.tar.' + _suffixes[compression]
+
+
+@contextlib.contextmanager
+def _open_tar(fh, compression):
+    """Open a tar stream for writing to `fh` with the given compression."""
+    if compression == 'zstd':
+        # zstd support requires the 'zstandard' module
+        import zstandard
+        with zstandard.ZstdCompressor().stream_writer(
+                fh, closefd=False) as stream:
+            with tarfile.open(fileobj=stream, mode='w|') as tar:
+                yield tar
+    else:
+        with tarfile.open(fileobj=fh,
+                          mode='w|' + _suffixes[compression]) as tar:
+            yield tar
+
+
+def check_compression(compression):
+    """Make sure that the given compression method can be used; raise
+       :exc:`ImportError` if it needs a Python module that is not
+       installed."""
+    if compression == 'zstd':
+        import zstandard  # noqa: F401
+
+
+def _is_partial(name):
+    """Return True if `name` is a file written by :func:`pack_directory`
+       before it has finished."""
+    return _partial_re.match(name) is not None
+
+
+def _index_line(tarinfo):
+    kind = 'd' if tarinfo.isdir() else 'l' if tarinfo.issym() else 'f'
+    return "%s\t%d\t%d\t%s\n" % (kind, tarinfo.size, tarinfo.mtime,
+                                 tarinfo.name)
+
+
+def pack_directory(directory, compression):
+    """Replace the contents of the job directory `directory` with a single
+       compressed tar file (see :func:`get_archive_name`) and an index file
+       listing its contents (one line per member, giving the type, size,
+       modification time and path, separated by tabs). The directory
+       itself is kept, so the job still has a directory. If packing fails,
+       or the directory already contains a file with the name of the
+       archive or index file, the directory is left as it was (and an
+       exception is raised)."""
+    archive = get_archive_name(compression)
+    names = []
+    for name in sorted(os.listdir(directory)):
+        if _is_partial(name):
+            # Left over from an interrupted pack
+            os.unlink(os.path.join(directory, name))
+        elif name in (archive, index_name):
+            # Don't overwrite the job's own files
+            raise FileExistsError("Job directory %s already contains %s"
+                                  % (directory, name))
+        else:
+            names.append(name)
+    index = []
+
+    def add_to_index(tarinfo):
+        index.append(_index_line(tarinfo))
+        return tarinfo
+    # Write to hidden files first, so that an interrupted pack leaves
+    # the original files intact
+    tmp = os.path.join(directory, _partial_prefix + uuid.uuid4().hex)
+    tmp_archive = tmp + '.tar.' + _suffixes[compression]
+    tmp_index = tmp + '.index'
+    try:
+        with open(tmp_archive, 'wb') as fh:
+            with _open_tar(fh, compression) as tar:
+                for name in names:
+                    tar.add(os.path.join(directory, name), arcname=name,
+                            filter=add_to_index)
+        with open(tmp_index, 'w') as fh:
+            fh.writelines(index)
+    except BaseException:
+        for tmp in (tmp_archive, tmp_index):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+        raise
+    os.rename(tmp_archive, os.path.join(directory, archive))
+    os.rename(tmp_index, os.path.join(directory, index_name))
+    for name in names:
+        path = os.path.join(directory, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.unlink(path)
@@ -0,0 +1,112 @@
+"""Support for admin tools that act on many jobs at once (e.g. to fail or
+   resubmit every job affected by a cluster outage)."""
+
+import saliweb.backend
+import concurrent.futures
+import fnmatch
+import shutil
+import sys
+
+
+def _age(raw):
+    return saliweb.backend._parse_time_delta(raw)
+
+
+def add_selection_options(parser):
+    """Add options to the given ArgumentParser to select jobs in bulk."""
+    parser.add_argument(
+        "-u", "--user", default=None,
+        help="Only consider jobs submitted by USER")
+    parser.add_argument(
+        "--older-than", metavar="AGE", type=_age, default=None,
+        help="Only consider jobs submitted more than AGE ago, where AGE "
+             "is a number followed by h, d, w, m or y (for hours, days, "
+             "weeks, months or years), e.g. 12h")
+
+
+def _is_glob(name):
+    return any(c in name for c in '*?[')
+
+
+def is_bulk(args, names):
+    """Return True if the jobs should be selected in bulk, i.e. if any of
+       the given job names is a glob pattern (such as job*) or any of the
+       options added by :func:`add_selection_options` were given."""
+    return (args.user is not None or args.older_than is not None
+            or any(_is_glob(name) for name in names))
+
+
+def select_jobs(web, states, names, user=None, older_than=None):
+    """Get a list of all jobs in any of the given states that match any of
+       the given job names or glob patterns (or all jobs, if `names` is
+       empty), optionally restricted to those submitted by `user` or
+       submitted more than `older_than` (a timedelta) ago."""
+    before = None
+    if older_than is not None:
+        before = saliweb.backend._utcnow() - older_than
+    jobs = []
+    for state in states:
+        # The database does a first pass over the names; check the
+        # (hopefully few) jobs it returns against the exact patterns
+        for job in web.db._get_all_jobs_in_state(
+                state, user=user, submitted_before=before,
+                name_patterns=names or None):
+            if not names or any(fnmatch.fnmatchcase(job.name, name)
+                                for name in names):
+                jobs.append(job)
+    return jobs
+
+
+def confirm(action, jobs):
+    """Ask the user to confirm an action on a list of jobs.
+       Return True if the action should go ahead."""
+    sys.stdout.write("%s %d job(s)? " % (action, len(jobs)))
+    sys.stdout.flush()
+    reply = sys.stdin.readline()
+    return len(reply) >= 1 and reply[0].upper() == 'Y'
+
+
+def _delete_directory(job):
+    """Delete a job's directory, and return any exception raised"""
+    try:
+        if job.directory:
+            shutil.rmtree(job.directory)
+    except FileNotFoundError:
+        # Directory was removed by a previous (interrupted) deletion
+        pass
+    except Exception as detail:
+        return detail
+
+
+def delete_jobs(web, jobs, workers=8):
+    """Delete the directories and database rows of all the given jobs.
+       Directories are deleted in parallel using `workers` threads, and then
+       the rows of all jobs whose directories were deleted are removed in a
+       single transaction. Return a list of (job, exception) tuples for jobs
+       that could not be deleted."""
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        errors = list(executor.map(_delete_directory, jobs))
+    with web.db._unit_of_work(max_changes=len(jobs)):
+        for job, err in zip(jobs, errors):
+            if err is None:
+                job._delete_row()
+    return [(job, err) for job, err in zip(jobs, errors) if err is not None]
+
+
+def resubmit_jobs(web, jobs):
+    """Put all of the given FAILED jobs back in the incoming queue, in a
+       single transaction, and then wake up the backend once. Return the
+       names of the jobs that were resubmitted."""
+    with web.db._unit_of_work(max_changes=len(jobs)):
+        names = [job.name for job in jobs if job._resubmit()]
+    if names:
+        saliweb.backend._notify_incoming(web.config, names)
+    return names
+
+
+def fail_jobs(web, jobs, email):
+    """Force all of the given jobs into the FAILED state, in a single
+       transaction."""
+    with web.db._unit_of_work(max_changes=len(jobs)):
+        for job in jobs:
+            job.admin_fail(email)
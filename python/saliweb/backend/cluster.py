@@ -1,40 +1,111 @@
 import re
 import os
+import threading
+import time
 import saliweb.backend.events
-from saliweb.backend.events import _JobThread
 
 
-class _DRMAAJobWaiter(_JobThread):
-    """Wait for a job started by a DRMAA Runner to finish"""
-    def __init__(self, webservice, jobids, runner, runid):
-        _JobThread.__init__(self, webservice)
-        self._jobids = jobids
-        self._runner = runner
-        self._runid = runid
+class _DRMAAReaper(threading.Thread):
+    """Wait for any job started by a DRMAA Runner class to finish.
+       A single reaper is shared by all jobs run by a given Runner class.
+       Each finished DRMAA job (or bulk job task) is mapped back to its run
+       ID, and a _CompletedJobEvent is sent once every job in the run
+       has finished. If DRMAA fails to wait, the wait is retried after a
+       delay; if it keeps failing, the reaper stops waiting for its runs,
+       and the backend polls them instead."""
+
+    # Delay (in seconds) before retrying a failed wait; this is doubled
+    # after each consecutive failure
+    _retry_delay = 1.
+
+    # Number of consecutive failed waits after which the reaper gives up
+    _max_failures = 5
+
+    def __init__(self, runnercls):
+        super().__init__()
+        self.daemon = True
+        self._runnercls = runnercls
+        self._cond = threading.Condition()
+        # Map from DRMAA job ID to run ID
+        self._runids = {}
+        # Map from run ID to [webservice, unfinished DRMAA job IDs,
+        #                     failed DRMAA job IDs]
+        self._runs = {}
+        # DRMAA jobs that finished before they were added (and whether
+        # they failed)
+        self._finished = {}
+
+    def add(self, webservice, jobids, runid):
+        """Start waiting for the given DRMAA job IDs, which together make up
+           the run `runid`."""
+        self._runnercls._waited_jobs.add(runid)
+        with self._cond:
+            self._runs[runid] = [webservice, set(jobids), []]
+            for j in jobids:
+                self._runids[j] = runid
+            for j in jobids:
+                if j in self._finished:
+                    self._job_finished(j, self._finished.pop(j))
+            self._cond.notify()
 
     def run(self):
+        drmaa, s = self._runnercls._get_drmaa()
+        failures = 0
+        while True:
+            with self._cond:
+                while not self._runs:
+                    self._cond.wait()
+            try:
+                info = s.wait(drmaa.Session.JOB_IDS_SESSION_ANY,
+                              drmaa.Session.TIMEOUT_WAIT_FOREVER)
+            except Exception:
+                failures += 1
+                if failures < self._max_failures:
+                    time.sleep(self._retry_delay * 2 ** (failures - 1))
+                else:
+                    # DRMAA has nothing left to wait for, or cannot wait.
+                    # We don't know whether our runs finished, so leave
+                    # them for the backend to poll
+                    failures = 0
+                    with self._cond:
+                        self._stop_waiting()
+                continue
+            failures = 0
+            with self._cond:
+                self._job_finished(info.jobId, info.wasAborted)
+
+    def _stop_waiting(self):
+        for runid in self._runs:
+            self._runnercls._waited_jobs.remove(runid)
+        self._runs.clear()
+        self._runids.clear()
+
+    def _job_finished(self, jobid, failed):
+        runid = self._runids.pop(jobid, None)
+        if runid is None:
+            self._finished[jobid] = failed
+            return
+        unfinished, failed_jobids = self._runs[runid][1:]
+        unfinished.discard(jobid)
+        if failed:
+            failed_jobids.append(jobid)
+        if not unfinished:
+            self._run_finished(runid)
+
+    def _run_finished(self, runid):
         from saliweb.backend import RunnerError
-        self._runner._waited_jobs.add(self._runid)
-        try:
-            drmaa, s = self._runner._get_drmaa()
-            failed_jobids = []
-            s.synchronize(self._jobids, drmaa.Session.TIMEOUT_WAIT_FOREVER,
-                          False)
-            for j in self._jobids:
-                if not s.wait(j, drmaa.Session.TIMEOUT_WAIT_FOREVER):
-                    failed_jobids.append(j)
-            if len(failed_jobids) > 0:
-                failure = RunnerError("Cluster jobs failed: %s. Please contact"
-                                      " the cluster sysadmin."
-                                      % ', '.join(failed_jobids))
-            else:
-                failure = None
-            e = saliweb.backend.events._CompletedJobEvent(self._webservice,
-                                                          self._runner,
-                                                          self._runid, failure)
-            self._webservice._event_queue.put(e)
-        finally:
-            self._runner._waited_jobs.remove(self._runid)
+        webservice, unfinished, failed_jobids = self._runs.pop(runid)
+        if len(failed_jobids) > 0:
+            failure = RunnerError("Cluster jobs failed: %s. Please contact"
+                                  " the cluster sysadmin."
+                                  % ', '.join(failed_jobids))
+        else:
+            failure = None
+        e = saliweb.backend.events._CompletedJobEvent(webservice,
+                                                      self._runnercls,
+                                                      runid, failure)
+        webservice._event_queue.put(e)
+        self._runnercls._waited_jobs.remove(runid)
 
 
 class _Tasks(object):
@@ -66,6 +137,16 @@ class _Tasks(object):
             raise ValueError("Unexpected bulk jobs return: %s; "
                              "was expecting %d jobs" % (str(jobids), numjobs))
 
+    @staticmethod
+    def _count_run_id_tasks(tasks):
+        """Get the number of subtasks from the 'first-last:step' part
+           of a run ID"""
+        m = re.match(r'(\d+)\-(\d+):(\d+)$', tasks)
+        if not m:
+            return 1
+        first, last, step = [int(x) for x in m.groups()]
+        return (last - first + step) // step
+
 
 class _SGETasks(_Tasks):
     """Parse SGE-style '-t' option into number of job subtasks"""
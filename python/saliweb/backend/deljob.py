@@ -1,21 +1,28 @@
 import saliweb.backend
+import saliweb.backend.bulk
 from argparse import ArgumentParser
 import sys
 
 
 def get_options():
     parser = ArgumentParser(
-        description="Delete the job(s) JOBNAME in the given STATE.")
+        description="Delete the job(s) JOBNAME in the given STATE. "
+                    "To delete many jobs at once, JOBNAME can be a glob "
+                    "pattern such as 'job*', or can be omitted if --user "
+                    "or --older-than is given.")
     parser.add_argument("state", metavar="STATE", help="Job state to consider")
     parser.add_argument(
-        "jobs", metavar="JOBNAME", nargs="+", help="Jobs to delete")
+        "jobs", metavar="JOBNAME", nargs="*", help="Jobs to delete")
     parser.add_argument(
         '-f', "--force", action="store_true",
         default=False, dest="force",
         help="Delete jobs without prompting")
+    saliweb.backend.bulk.add_selection_options(parser)
 
     args = parser.parse_args()
-    return args.state, args.jobs, args.force
+    if not args.jobs and not saliweb.backend.bulk.is_bulk(args, args.jobs):
+        parser.error("No jobs given")
+    return args
 
 
 def delete_job(job, force):
@@ -28,6 +35,16 @@ def delete_job(job, force):
     job.delete()
 
 
+def delete_jobs(web, jobs, force):
+    if not jobs or (not force
+                    and not saliweb.backend.bulk.confirm('Delete', jobs)):
+        return
+    errors = saliweb.backend.bulk.delete_jobs(web, jobs)
+    for job, err in errors:
+        print("Could not delete job %s: %s" % (job.name, err),
+              file=sys.stderr)
+
+
 def check_valid_state(web, state):
     # Check for valid state name
     _ = saliweb.backend._JobState(state)
@@ -38,12 +55,18 @@ def check_valid_state(web, state):
 
 
 def main(webservice):
-    state, job_names, force = get_options()
+    args = get_options()
     web = webservice.get_web_service(webservice.config)
-    check_valid_state(web, state)
-    for name in job_names:
-        job = web.get_job_by_name(state, name)
+    check_valid_state(web, args.state)
+    if saliweb.backend.bulk.is_bulk(args, args.jobs):
+        jobs = saliweb.backend.bulk.select_jobs(
+            web, [args.state], args.jobs, user=args.user,
+            older_than=args.older_than)
+        delete_jobs(web, jobs, args.force)
+        return
+    for name in args.jobs:
+        job = web.get_job_by_name(args.state, name)
         if job:
-            delete_job(job, force)
+            delete_job(job, args.force)
         else:
             print("Could not find job", name, file=sys.stderr)
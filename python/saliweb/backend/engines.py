@@ -0,0 +1,349 @@
+"""SQL database engines that can be used to store the job database."""
+
+import datetime
+import copy
+import re
+import threading
+import saliweb.backend
+
+
+class SQLEngine(object):
+    """Interface to a particular SQL database engine, used by
+       :class:`~saliweb.backend.Database`. This handles making connections
+       to the database, and any parts of the SQL dialect that differ
+       between engines. Subclass this to support a new engine."""
+
+    #: Placeholder used in SQL queries for parameters
+    placeholder = '%s'
+
+    #: SQL expression giving the current UTC date and time
+    utc_timestamp = 'UTC_TIMESTAMP()'
+
+    #: Exceptions that may indicate that the connection to the database
+    #: has been lost (see :meth:`is_disconnect`)
+    errors = ()
+
+    #: If True, streamed query results are read using a separate
+    #: database connection, since the engine does not allow other queries
+    #: to be made on the same connection until all results are read
+    stream_separate_connection = False
+
+    def connect(self, config):
+        """Make and return a new DB-API connection to the database, using
+           the information in the given :class:`~saliweb.backend.Config`
+           object."""
+        raise NotImplementedError()
+
+    def is_disconnect(self, err):
+        """Return True if the given exception (one of :attr:`errors`)
+           means that the connection to the database was lost, in which
+           case the query is retried on a new connection."""
+        return False
+
+    def get_cursor(self, conn, stream=False):
+        """Get a new cursor for the given connection. If `stream` is True,
+           the cursor should read results from the server as they are
+           fetched, rather than all at once."""
+        return conn.cursor()
+
+    def quote_identifier(self, name):
+        """Quote the given column name for use in a SQL statement, if
+           needed (for example, 'user' is a reserved word in some
+           engines)."""
+        return name
+
+    def get_field_schema(self, field):
+        """Get the SQL schema for the given
+           :class:`~saliweb.backend.MySQLField`."""
+        return field.get_schema()
+
+    def get_index_schema(self, table, index, online=False):
+        """Get the SQL statement to add the given
+           :class:`~saliweb.backend.MySQLIndex` to a table. If `online`
+           is True, the table is live, so the index should if possible be
+           built without blocking reads or writes."""
+        return index.get_schema(table)
+
+    def get_drop_index_schema(self, table, name):
+        """Get the SQL statement to remove the named index from a table."""
+        return 'DROP INDEX %s' % name
+
+    def get_table_indexes(self, execute, table):
+        """Get all indexes present on the given table, as a dict of index
+           name: tuple of field names. `execute` should be used to run
+           any queries; it takes the same arguments as
+           :meth:`Database._execute`."""
+        raise NotImplementedError()
+
+    def get_replace_select(self, table, fields, key, select):
+        """Get a SQL statement to copy rows from the `select` query (which
+           returns the given `fields`) into the given table in bulk,
+           replacing any existing rows that have the same value of the
+           `key` field."""
+        return 'REPLACE INTO %s (%s) %s' % (
+            table, ', '.join(self.quote_identifier(f) for f in fields),
+            select)
+
+
+class MySQLEngine(SQLEngine):
+    """Store the job database using MySQL or MariaDB (this is the default).
+       The MySQLdb Python module is used to talk to the database."""
+
+    stream_separate_connection = True
+
+    # MySQL error codes for "server has gone away" and
+    # "lost connection to server during query"
+    _disconnect_codes = (2006, 2013)
+
+    def connect(self, config):
+        import MySQLdb
+        self._cursors = MySQLdb.cursors
+        self.errors = (MySQLdb.OperationalError,)
+        conn = MySQLdb.connect(user=config.database['user'],
+                               db=config.database['db'],
+                               unix_socket=config.database['socket'],
+                               passwd=config.database['passwd'])
+        conn.set_character_set('utf8')
+        c = conn.cursor()
+        # Make sure that our SELECTs see jobs added by the frontend
+        c.execute("SET SESSION TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        return conn
+
+    def is_disconnect(self, err):
+        return (hasattr(err, 'args') and isinstance(err.args, tuple)
+                and len(err.args) >= 1
+                and err.args[0] in self._disconnect_codes)
+
+    def get_cursor(self, conn, stream=False):
+        if stream:
+            return conn.cursor(self._cursors.SSCursor)
+        else:
+            return conn.cursor()
+
+    def get_index_schema(self, table, index, online=False):
+        schema = index.get_schema(table)
+        if online:
+            schema += ' ALGORITHM=INPLACE LOCK=NONE'
+        return schema
+
+    def get_drop_index_schema(self, table, name):
+        return 'DROP INDEX %s ON %s' % (name, table)
+
+    def get_table_indexes(self, execute, table):
+        return _parse_mysql_indexes(execute('SHOW INDEX FROM ' + table))
+
+
+def _parse_mysql_indexes(rows):
+    """Get indexes from the rows returned by a MySQL SHOW INDEX query,
+       as a dict of index name: tuple of field names."""
+    fields = {}
+    # Each row contains (among others) the index name, the position
+    # of the field in the index, and the field name
+    for row in rows:
+        fields.setdefault(row[2], []).append((row[3], row[4]))
+    return dict((name, tuple(f[1] for f in sorted(fields[name])))
+                for name in fields)
+
+
+def _adapt_datetime(ts):
+    return ts.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _convert_datetime(val):
+    return datetime.datetime.fromisoformat(val.decode('ascii'))
+
+
+class SQLiteEngine(SQLEngine):
+    """Store the job database in a local SQLite file. This is suitable for
+       small web services where the backend runs on a single host,
+       and for testing. The 'db' option in the configuration file gives the
+       name of the file, unless `filename` is given here. Write-ahead
+       logging is used, so that reads are not blocked by writes."""
+
+    placeholder = '?'
+
+    def __init__(self, filename=None):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.errors = (sqlite3.OperationalError,)
+        self.filename = filename
+
+    def connect(self, config):
+        sqlite3 = self._sqlite3
+        # Store dates in the same form as MySQL DATETIME fields, so that
+        # they sort correctly
+        sqlite3.register_adapter(datetime.datetime, _adapt_datetime)
+        sqlite3.register_converter('DATETIME', _convert_datetime)
+        filename = self.filename or config.database['db']
+        conn = sqlite3.connect(filename, timeout=30.,
+                               detect_types=sqlite3.PARSE_DECLTYPES,
+                               check_same_thread=False)
+        # sqlite has no date/time functions like MySQL's, so add one
+        conn.create_function('UTC_TIMESTAMP', 0,
+                             lambda: _adapt_datetime(
+                                 saliweb.backend._utcnow()))
+        if filename != ':memory:':
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def get_field_schema(self, field):
+        # sqlite has no enum field, so use a text field instead
+        if field.type.upper().startswith('ENUM('):
+            field = copy.copy(field)
+            field.type = 'TEXT'
+        return field.get_schema()
+
+    def get_table_indexes(self, execute, table):
+        names = [row[1] for row in
+                 execute('PRAGMA index_list(%s)' % table).fetchall()]
+        indexes = {}
+        for name in names:
+            c = execute('PRAGMA index_info(%s)' % name)
+            indexes[name] = tuple(row[2] for row in sorted(c.fetchall()))
+        return indexes
+
+
+class PostgreSQLEngine(SQLEngine):
+    """Store the job database using PostgreSQL. The psycopg2 Python module
+       is used to talk to the database. The 'socket' option in the
+       configuration file gives the directory containing the server's
+       Unix socket."""
+
+    utc_timestamp = "(NOW() AT TIME ZONE 'UTC')"
+    stream_separate_connection = True
+
+    def connect(self, config):
+        import psycopg2
+        self._psycopg2 = psycopg2
+        self.errors = (psycopg2.OperationalError, psycopg2.InterfaceError)
+        return psycopg2.connect(user=config.database['user'],
+                                dbname=config.database['db'],
+                                host=config.database['socket'],
+                                password=config.database['passwd'])
+
+    def is_disconnect(self, err):
+        # Errors reported by the server have a SQLSTATE code; lost
+        # connections do not
+        return getattr(err, 'pgcode', None) is None
+
+    def get_cursor(self, conn, stream=False):
+        if stream:
+            # Named cursors are read from the server in batches
+            return conn.cursor(name='saliweb_stream')
+        else:
+            return conn.cursor()
+
+    def quote_identifier(self, name):
+        # Quote all names, since some (e.g. 'user') are reserved words
+        return '"%s"' % name.replace('"', '""')
+
+    def get_field_schema(self, field):
+        check = ''
+        field = copy.copy(field)
+        field.name = self.quote_identifier(field.name)
+        if field.type.upper().startswith('ENUM('):
+            # Store enums as plain strings, restricted to the valid values
+            check = ' CHECK (%s IN (%s))' % (field.name, field.type[5:-1])
+            field.type = 'VARCHAR(20)'
+        elif field.type.upper() == 'DATETIME':
+            field.type = 'TIMESTAMP'
+        return field.get_schema() + check
+
+    def get_index_schema(self, table, index, online=False):
+        index = copy.copy(index)
+        index.fields = tuple(self.quote_identifier(f) for f in index.fields)
+        return index.get_schema(table)
+
+    def get_table_indexes(self, execute, table):
+        c = execute('SELECT indexname, indexdef FROM pg_indexes '
+                    'WHERE tablename=%s', (table,))
+        indexes = {}
+        for name, indexdef in c:
+            m = re.search(r'\((.*)\)\s*$', indexdef)
+            indexes[name] = tuple(f.strip().strip('"')
+                                  for f in m.group(1).split(','))
+        return indexes
+
+    def get_replace_select(self, table, fields, key, select):
+        q = self.quote_identifier
+        return ('INSERT INTO %s (%s) %s ON CONFLICT (%s) DO UPDATE SET %s'
+                % (table, ', '.join(q(f) for f in fields), select, q(key),
+                   ', '.join('%s=EXCLUDED.%s' % (q(f), q(f))
+                             for f in fields if f != key)))
+
+
+#: Mapping from names used in the 'engine' configuration file option to
+#: :class:`SQLEngine` subclasses
+engines = {'mysql': MySQLEngine, 'sqlite': SQLiteEngine,
+           'postgresql': PostgreSQLEngine}
+
+
+class _ConnectionPool(object):
+    """A small, thread-safe pool of database connections for a given
+       :class:`SQLEngine`. Connections are made on demand; at most `size`
+       idle connections are kept for reuse."""
+
+    def __init__(self, engine, config, size):
+        self.engine, self.config, self.size = engine, config, size
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Get a connection from the pool, making a new one if needed."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return self.engine.connect(self.config)
+
+    def put(self, conn):
+        """Return a connection to the pool once it is no longer needed."""
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        _close_quietly(conn)
+
+    def clear(self):
+        """Close all idle connections (e.g. if the server went away, they
+           are probably not usable either)."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            _close_quietly(conn)
+
+
+def _close_quietly(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class _PooledCursor(object):
+    """Wrap a cursor on a connection taken from a :class:`_ConnectionPool`,
+       so that the connection is returned to the pool once the cursor is
+       closed."""
+
+    def __init__(self, cursor, conn, pool):
+        self._cursor, self._conn, self._pool = cursor, conn, pool
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def close(self):
+        if self._conn is not None:
+            self._cursor.close()
+            # End the read-only transaction before the connection is reused
+            self._conn.rollback()
+            self._pool.put(self._conn)
+            self._conn = None
@@ -1,62 +1,173 @@
 import threading
 import select
 import time
-import collections
+import heapq
+import itertools
 
 
 class _EventQueue(object):
-    """A thread-safe FIFO queue"""
+    """A thread-safe priority queue of events. Events are returned in order
+       of their `priority` attribute (lowest first; see _DEFAULT_PRIORITY)
+       and then in FIFO order. Items can also be added with a delay, in
+       which case they are not returned until that time has elapsed.
+
+       Events with a true `coalesce` attribute are idempotent, so if an
+       event of the same type (for the same web service) is already waiting
+       in the queue, adding another is a no-op (other than calling the
+       waiting event's `merge` method, if it has one, with the new event).
+
+       Statistics on queue depth and the time events spent waiting are
+       kept in the `stats` dict."""
     def __init__(self):
         self.lock = threading.RLock()
-        self.queue = collections.deque()
+        # Heap of (priority, sequence number, time added, item)
+        self.queue = []
         self.cond = threading.Condition(self.lock)
+        # Heap of (due time, sequence number, item) for delayed items
+        self.delayed = []
+        self._sequence = itertools.count()
+        # Coalescing events currently in the queue
+        self._pending = {}
+        self.stats = {'depth': 0, 'max_depth': 0, 'processed': 0,
+                      'coalesced': 0, 'last_wait': 0., 'max_wait': 0.,
+                      'total_wait': 0.}
+
+    def _get_coalesce_key(self, item):
+        if getattr(item, 'coalesce', False):
+            return (type(item), getattr(item, 'webservice', None))
 
-    def put(self, item):
+    def put(self, item, delay=None):
+        """Add an item to the queue. If `delay` is given, the item will not
+           be returned by :meth:`get` until that many seconds have elapsed."""
         self.lock.acquire()
-        self.queue.append(item)
+        if delay:
+            heapq.heappush(self.delayed, (time.time() + delay,
+                                          next(self._sequence), item))
+        else:
+            self._push(item, time.time())
         self.cond.notify()
         self.lock.release()
 
+    def _push(self, item, now):
+        key = self._get_coalesce_key(item)
+        if key is not None:
+            pending = self._pending.get(key)
+            if pending is not None:
+                if hasattr(pending, 'merge'):
+                    pending.merge(item)
+                self.stats['coalesced'] += 1
+                return
+            self._pending[key] = item
+        heapq.heappush(self.queue, (getattr(item, 'priority',
+                                            _DEFAULT_PRIORITY),
+                                    next(self._sequence), now, item))
+        self.stats['depth'] = len(self.queue)
+        self.stats['max_depth'] = max(self.stats['max_depth'],
+                                      self.stats['depth'])
+
+    def _pop(self, now):
+        priority, seq, added, item = heapq.heappop(self.queue)
+        key = self._get_coalesce_key(item)
+        if key is not None:
+            del self._pending[key]
+        wait = now - added
+        self.stats['depth'] = len(self.queue)
+        self.stats['processed'] += 1
+        self.stats['last_wait'] = wait
+        self.stats['total_wait'] += wait
+        self.stats['max_wait'] = max(self.stats['max_wait'], wait)
+        return item
+
+    def _move_due_items(self, now):
+        """Move any delayed items that are now due onto the queue, and
+           return the time in seconds until the next delayed item is due
+           (or None)."""
+        while self.delayed and self.delayed[0][0] <= now:
+            due, seq, item = heapq.heappop(self.delayed)
+            self._push(item, due)
+        if self.delayed:
+            return self.delayed[0][0] - now
+
     def get(self, timeout=None):
         """Wait for and get the next item from the queue. If timeout is
            given, wait no longer than timeout seconds. If the queue is empty
            after the wait, return None."""
         self.lock.acquire()
-        if not self.queue:
-            self.cond.wait(timeout)
         try:
-            item = self.queue.popleft()
-        except IndexError:
-            item = None
-        self.lock.release()
-        return item
+            now = time.time()
+            end = None if timeout is None else now + timeout
+            while True:
+                next_due = self._move_due_items(now)
+                if self.queue:
+                    return self._pop(now)
+                if end is not None and now >= end:
+                    return None
+                waits = []
+                if next_due is not None:
+                    waits.append(next_due)
+                if end is not None:
+                    waits.append(end - now)
+                self.cond.wait(min(waits) if waits else None)
+                now = time.time()
+        finally:
+            self.lock.release()
+
+
+# Event priorities; events with lower values are processed first
+_COMPLETION_PRIORITY = 0
+_INCOMING_PRIORITY = 1
+_HOUSEKEEPING_PRIORITY = 2
+_DEFAULT_PRIORITY = _INCOMING_PRIORITY
 
 
 class _PeriodicCheckEvent(object):
-    """Event that represents a periodic check for incoming or completed jobs"""
+    """Event that represents a periodic check for incoming or completed jobs.
+       Each check schedules the next one."""
+    priority = _INCOMING_PRIORITY
+    coalesce = True
+
     def __init__(self, webservice):
         self.webservice = webservice
 
     def process(self):
+        self.webservice._schedule_periodic_check()
         self.webservice._process_completed_jobs()
+        self.webservice._check_dependencies()
         self.webservice._process_incoming_jobs()
 
 
 class _IncomingJobsEvent(object):
-    """Event that represents new incoming job(s)"""
-    def __init__(self, webservice):
+    """Event that represents new incoming job(s). If `names` is given, it
+       is the set of names of the new jobs; otherwise, all incoming
+       jobs are checked."""
+    priority = _INCOMING_PRIORITY
+    coalesce = True
+
+    def __init__(self, webservice, names=None):
         self.webservice = webservice
+        self.names = names
+
+    def merge(self, other):
+        if self.names is None or other.names is None:
+            self.names = None
+        else:
+            self.names |= other.names
 
     def process(self):
-        self.webservice._process_incoming_jobs()
+        self.webservice._process_incoming_jobs(self.names)
 
 
 class _CleanupIncomingJobsEvent(object):
-    """Event that represents cleanup of incoming job directories"""
+    """Event that represents cleanup of incoming job directories.
+       Each cleanup schedules the next one."""
+    priority = _HOUSEKEEPING_PRIORITY
+    coalesce = True
+
     def __init__(self, webservice):
         self.webservice = webservice
 
     def process(self):
+        self.webservice._schedule_cleanup_incoming_jobs()
         self.webservice._cleanup_incoming_jobs()
 
 
@@ -68,67 +179,116 @@ class _JobThread(threading.Thread):
         self._webservice = webservice
 
 
-class _PeriodicCheck(_JobThread):
-    def run(self):
-        # Simply emit a _PeriodicCheckEvent every check_minutes
-        timeout = self._webservice.config.backend['check_minutes'] * 60
-        while True:
-            time.sleep(timeout)
-            self._webservice._event_queue.put(_PeriodicCheckEvent(
-                                                     self._webservice))
-
-
 class _IncomingJobs(_JobThread):
     """Wait for new incoming jobs"""
     def __init__(self, webservice, sock):
         _JobThread.__init__(self, webservice)
         self._sock = sock
+        # Data read so far and deadline for each open client connection
+        self._clients = {}
+
+    # Maximum time in seconds to wait for a client to send its message
+    _read_timeout = 5.
 
     def run(self):
-        # Simply emit an IncomingJobsEvent whenever the listening socket is
-        # connected to
+        # Emit an IncomingJobsEvent whenever a client that connected to the
+        # listening socket has sent its message. Clients are read
+        # concurrently, so a slow client does not hold up the others.
         while True:
-            rlist, wlist, xlist = select.select([self._sock], [], [])
-            # Note that currently we don't do anything with the
-            # message itself coming in on the socket
-            if len(rlist) == 1:
-                conn, addr = self._sock.accept()
-            q = self._webservice._event_queue
-            q.put(_IncomingJobsEvent(self._webservice))
+            rlist, wlist, xlist = select.select(
+                [self._sock] + list(self._clients), [], [],
+                self._get_select_timeout())
+            for s in rlist:
+                if s is self._sock:
+                    self._accept()
+                else:
+                    self._read_client(s)
+            now = time.time()
+            for conn, (data, deadline) in list(self._clients.items()):
+                if now >= deadline:
+                    # Use whatever we got (the client may not have closed
+                    # the connection)
+                    self._finish_client(conn)
 
+    def _get_select_timeout(self):
+        """Get the time to wait until the next client read times out,
+           or None if no clients are connected"""
+        if self._clients:
+            deadline = min(d for data, d in self._clients.values())
+            return max(0., deadline - time.time())
 
-class _OldJobsEvent(object):
-    """Event that represents jobs ready for archival or expiry"""
-    def __init__(self, webservice):
-        self.webservice = webservice
+    def _accept(self):
+        conn, addr = self._sock.accept()
+        conn.setblocking(False)
+        self._clients[conn] = ([], time.time() + self._read_timeout)
 
-    def process(self):
-        self.webservice._process_old_jobs()
+    def _read_client(self, conn):
+        """Read data from the client; the message is complete once the
+           client closes the connection"""
+        try:
+            d = conn.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The client went away; use whatever we got
+            d = None
+        if d:
+            self._clients[conn][0].append(d)
+        else:
+            self._finish_client(conn)
 
+    def _finish_client(self, conn):
+        data, deadline = self._clients.pop(conn)
+        conn.close()
+        names = _parse_incoming_message(b''.join(data))
+        q = self._webservice._event_queue
+        q.put(_IncomingJobsEvent(self._webservice, names))
 
-class _OldJobs(_JobThread):
-    """Archive or expire old jobs"""
-    def run(self):
-        # Simply emit an OldJobsEvent every oldjob_interval
-        oldjob_interval = self._webservice._get_oldjob_interval()
-        while True:
-            time.sleep(oldjob_interval)
-            self._webservice._event_queue.put(_OldJobsEvent(self._webservice))
 
+def _parse_incoming_message(msg):
+    """Get the job names from "INCOMING <name>" message(s) sent by the
+       frontend. If the message cannot be parsed, return None (so that all
+       incoming jobs are checked)."""
+    try:
+        words = msg.decode('utf-8').split()
+    except UnicodeDecodeError:
+        return None
+    if not words or len(words) % 2 != 0 \
+       or any(w != 'INCOMING' for w in words[::2]):
+        return None
+    return set(words[1::2])
 
-class _CleanupIncomingJobs(_JobThread):
-    """Cleanup of abandoned incoming job directories"""
-    def run(self):
-        # Simply periodically emit a CleanupIncomingJobsEvent
-        interval = self._webservice._get_cleanup_incoming_job_times()[0]
-        while True:
-            time.sleep(interval)
-            self._webservice._event_queue.put(
-                              _CleanupIncomingJobsEvent(self._webservice))
+
+class _OldJobsEvent(object):
+    """Event that represents jobs ready for archival or expiry at the time
+       `due`. Once they have been handled, the next such event is scheduled
+       for when the next job is due. Events that have been superseded by an
+       earlier check (see WebService._schedule_old_jobs) do nothing."""
+    priority = _HOUSEKEEPING_PRIORITY
+    coalesce = True
+
+    def __init__(self, webservice, due=None):
+        self.webservice = webservice
+        self.due = due
+
+    def _is_current(self):
+        return self.due == self.webservice._old_jobs_due
+
+    def merge(self, other):
+        # Keep the current event if a superseded one is coalesced with it
+        if other._is_current():
+            self.due = other.due
+
+    def process(self):
+        if self._is_current():
+            self.webservice._process_old_jobs()
+            self.webservice._schedule_old_jobs()
 
 
 class _CompletedJobEvent(object):
     """Event to represent a job started by a Runner finishing"""
+    priority = _COMPLETION_PRIORITY
+
     def __init__(self, webservice, runner, runid, run_exception):
         self.webservice = webservice
         self.runner = runner
@@ -139,3 +299,72 @@ class _CompletedJobEvent(object):
         job = self.webservice._get_job_by_runner_id(self.runner, self.runid)
         if job:
             job._try_complete(self.webservice, self.run_exception)
+
+
+class _StateFileRecheckEvent(object):
+    """Event to check again whether a job has completed, if its Runner
+       reported that it finished but the job-state file did not (yet)
+       agree"""
+    priority = _COMPLETION_PRIORITY
+
+    def __init__(self, webservice, name, runner_id, deadline, delay):
+        self.webservice = webservice
+        self.name = name
+        self.runner_id = runner_id
+        self.deadline = deadline
+        self.delay = delay
+
+    def process(self):
+        self.webservice._deferred_completions.pop(self.runner_id, None)
+        job = self.webservice.get_job_by_name('RUNNING', self.name)
+        if job and job._metadata['runner_id'] == self.runner_id:
+            job._try_complete(self.webservice, recheck=self)
+
+
+class _JobHookEvent(object):
+    """Event to resume a job task once a hook has finished running in
+       a worker process"""
+    priority = _COMPLETION_PRIORITY
+
+    def __init__(self, webservice, task, hook, outcome):
+        self.webservice = webservice
+        self.task = task
+        self.hook = hook
+        self.outcome = outcome
+
+    def process(self):
+        self.webservice._finish_hook(self.task, self.hook, self.outcome)
+
+
+class _MoveWorker(_JobThread):
+    """Move job directories from a queue, and send an event when each
+       finishes"""
+    def __init__(self, webservice, queue):
+        _JobThread.__init__(self, webservice)
+        self._queue = queue
+
+    def run(self):
+        while True:
+            task, move = self._queue.get()
+            try:
+                outcome = (True,
+                           move.run(self._webservice._move_copy_workers))
+            except Exception as detail:
+                outcome = (False, detail)
+            self._webservice._event_queue.put(
+                _JobMoveEvent(self._webservice, task, move, outcome))
+
+
+class _JobMoveEvent(object):
+    """Event to resume a job task once its directory has been moved in
+       the background"""
+    priority = _COMPLETION_PRIORITY
+
+    def __init__(self, webservice, task, move, outcome):
+        self.webservice = webservice
+        self.task = task
+        self.move = move
+        self.outcome = outcome
+
+    def process(self):
+        self.webservice._finish_move(self.task, self.move, self.outcome)
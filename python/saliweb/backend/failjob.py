@@ -1,17 +1,27 @@
 import saliweb.backend
+import saliweb.backend.bulk
 from argparse import ArgumentParser
 import sys
 
 
+# States of jobs that have not yet finished, considered by default when
+# selecting jobs in bulk
+IN_FLIGHT_STATES = ('INCOMING', 'PREPROCESSING', 'RUNNING', 'POSTPROCESSING',
+                    'FINALIZING')
+
+
 def get_options():
     parser = ArgumentParser(
         description="Force the job(s) JOBNAME into the FAILED state. "
                     "This can only be done if the backend daemon is stopped "
                     "first. By default, the server admin will receive an "
                     "email for each failed job, just as if it failed "
-                    "\"normally\". This can be suppressed with the -n option.")
+                    "\"normally\". This can be suppressed with the -n option. "
+                    "To fail many jobs at once, JOBNAME can be a glob "
+                    "pattern such as 'job*', or can be omitted if --state, "
+                    "--user or --older-than is given.")
     parser.add_argument(
-        "jobnames", nargs="+", metavar="JOBNAME",
+        "jobnames", nargs="*", metavar="JOBNAME",
         help="Job(s) to fail")
 
     parser.add_argument(
@@ -21,8 +31,23 @@ def get_options():
     parser.add_argument(
         "-f", "--force", action="store_true",
         default=False, dest="force", help="Fail jobs without prompting")
+    parser.add_argument(
+        "-s", "--state", action="append", dest="states", default=None,
+        help="Only consider jobs in STATE (can be given multiple times). "
+             "By default, when selecting many jobs at once, only jobs that "
+             "have not yet finished (INCOMING, PREPROCESSING, RUNNING, "
+             "POSTPROCESSING or FINALIZING) are considered")
+    saliweb.backend.bulk.add_selection_options(parser)
+
+    args = parser.parse_args()
+    if not args.jobnames and not is_bulk(args):
+        parser.error("No jobs given")
+    return args
 
-    return parser.parse_args()
+
+def is_bulk(args):
+    return (args.states is not None
+            or saliweb.backend.bulk.is_bulk(args, args.jobnames))
 
 
 def fail_job(job, force, email):
@@ -35,6 +60,13 @@ def fail_job(job, force, email):
     job.admin_fail(email)
 
 
+def fail_jobs(web, jobs, force, email):
+    if not jobs or (not force
+                    and not saliweb.backend.bulk.confirm('Fail', jobs)):
+        return
+    saliweb.backend.bulk.fail_jobs(web, jobs, email)
+
+
 def check_daemon_running(web):
     pid = web.get_running_pid()
     if pid is not None:
@@ -55,6 +87,15 @@ def main(webservice):
     web = webservice.get_web_service(webservice.config)
     check_daemon_running(web)
     all_states = saliweb.backend._JobState.get_valid_states()
+    if is_bulk(args):
+        for state in args.states or []:
+            saliweb.backend._JobState(state)  # check for valid state name
+        states = args.states or list(IN_FLIGHT_STATES)
+        jobs = saliweb.backend.bulk.select_jobs(
+            web, states, args.jobnames, user=args.user,
+            older_than=args.older_than)
+        fail_jobs(web, jobs, args.force, args.email)
+        return
     for name in args.jobnames:
         job = find_job(web, name, all_states)
         if job:
@@ -25,6 +25,6 @@ def main(webservice):
         check_valid_state(state)
     web = webservice.get_web_service(webservice.config)
     for state in states:
-        for job in web.db._get_all_jobs_in_state(state,
-                                                 order_by='submit_time'):
+        for job in web.db._get_job_rows(state, order_by='submit_time',
+                                        stream=True):
             print("%-60s %s" % (job.name, state))
@@ -0,0 +1,73 @@
+from argparse import ArgumentParser
+import saliweb.backend
+import shutil
+import os
+
+
+def get_options():
+    parser = ArgumentParser(
+        description="Move the directories of existing jobs into the job "
+                    "directory layout (flat or sharded) selected by the "
+                    "'sharded' option in the [directories] section of the "
+                    "configuration file. Jobs stay in the same top-level "
+                    "directory. RUNNING jobs are not moved, since their "
+                    "cluster jobs may still be using their directories; "
+                    "they move to the new layout when they finish. "
+                    "The backend must be stopped first.")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        default=False, dest="dry_run",
+        help="Only show the directories that would be moved")
+    return parser.parse_args()
+
+
+def get_new_directory(config, name, directory):
+    """Get the directory that the named job, currently in `directory`,
+       should use in the configured layout."""
+    parent = os.path.dirname(os.path.normpath(directory))
+    shard = saliweb.backend._get_job_shard(name)
+    if parent.endswith(os.sep + shard):
+        topdir = parent[:-len(shard) - 1]
+    else:
+        topdir = parent
+    if config.sharded_directories:
+        topdir = os.path.join(topdir, shard)
+    return os.path.join(topdir, name)
+
+
+def get_moves(web):
+    """Get a list of (job, new directory) pairs for every job whose
+       directory is not in the configured layout."""
+    states = saliweb.backend._JobState.get_valid_states()
+    for state in ('EXPIRED', 'RUNNING'):
+        states.remove(state)
+    moves = []
+    for state in states:
+        for job in web.db._get_all_jobs_in_state(state):
+            if job.directory is None:
+                continue
+            new = get_new_directory(web.config, job.name, job.directory)
+            if new != os.path.normpath(job.directory):
+                moves.append((job, new))
+    return moves
+
+
+def main(webservice):
+    args = get_options()
+    web = webservice.get_web_service(webservice.config)
+    if web.get_running_pid() is not None:
+        raise ValueError("Cannot move job directories while the backend is "
+                         "running. Please stop the backend first")
+    moves = get_moves(web)
+    if not moves:
+        print("All job directories are in the configured layout.")
+    # Commit database changes in batches, so that all moved directories
+    # are recorded even if a later move fails
+    with web.db._unit_of_work(max_changes=100):
+        for job, new in moves:
+            print("%s -> %s" % (job.directory, new))
+            if not args.dry_run:
+                os.makedirs(os.path.dirname(new), exist_ok=True)
+                shutil.move(job.directory, new)
+                job._metadata['directory'] = new
+                job._sync_metadata()
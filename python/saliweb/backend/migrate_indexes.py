@@ -0,0 +1,26 @@
+from argparse import ArgumentParser
+
+
+def get_options():
+    parser = ArgumentParser(
+        description="Add any database indexes that are expected by the "
+                    "backend but missing from the live database tables. "
+                    "Indexes are built online, so this can be run while "
+                    "the backend daemon and web frontend are running.")
+    parser.add_argument(
+        "-n", "--dry-run", action="store_true",
+        default=False, dest="dry_run",
+        help="Only show the indexes that would be added")
+    return parser.parse_args()
+
+
+def main(webservice):
+    args = get_options()
+    web = webservice.get_web_service(webservice.config)
+    missing = web.db._get_missing_indexes()
+    if not missing:
+        print("All database indexes are present.")
+    for table, index in missing:
+        print(index.get_schema(table) + ';')
+        if not args.dry_run:
+            web.db._add_index(table, index)
@@ -0,0 +1,124 @@
+"""Moving of job directories, possibly between filesystems.
+   See :meth:`saliweb.backend.Job._change_state`."""
+
+import concurrent.futures
+import shutil
+import os
+
+
+def _copy_file_range(src, dst):
+    """Copy the contents of the file `src` to `dst` using copy_file_range,
+       which lets the kernel do the copy without passing the data through
+       user space (and, on some filesystems such as NFS 4.2, do the copy
+       on the server)."""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+
+
+def _copy_file(src, dst):
+    """Copy a single file, with its permissions and times."""
+    if hasattr(os, 'copy_file_range'):
+        try:
+            _copy_file_range(src, dst)
+        except OSError:
+            # Older kernels can't copy_file_range between filesystems
+            shutil.copyfile(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
+def _walk(topdir):
+    """Get the directories, symlinks and regular files (with their sizes)
+       under `topdir`, as paths relative to it."""
+    dirs, links, files = [], [], {}
+    for root, subdirs, fnames in os.walk(topdir):
+        rel = os.path.relpath(root, topdir)
+        for d in subdirs[:]:
+            if os.path.islink(os.path.join(root, d)):
+                # os.walk does not descend into symlinks to directories
+                subdirs.remove(d)
+                links.append(os.path.normpath(os.path.join(rel, d)))
+            else:
+                dirs.append(os.path.normpath(os.path.join(rel, d)))
+        for f in fnames:
+            path = os.path.join(root, f)
+            relpath = os.path.normpath(os.path.join(rel, f))
+            if os.path.islink(path):
+                links.append(relpath)
+            else:
+                files[relpath] = os.path.getsize(path)
+    return dirs, links, files
+
+
+def copy_tree(source, destination, workers):
+    """Copy the directory `source` to `destination` (which must not yet
+       exist), copying up to `workers` files in parallel. The copy is then
+       verified against the source; :exc:`OSError` is raised if any file
+       is missing or has the wrong size."""
+    dirs, links, files = _walk(source)
+    os.mkdir(destination)
+    for d in dirs:
+        os.mkdir(os.path.join(destination, d))
+    for link in links:
+        os.symlink(os.readlink(os.path.join(source, link)),
+                   os.path.join(destination, link))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        # list() so that any exceptions are raised here
+        list(executor.map(_copy_file,
+                          [os.path.join(source, f) for f in files],
+                          [os.path.join(destination, f) for f in files]))
+    # Copy directory times last, since adding files changes them
+    for d in reversed(dirs):
+        shutil.copystat(os.path.join(source, d),
+                        os.path.join(destination, d))
+    shutil.copystat(source, destination)
+    new_dirs, new_links, new_files = _walk(destination)
+    if (sorted(new_dirs) != sorted(dirs) or sorted(new_links) != sorted(links)
+            or new_files != files):
+        raise OSError("Copy of %s to %s does not match the original"
+                      % (source, destination))
+
+
+def _same_filesystem(path1, path2):
+    return os.stat(path1).st_dev == os.stat(path2).st_dev
+
+
+def get_partial_directory(destination):
+    """Get the hidden directory that a copy to `destination` is made in
+       until it is complete (see :func:`move_directory`)."""
+    return os.path.join(os.path.dirname(destination),
+                        '.' + os.path.basename(destination) + '.moving')
+
+
+def move_directory(source, destination, workers):
+    """Move the directory `source` to `destination`. If both are on the
+       same filesystem, the directory is simply renamed, and False is
+       returned. Otherwise, it is copied (see :func:`copy_tree`) and True
+       is returned; the source is left in place so that it can still be
+       used until the caller has recorded the new location, and it is
+       then the caller's responsibility to remove it. Either way, the
+       destination directory only appears once the move is complete."""
+    parent = os.path.dirname(destination)
+    os.makedirs(parent, exist_ok=True)
+    if _same_filesystem(source, parent):
+        os.rename(source, destination)
+        return False
+    # Copy to a hidden directory (ignored by the backend's sanity check)
+    # and rename it into place once it has been verified
+    partial = get_partial_directory(destination)
+    if os.path.exists(partial):
+        # Left over from an interrupted move
+        shutil.rmtree(partial)
+    try:
+        copy_tree(source, partial, workers)
+        os.rename(partial, destination)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return True
@@ -1,3 +1,4 @@
+import saliweb.backend.bulk
 from argparse import ArgumentParser
 import sys
 
@@ -5,18 +6,31 @@ import sys
 def get_options():
     parser = ArgumentParser(
         description="Take the given failed job(s), JOBNAME, and put "
-                    "them back in the incoming queue.")
+                    "them back in the incoming queue. To resubmit many "
+                    "jobs at once, JOBNAME can be a glob pattern such as "
+                    "'job*', or can be omitted if --user or --older-than "
+                    "is given.")
     parser.add_argument(
-        "jobs", nargs="+", metavar="JOBNAME",
+        "jobs", nargs="*", metavar="JOBNAME",
         help="Job(s) to resubmit")
+    saliweb.backend.bulk.add_selection_options(parser)
     args = parser.parse_args()
-    return args.jobs
+    if not args.jobs and not saliweb.backend.bulk.is_bulk(args, args.jobs):
+        parser.error("No jobs given")
+    return args
 
 
 def main(webservice):
-    names = get_options()
+    args = get_options()
     web = webservice.get_web_service(webservice.config)
-    for name in names:
+    if saliweb.backend.bulk.is_bulk(args, args.jobs):
+        jobs = saliweb.backend.bulk.select_jobs(
+            web, ['FAILED'], args.jobs, user=args.user,
+            older_than=args.older_than)
+        names = saliweb.backend.bulk.resubmit_jobs(web, jobs)
+        print("Resubmitted %d job(s)" % len(names))
+        return
+    for name in args.jobs:
         job = web.get_job_by_name('FAILED', name)
         if job:
             job.resubmit()
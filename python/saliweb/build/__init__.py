@@ -548,6 +548,9 @@ def _check_mysql(env):
     """Make sure that we can connect to the database as both the frontend and
        backend users."""
     c = env['config']
+    # Only MySQL databases can be checked here
+    if c.database.get('engine', 'mysql') != 'mysql':
+        return
     c._read_db_auth('back')
     backend = dict(c.database)
     c._read_db_auth('front')
@@ -558,9 +561,14 @@ def _check_mysql(env):
                              unix_socket=c.database['socket'],
                              passwd=backend['passwd'])
         cur = db.cursor()
-        for table in ('jobs', 'dependencies'):
+        tables = ['jobs', 'dependencies']
+        if c.oldjobs['history']:
+            tables.append('expired_jobs')
+        for table in tables:
             cur.execute('DESCRIBE ' + table)
             _check_mysql_schema(env, c, cur, table)
+            cur.execute('SHOW INDEX FROM ' + table)
+            _check_mysql_indexes(env, c, cur, table)
         cur.execute('SHOW GRANTS FOR CURRENT_USER')
         _check_mysql_grants(env, cur, c.database['db'], backend['user'],
                             'SELECT, INSERT, UPDATE, DELETE, CREATE, DROP, '
@@ -583,13 +591,18 @@ def _check_mysql(env):
         _check_mysql_grants(env, cur, c.database['db'], frontend['user'],
                             'SELECT, INSERT, UPDATE, DELETE',
                             table='dependencies')
+        if c.oldjobs['history']:
+            cur.execute('SHOW GRANTS FOR CURRENT_USER')
+            _check_mysql_grants(env, cur, c.database['db'], frontend['user'],
+                                'SELECT', table='expired_jobs')
     except (MySQLdb.OperationalError, MySQLdb.ProgrammingError) as detail:
         # Only complain about possible too-long DB usernames if MySQL
         # itself first complained
         _check_sql_username_length(env, frontend, 'front')
         _check_sql_username_length(env, backend, 'back')
         outfile = _generate_admin_mysql_script(c.database['db'], backend,
-                                               frontend)
+                                               frontend,
+                                               c.oldjobs['history'])
         print("""
 ** Could not query the jobs table in the %s database using both the
 ** frontend and backend users. The actual error message follows:
@@ -646,17 +659,16 @@ def _check_mysql_grants(env, cursor, database, user, grant, table=None):
     env.Exit(1)
 
 
-def _generate_admin_mysql_script(database, backend, frontend):
+def _generate_admin_mysql_script(database, backend, frontend,
+                                 history=False):
     d = saliweb.backend.Database(None)
     fd, outfile = tempfile.mkstemp()
     commands = """CREATE DATABASE %(database)s;
 GRANT DELETE,CREATE,DROP,INDEX,INSERT,SELECT,UPDATE ON %(database)s.*
     TO '%(backend_user)s'@'localhost' IDENTIFIED BY '%(backend_passwd)s';
 CREATE TABLE %(database)s.jobs (%(schema)s);
-CREATE INDEX state_index ON %(database)s.jobs (state);
 CREATE TABLE %(database)s.dependencies (%(depschema)s);
-CREATE INDEX child_index ON %(database)s.dependencies (child);
-CREATE INDEX parent_index ON %(database)s.dependencies (parent);
+%(indexes)s
 GRANT SELECT ON %(database)s.jobs to '%(frontend_user)s'@'localhost'
     IDENTIFIED BY '%(frontend_passwd)s';
 GRANT INSERT (name,user,passwd,directory,contact_email,url,submit_time)
@@ -667,7 +679,14 @@ GRANT SELECT,INSERT,UPDATE,DELETE ON %(database)s.dependencies
        'backend_passwd': backend['passwd'], 'frontend_user': frontend['user'],
        'frontend_passwd': frontend['passwd'],
        'schema': ', '.join(x.get_schema() for x in d._fields),
-       'depschema': ', '.join(x.get_schema() for x in d._dependfields)}
+       'depschema': ', '.join(x.get_schema() for x in d._dependfields),
+       'indexes': '\n'.join(i.get_schema('%s.%s' % (database, table)) + ';'
+                            for table, i in d._get_indexes())}
+    if history:
+        schema = ', '.join(x.get_schema() for x in d._historyfields)
+        commands += "CREATE TABLE %s.expired_jobs (%s);\n" % (database, schema)
+        commands += ("GRANT SELECT ON %s.expired_jobs to '%s'@'localhost';\n"
+                     % (database, frontend['user']))
     commands = commands.encode('ascii')
     os.write(fd, commands)
     os.close(fd)
@@ -675,17 +694,27 @@ GRANT SELECT,INSERT,UPDATE,DELETE ON %(database)s.dependencies
     return outfile
 
 
-def _check_mysql_schema(env, config, cursor, table):
+def _get_backend_database(config):
+    """Get a Database with the fields the backend expects, given the
+       web service configuration."""
     d = saliweb.backend.Database(None)
     if config.track_hostname:
         d.set_track_hostname()
+    if config.backend['move_workers'] > 0:
+        d.set_background_moves()
+    return d
+
+
+def _check_mysql_schema(env, config, cursor, table):
+    d = _get_backend_database(config)
     dbfields = []
     for row in cursor:
         dbfields.append(saliweb.backend.MySQLField(row[0], row[1].upper(),
                                                    null=row[2], key=row[3],
                                                    default=row[4]))
 
-    fields = {'jobs': d._fields, 'dependencies': d._dependfields}[table]
+    fields = {'jobs': d._fields, 'dependencies': d._dependfields,
+              'expired_jobs': d._historyfields}[table]
     for dbfield, backfield in zip(dbfields, fields):
         dbfield.index = backfield.index  # Ignore differences in indexes here
         if dbfield != backfield:
@@ -719,6 +748,23 @@ def _check_mysql_schema(env, config, cursor, table):
         env.Exit(1)
 
 
+def _check_mysql_indexes(env, config, cursor, table):
+    d = _get_backend_database(config)
+    dbindexes = saliweb.backend.engines._parse_mysql_indexes(cursor)
+    missing = d._get_missing_table_indexes(
+        [index for t, index in d._get_indexes() if t == table], dbindexes)
+    if missing:
+        print("""
+** WARNING: The '%s' database table is missing indexes expected by the
+** backend, which will slow down the backend's queries. They can be added
+** to the live table by running the migrate_indexes.py admin tool once the
+** web service is installed (any existing index with the same name but
+** different fields will be replaced). The missing indexes are:
+   %s
+""" % (table, ';\n   '.join(i.get_schema(table) for i in missing)),
+              file=sys.stderr)
+
+
 def _install_config(env):
     config = env['config']
     env['instconfigfile'] = os.path.join(
@@ -777,7 +823,10 @@ def _make_script(env, target, source):
         print("#!/usr/bin/python%d" % sys.version_info[0], file=f)
         print("import webservice", file=f)
         print("import saliweb.backend." + name, file=f)
-        print("saliweb.backend.%s.main(webservice)" % name, file=f)
+        # Guard the main body, since worker processes that run job hooks
+        # import this script as a module
+        print("\nif __name__ == '__main__':", file=f)
+        print("    saliweb.backend.%s.main(webservice)" % name, file=f)
     env.Execute(Chmod(target[0], 0o700))
 
 
@@ -836,7 +885,7 @@ def _InstallAdminTools(env, tools=None):
     if tools is None:
         # todo: this list should be auto-generated from backend
         tools = ['resubmit', 'service', 'deljob', 'failjob', 'delete_all_jobs',
-                 'list_jobs']
+                 'list_jobs', 'migrate_indexes', 'migrate_directories']
     for bin in tools:
         env.Command(os.path.join(env['bindir'], bin + '.py'), None,
                     _make_script)
@@ -395,6 +395,12 @@ def get_db():
     return flask.g.db_conn
 
 
+def _use_expired_history():
+    """Return True if expired jobs are moved to a separate history table"""
+    history = flask.current_app.config.get('OLDJOBS_HISTORY', 'false')
+    return history.lower() in ('1', 'yes', 'true', 'on')
+
+
 def get_completed_job(name, passwd, still_running_template=None):
     """Create and return a new :class:`CompletedJob` for a given URL.
        If the job is not valid (e.g. incorrect password) an exception is
@@ -421,6 +427,11 @@ def get_completed_job(name, passwd, still_running_template=None):
     c.execute('SELECT * FROM jobs WHERE name=%s AND passwd=%s',
               (make_ascii(name), make_ascii(passwd)))
     job_row = c.fetchone()
+    if not job_row and _use_expired_history():
+        c.execute('SELECT name FROM expired_jobs WHERE name=%s AND passwd=%s',
+                  (make_ascii(name), make_ascii(passwd)))
+        if c.fetchone():
+            job_row = {'state': 'EXPIRED'}
     if not job_row:
         raise _ResultsBadJobError('Job does not exist, or wrong password')
     elif job_row['state'] in ('EXPIRED', 'ARCHIVED'):
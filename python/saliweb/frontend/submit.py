@@ -6,12 +6,22 @@ import socket
 import fcntl
 import string
 import datetime
+import saliweb
+
+
+def _use_sharded_directories():
+    """Return True if job directories use the sharded (ab/cd/name) layout"""
+    sharded = flask.current_app.config.get('DIRECTORIES_SHARDED', 'false')
+    return sharded.lower() in ('1', 'yes', 'true', 'on')
 
 
 def _get_job_directory(job_name):
     """Get the full path to the incoming directory for the given job name"""
     config = flask.current_app.config
-    return os.path.join(config['DIRECTORIES_INCOMING'], job_name)
+    incoming = config['DIRECTORIES_INCOMING']
+    if _use_sharded_directories():
+        incoming = os.path.join(incoming, saliweb._get_job_shard(job_name))
+    return os.path.join(incoming, job_name)
 
 
 def _sanitize_job_name(job_name):
@@ -36,13 +46,23 @@ def _get_trial_job_names(user_job_name):
 def _try_job_name(job_name, cur):
     """Determine if a new job name is acceptable and unique. If it is, return
        the job directory; otherwise, return None"""
+    from . import _use_expired_history
+
     def is_job_in_db():
         cur.execute("SELECT COUNT(name) FROM jobs WHERE name=%s", (job_name,))
-        return cur.fetchone()[0] > 0
+        if cur.fetchone()[0] > 0:
+            return True
+        # Expired job names cannot be reused either
+        if _use_expired_history():
+            cur.execute("SELECT COUNT(name) FROM expired_jobs WHERE name=%s",
+                        (job_name,))
+            return cur.fetchone()[0] > 0
+        return False
 
     job_dir = _get_job_directory(job_name)
     if not os.path.exists(job_dir) and not is_job_in_db():
         try:
+            os.makedirs(os.path.dirname(job_dir), exist_ok=True)
             os.mkdir(job_dir)
         except FileExistsError:
             # Directory may have been made between exists() check and mkdir()
@@ -3,6 +3,11 @@
 OperationalError = 'Dummy MySQL OperationalError'
 
 
+class cursors(object):
+    class SSCursor(object):
+        pass
+
+
 class DummyCursor(object):
     def __init__(self, sql):
         self.sql = sql
@@ -0,0 +1,84 @@
+"""Benchmark the database traffic generated by a job's lifecycle.
+
+Runs a number of jobs through the full lifecycle (INCOMING through EXPIRED)
+using the in-memory SQLite stand-in for the database, and reports the number
+of statements, bytes sent and statement time per job. For comparison, the
+same is done with every column written on each update (as was the case
+before per-field change tracking in _JobMetadata).
+
+Run with
+    PYTHONPATH=../../python python bench_job_lifecycle.py
+"""
+
+import time
+import os
+import saliweb.backend
+from memory_database import MemoryDatabase
+import testutil
+import test_job
+from test_job import add_incoming_job, setup_webservice, cleanup_webservice
+
+
+class CountingDatabase(MemoryDatabase):
+    """Database that keeps statistics on all statements executed"""
+    def _connect(self, config):
+        MemoryDatabase._connect(self, config)
+        self.stats = {'statements': 0, 'bytes': 0, 'time': 0.}
+
+    def _execute(self, query, args=(), stream=False):
+        self.stats['statements'] += 1
+        self.stats['bytes'] += len(query) + sum(len(str(a)) for a in args
+                                                if a is not None)
+        start = time.perf_counter()
+        c = MemoryDatabase._execute(self, query, args, stream)
+        self.stats['time'] += time.perf_counter() - start
+        return c
+
+
+def run_lifecycle(njobs):
+    db, conf, web, tmpdir = setup_webservice(archive='0h', expire='0h')
+    stats = web.db.stats
+    stats.update(statements=0, bytes=0, time=0.)
+    conf.limits['running'] = njobs
+    for i in range(njobs):
+        add_incoming_job(db, 'job%d' % i)
+        # Add a large failure message and extra field to every job, as a
+        # worst case
+        db._execute("UPDATE jobs SET failure=?, testfield=? WHERE name=?",
+                    ('x' * 10000, 'y' * 1000, 'job%d' % i))
+    stats.update(statements=0, bytes=0, time=0.)
+    web._process_incoming_jobs()
+    for job in list(db._get_all_jobs_in_state('RUNNING')):
+        with open(os.path.join(job.directory, 'job-state'), 'w') as fh:
+            fh.write('DONE')
+    web._process_completed_jobs()
+    # Database timestamps have a resolution of one second
+    time.sleep(1.1)
+    web._process_old_jobs()
+    time.sleep(1.1)
+    web._process_old_jobs()
+    assert len(list(db._get_all_jobs_in_state('EXPIRED'))) == njobs
+    result = dict(stats)
+    cleanup_webservice(conf, tmpdir)
+    return result
+
+
+def main():
+    njobs = 50
+    test_job.MemoryDatabase = CountingDatabase
+    orig_dirty_keys = saliweb.backend._JobMetadata.dirty_keys
+    for name in ('all fields', 'changed fields'):
+        if name == 'all fields':
+            saliweb.backend._JobMetadata.dirty_keys = \
+                lambda self: list(self.keys())
+        else:
+            saliweb.backend._JobMetadata.dirty_keys = orig_dirty_keys
+        with testutil.temp_working_dir():
+            stats = run_lifecycle(njobs)
+        print("%-15s %6.1f statements, %9.1f bytes, %8.1f us per job"
+              % (name, stats['statements'] / njobs, stats['bytes'] / njobs,
+                 stats['time'] * 1e6 / njobs))
+
+
+if __name__ == '__main__':
+    main()
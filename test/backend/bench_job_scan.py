@@ -0,0 +1,62 @@
+"""Benchmark bulk scans of the job table.
+
+Fills the in-memory SQLite stand-in for the database with a large number of
+completed jobs, then reads the directory of every job (as the filesystem
+sanity check does), both as full Job objects and as lightweight rows from
+Database._get_job_rows. Reports the time per job of a streamed scan, and the
+peak memory needed to hold all results at once.
+
+Run with
+    PYTHONPATH=../../python python bench_job_scan.py [number of jobs]
+"""
+
+import sys
+import time
+import tracemalloc
+import datetime
+import saliweb.backend
+from memory_database import MemoryDatabase
+
+
+def make_database(njobs):
+    db = MemoryDatabase(saliweb.backend.Job)
+    db._connect(None)
+    db._create_tables()
+    now = datetime.datetime(2020, 1, 1)
+    db.conn.executemany(
+        "INSERT INTO jobs(name,state,submit_time,directory,url) "
+        "VALUES(?,?,?,?,?)",
+        (('job%d' % i, 'COMPLETED', now, '/completed/job%d' % i,
+          'http://test/job%d' % i) for i in range(njobs)))
+    db.conn.commit()
+    return db
+
+
+def scan_jobs(db, stream):
+    return db._get_all_jobs_in_state('COMPLETED', fields=['directory'],
+                                     stream=stream)
+
+
+def scan_rows(db, stream):
+    return db._get_job_rows('COMPLETED', fields=['directory'], stream=stream)
+
+
+def main():
+    njobs = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    db = make_database(njobs)
+    for name, scan in (('Job objects', scan_jobs), ('rows', scan_rows)):
+        start = time.perf_counter()
+        for job in scan(db, stream=True):
+            job.directory
+        elapsed = time.perf_counter() - start
+        tracemalloc.start()
+        jobs = list(scan(db, stream=False))
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del jobs
+        print("%-12s %7.2f us per job scanned, %7.1f bytes per job held"
+              % (name, elapsed * 1e6 / njobs, float(peak) / njobs))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ class Config(saliweb.backend.Config):
     def __init__(self, fh):
         saliweb.backend.Config.__init__(self, fh)
         self.__tmpdir = tempfile.mkdtemp()
+        # Copies passed to hook worker processes don't own the directory
+        self.__pid = os.getpid()
         self._mailer = os.path.join(self.__tmpdir, 'mailer')
         self.__mailoutput = os.path.join(self.__tmpdir, 'output')
         with open(self._mailer, 'w') as f:
@@ -22,7 +24,8 @@ with open('%s', 'w') as fh:
 
     def __del__(self):
         try:
-            shutil.rmtree(self.__tmpdir)
+            if self.__pid == os.getpid():
+                shutil.rmtree(self.__tmpdir)
         except AttributeError:
             pass
 
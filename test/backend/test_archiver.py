@@ -0,0 +1,136 @@
+import unittest
+import os
+import sys
+import tarfile
+from saliweb.backend.archiver import pack_directory, get_archive_name
+import saliweb.backend.archiver
+import testutil
+
+
+def make_job_directory(topdir):
+    os.mkdir(topdir)
+    os.mkdir(os.path.join(topdir, 'subdir'))
+    for fname in ('input', 'subdir/output'):
+        with open(os.path.join(topdir, fname), 'w') as fh:
+            fh.write('test ' + fname)
+    os.symlink('input', os.path.join(topdir, 'link'))
+
+
+class ArchiverTest(unittest.TestCase):
+    """Check packing of archived job directories"""
+
+    def check_pack(self, compression, mode):
+        with testutil.temp_dir() as tmpdir:
+            jobdir = os.path.join(tmpdir, 'job1')
+            make_job_directory(jobdir)
+            pack_directory(jobdir, compression)
+            archive = get_archive_name(compression)
+            self.assertEqual(sorted(os.listdir(jobdir)),
+                             sorted([archive, 'archive.index']))
+            with open(os.path.join(jobdir, 'archive.index')) as fh:
+                index = [line.rstrip('\n').split('\t') for line in fh]
+            self.assertEqual([(i[0], i[3]) for i in index],
+                             [('f', 'input'), ('l', 'link'), ('d', 'subdir'),
+                              ('f', 'subdir/output')])
+            self.assertEqual(index[0][1], '10')
+            if mode is None:
+                return
+            with tarfile.open(os.path.join(jobdir, archive), mode) as tar:
+                self.assertEqual(sorted(tar.getnames()),
+                                 ['input', 'link', 'subdir',
+                                  'subdir/output'])
+                fh = tar.extractfile('subdir/output')
+                self.assertEqual(fh.read(), b'test subdir/output')
+
+    def test_pack_gzip(self):
+        """Test pack_directory() with gzip compression"""
+        self.check_pack('gzip', 'r:gz')
+
+    def test_pack_xz(self):
+        """Test pack_directory() with xz compression"""
+        self.check_pack('xz', 'r:xz')
+
+    def test_pack_zstd(self):
+        """Test pack_directory() with zstd compression"""
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            sys.stderr.write("test skipped: zstandard module not "
+                             "installed: ")
+            return
+        self.check_pack('zstd', None)
+
+    def test_pack_leftovers(self):
+        """Test pack_directory() with files left by an interrupted pack"""
+        with testutil.temp_dir() as tmpdir:
+            jobdir = os.path.join(tmpdir, 'job1')
+            make_job_directory(jobdir)
+            token = '0123456789abcdef' * 2
+            for name in ('.saliweb-pack-%s.tar.gz' % token,
+                         '.saliweb-pack-%s.tar.xz' % token,
+                         '.saliweb-pack-%s.index' % token):
+                with open(os.path.join(jobdir, name), 'w') as fh:
+                    fh.write('garbage')
+            # Similar-looking job files should be kept
+            for name in ('.archive.tar.gz', '.archive.index',
+                         '.saliweb-pack-foo.index'):
+                with open(os.path.join(jobdir, name), 'w') as fh:
+                    fh.write('job output')
+            pack_directory(jobdir, 'gzip')
+            self.assertEqual(sorted(os.listdir(jobdir)),
+                             ['archive.index', 'archive.tar.gz'])
+            with tarfile.open(os.path.join(jobdir, 'archive.tar.gz')) as tar:
+                self.assertEqual(sorted(tar.getnames()),
+                                 ['.archive.index', '.archive.tar.gz',
+                                  '.saliweb-pack-foo.index', 'input',
+                                  'link', 'subdir', 'subdir/output'])
+
+    def test_pack_collision(self):
+        """Test pack_directory() with job files named like the archive"""
+        for name in ('archive.tar.gz', 'archive.index'):
+            with testutil.temp_dir() as tmpdir:
+                jobdir = os.path.join(tmpdir, 'job1')
+                make_job_directory(jobdir)
+                with open(os.path.join(jobdir, name), 'w') as fh:
+                    fh.write('job output')
+                self.assertRaises(FileExistsError, pack_directory, jobdir,
+                                  'gzip')
+                # Directory should be unchanged
+                self.assertEqual(sorted(os.listdir(jobdir)),
+                                 sorted(['input', 'link', 'subdir', name]))
+                with open(os.path.join(jobdir, name)) as fh:
+                    self.assertEqual(fh.read(), 'job output')
+                if name != 'archive.index':
+                    # Other compressions can still be used
+                    pack_directory(jobdir, 'xz')
+                    with tarfile.open(os.path.join(jobdir,
+                                                   'archive.tar.xz')) as tar:
+                        self.assertIn(name, tar.getnames())
+
+    def test_pack_failure(self):
+        """Test pack_directory() failure"""
+        def bad_index_line(tarinfo):
+            raise OSError("read error")
+        with testutil.temp_dir() as tmpdir:
+            jobdir = os.path.join(tmpdir, 'job1')
+            make_job_directory(jobdir)
+            old = saliweb.backend.archiver._index_line
+            try:
+                saliweb.backend.archiver._index_line = bad_index_line
+                self.assertRaises(OSError, pack_directory, jobdir, 'gzip')
+            finally:
+                saliweb.backend.archiver._index_line = old
+            # Directory should be unchanged
+            self.assertEqual(sorted(os.listdir(jobdir)),
+                             ['input', 'link', 'subdir'])
+
+    def test_pack_empty(self):
+        """Test pack_directory() with an empty directory"""
+        with testutil.temp_dir() as tmpdir:
+            pack_directory(tmpdir, 'gzip')
+            with tarfile.open(os.path.join(tmpdir, 'archive.tar.gz')) as tar:
+                self.assertEqual(tar.getnames(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
 import saliweb.backend
 import unittest
+import sys
+import os
+from unittest import mock
 
 
 class Tets(unittest.TestCase):
@@ -8,6 +11,15 @@ class Tets(unittest.TestCase):
         self.assertRaises(saliweb.backend._SigTermError,
                           saliweb.backend._sigterm_handler, None, None)
 
+    def test_get_job_shard(self):
+        """Test _get_job_shard"""
+        shard = os.path.join('1b', 'a4')
+        self.assertEqual(saliweb.backend._get_job_shard('new-job'), shard)
+        # Older Pythons do not support the usedforsecurity argument
+        with mock.patch.object(sys, 'version_info', (3, 8)):
+            self.assertEqual(saliweb.backend._get_job_shard('new-job'),
+                             shard)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,143 @@
+import unittest
+import os
+import sys
+import socket
+import datetime
+import saliweb.backend.bulk
+from test_job import setup_webservice, cleanup_webservice, add_failed_job
+from io import StringIO
+import testutil
+
+
+def set_job_owner(db, name, user, age_days):
+    submit = testutil._utcnow() - datetime.timedelta(days=age_days)
+    db.conn.execute("UPDATE jobs SET user=?, submit_time=? WHERE name=?",
+                    (user, submit, name))
+    db.conn.commit()
+
+
+class BulkTest(unittest.TestCase):
+    """Check bulk operations on jobs"""
+
+    def test_is_bulk(self):
+        """Test is_bulk()"""
+        class Args(object):
+            user = older_than = None
+        args = Args()
+        self.assertFalse(saliweb.backend.bulk.is_bulk(args, ['job1']))
+        self.assertTrue(saliweb.backend.bulk.is_bulk(args, ['job*']))
+        self.assertTrue(saliweb.backend.bulk.is_bulk(args, ['job?']))
+        args.user = 'foo'
+        self.assertTrue(saliweb.backend.bulk.is_bulk(args, []))
+
+    def test_confirm(self):
+        """Test confirm()"""
+        oldout, oldin = sys.stdout, sys.stdin
+        try:
+            for reply, result in (('y\n', True), ('n\n', False), ('', False)):
+                sys.stdout = StringIO()
+                sys.stdin = StringIO(reply)
+                self.assertEqual(saliweb.backend.bulk.confirm(
+                    'Delete', ['job1', 'job2']), result)
+                self.assertEqual(sys.stdout.getvalue(), 'Delete 2 job(s)? ')
+        finally:
+            sys.stdout, sys.stdin = oldout, oldin
+
+    def test_select_jobs(self):
+        """Test select_jobs()"""
+        db, conf, web, tmpdir = setup_webservice()
+        for name in ('job1', 'job2', 'other'):
+            add_failed_job(db, name)
+        set_job_owner(db, 'job1', 'foo', 10)
+        set_job_owner(db, 'other', 'foo', 1)
+
+        def select(*args, **kwargs):
+            return sorted(j.name for j in saliweb.backend.bulk.select_jobs(
+                web, *args, **kwargs))
+        self.assertEqual(select(['FAILED'], []), ['job1', 'job2', 'other'])
+        self.assertEqual(select(['FAILED', 'RUNNING'], ['job*', 'other']),
+                         ['job1', 'job2', 'other'])
+        self.assertEqual(select(['FAILED'], ['job*']), ['job1', 'job2'])
+        self.assertEqual(select(['FAILED'], ['job[!1]']), ['job2'])
+        self.assertEqual(select(['FAILED'], ['?ther']), ['other'])
+        self.assertEqual(select(['FAILED'], ['JOB*']), [])
+        self.assertEqual(select(['FAILED'], [], user='foo'),
+                         ['job1', 'other'])
+        self.assertEqual(select(['FAILED'], [],
+                                older_than=datetime.timedelta(days=5)),
+                         ['job1'])
+        self.assertEqual(select(['RUNNING'], []), [])
+        saliweb.backend.bulk.delete_jobs(
+            web, saliweb.backend.bulk.select_jobs(web, ['FAILED'], []))
+        cleanup_webservice(conf, tmpdir)
+
+    def test_delete_jobs(self):
+        """Test delete_jobs()"""
+        db, conf, web, tmpdir = setup_webservice()
+        dirs = [add_failed_job(db, 'job%d' % i) for i in range(20)]
+        with open(os.path.join(dirs[0], 'output'), 'w') as fh:
+            fh.write('test')
+        # Directory already deleted should be OK
+        os.rmdir(dirs[1])
+        jobs = saliweb.backend.bulk.select_jobs(web, ['FAILED'], [])
+        # Job that cannot be deleted
+        job2, = [j for j in jobs if j.name == 'job2']
+        job2._metadata['directory'] = os.path.join(tmpdir, 'not-a-dir')
+        with open(job2.directory, 'w') as fh:
+            fh.write('test')
+        os.rmdir(dirs.pop(2))
+        errors = saliweb.backend.bulk.delete_jobs(web, jobs, workers=4)
+        self.assertEqual([job.name for job, err in errors], ['job2'])
+        self.assertEqual([j.name for j in db._get_all_jobs_in_state('FAILED')],
+                         ['job2'])
+        for d in dirs:
+            self.assertFalse(os.path.exists(d))
+        os.unlink(os.path.join(tmpdir, 'not-a-dir'))
+        db._execute("DELETE FROM jobs")
+        cleanup_webservice(conf, tmpdir)
+
+    @testutil.run_in_tempdir
+    def test_resubmit_jobs(self):
+        """Test resubmit_jobs()"""
+        db, conf, web, tmpdir = setup_webservice()
+        for name in ('job1', 'job2'):
+            add_failed_job(db, name)
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.bind(conf.socket)
+        s.listen(5)
+        jobs = saliweb.backend.bulk.select_jobs(web, ['FAILED'], [])
+        names = saliweb.backend.bulk.resubmit_jobs(web, jobs)
+        self.assertEqual(sorted(names), ['job1', 'job2'])
+        self.assertEqual(db._count_all_jobs_in_state('INCOMING'), 2)
+        # Backend should have been woken up only once, for both jobs
+        s.settimeout(1.)
+        conn, addr = s.accept()
+        msg = conn.recv(4096).decode('utf-8')
+        self.assertEqual(sorted(msg.split()),
+                         ['INCOMING', 'INCOMING', 'job1', 'job2'])
+        conn.close()
+        self.assertRaises(socket.timeout, s.accept)
+        s.close()
+        for name in names:
+            os.rmdir(os.path.join(conf.directories['PREPROCESSING'], name))
+        cleanup_webservice(conf, tmpdir)
+
+    def test_fail_jobs(self):
+        """Test fail_jobs()"""
+        db, conf, web, tmpdir = setup_webservice()
+        for name in ('job1', 'job2'):
+            add_failed_job(db, name)
+        jobs = saliweb.backend.bulk.select_jobs(web, ['FAILED'], [])
+        for job in jobs:
+            db._change_job_state(job._metadata, 'FAILED', 'COMPLETED')
+        jobs = saliweb.backend.bulk.select_jobs(web, ['COMPLETED'], [])
+        saliweb.backend.bulk.fail_jobs(web, jobs, email=False)
+        jobs = saliweb.backend.bulk.select_jobs(web, ['FAILED'], [])
+        self.assertEqual(sorted(j.name for j in jobs), ['job1', 'job2'])
+        self.assertIn('Python exception', jobs[0]._metadata['failure'])
+        saliweb.backend.bulk.delete_jobs(web, jobs)
+        cleanup_webservice(conf, tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
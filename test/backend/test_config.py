@@ -4,6 +4,8 @@ from io import StringIO
 import config
 from email.mime.text import MIMEText
 import re
+import os
+import testutil
 
 basic_config = """
 [general]
@@ -59,7 +61,12 @@ class ConfigTest(unittest.TestCase):
         self.assertEqual(conf.oldjobs['expire'].days, 90)
         self.assertEqual(conf.admin_email, 'test@salilab.org')
         self.assertEqual(conf.limits['running'], 5)
+        self.assertEqual(conf.backend['hook_workers'], 0)
+        self.assertEqual(conf.backend['move_workers'], 0)
+        self.assertEqual(conf.backend['oldjob_workers'], 0)
+        self.assertEqual(conf.backend['group_commit'], 1)
         self.assertNotIn('concurrent_tasks', conf.limits)
+        self.assertNotIn('running_tasks', conf.limits)
         self.assertFalse(conf.track_hostname)
         self.assertEqual(len(conf.frontends.keys()), 2)
         self.assertEqual(conf.frontends['foo']['service_name'], 'Foo')
@@ -76,6 +83,73 @@ class ConfigTest(unittest.TestCase):
         conf = get_config(extra='[limits]\nconcurrent_tasks: 10')
         self.assertEqual(conf.limits['concurrent_tasks'], 10)
 
+        conf = get_config(extra='[limits]\nrunning_tasks: 100')
+        self.assertEqual(conf.limits['running_tasks'], 100)
+
+        conf = Config(StringIO(
+            (basic_config % ('', '', '3h', '90d')).replace(
+                'check_minutes: 10', 'check_minutes: 10\nhook_workers: 4')))
+        self.assertEqual(conf.backend['hook_workers'], 4)
+        conf = Config(StringIO(
+            (basic_config % ('', '', '3h', '90d')).replace(
+                'check_minutes: 10', 'check_minutes: 10\ngroup_commit: 50')))
+        self.assertEqual(conf.backend['group_commit'], 50)
+        conf = Config(StringIO(
+            (basic_config % ('', '', '3h', '90d')).replace(
+                'check_minutes: 10', 'check_minutes: 10\nmove_workers: 2')))
+        self.assertEqual(conf.backend['move_workers'], 2)
+        conf = Config(StringIO(
+            (basic_config % ('', '', '3h', '90d')).replace(
+                'check_minutes: 10', 'check_minutes: 10\noldjob_workers: 4')))
+        self.assertEqual(conf.backend['oldjob_workers'], 4)
+
+        self.assertFalse(get_config().oldjobs['history'])
+        conf = get_config(expire='90d\nhistory: True')
+        self.assertTrue(conf.oldjobs['history'])
+
+        self.assertIsNone(get_config().oldjobs['compress'])
+        conf = get_config(expire='90d\ncompress: GZIP')
+        self.assertEqual(conf.oldjobs['compress'], 'gzip')
+        conf = get_config(expire='90d\ncompress: none')
+        self.assertIsNone(conf.oldjobs['compress'])
+        self.assertRaises(ConfigError, get_config,
+                          expire='90d\ncompress: garbage')
+        try:
+            import zstandard  # noqa: F401
+            self.assertEqual(get_config(
+                expire='90d\ncompress: zstd').oldjobs['compress'], 'zstd')
+        except ImportError:
+            self.assertRaises(ConfigError, get_config,
+                              expire='90d\ncompress: zstd')
+
+    def test_database_engine(self):
+        """Check choice of database engine"""
+        conf = get_config()
+        self.assertEqual(conf.database['engine'], 'mysql')
+        self.assertEqual(conf.database['socket'],
+                         '/var/lib/mysql/mysql.sock')
+        db_config = basic_config.replace('db: testdb',
+                                         'db: testdb\nengine: %s')
+        conf = Config(StringIO(db_config % ('', 'PostgreSQL', '', '3h',
+                                            '90d')))
+        self.assertEqual(conf.database['engine'], 'postgresql')
+        self.assertEqual(conf.database['socket'], '/var/run/postgresql')
+        conf = Config(StringIO(db_config % ('', 'sqlite', '', '3h', '90d')))
+        self.assertEqual(conf.database['engine'], 'sqlite')
+        self.assertEqual(conf.database['db'], 'testdb')
+        self.assertIsNone(conf.database['socket'])
+        # Relative sqlite database paths are relative to the config file
+        with testutil.temp_dir() as tmpdir:
+            fname = os.path.join(tmpdir, 'live.conf')
+            with open(fname, 'w') as fh:
+                fh.write(db_config % ('', 'sqlite', '', '3h', '90d'))
+            conf = Config(fname)
+            self.assertEqual(conf.database['db'],
+                             os.path.join(tmpdir, 'testdb'))
+        self.assertRaises(ConfigError, Config,
+                          StringIO(db_config % ('', 'garbage', '', '3h',
+                                                '90d')))
+
     def test_send_email(self):
         """Check Config.send_email()"""
         for to in ['testto', ['testto'], ('testto',)]:
@@ -109,6 +183,18 @@ class ConfigTest(unittest.TestCase):
         conf = get_config(extradir='running: /running')
         self.assertEqual(conf.directories['POSTPROCESSING'], '/running')
 
+    def test_sharded_directories(self):
+        """Check Config sharded directory layout"""
+        conf = get_config(extradir='completed: /foo')
+        self.assertFalse(conf.sharded_directories)
+        self.assertEqual(conf._get_job_directory('COMPLETED', 'job1'),
+                         '/foo/job1')
+        conf = get_config(extradir='completed: /foo/\nsharded: True')
+        self.assertTrue(conf.sharded_directories)
+        self.assertNotIn('sharded', conf.directories)
+        self.assertEqual(conf._get_job_directory('COMPLETED', 'job1'),
+                         '/foo/0f/a5/job1')
+
     def test_time_deltas(self):
         """Check parsing of time deltas in config files"""
         # Check integer hours, days, months, years
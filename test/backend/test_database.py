@@ -4,8 +4,11 @@ try:
 except ImportError:
     from pysqlite2 import dbapi2 as sqlite3
 import datetime
-from saliweb.backend import Job, MySQLField
+import os
+from unittest import mock
+from saliweb.backend import Job, MySQLField, MySQLIndex
 import saliweb.backend
+from saliweb.backend.engines import SQLiteEngine
 from memory_database import MemoryDatabase
 import testutil
 
@@ -78,7 +81,8 @@ class DatabaseTest(unittest.TestCase):
         config = DummyConfig()
         db = saliweb.backend.Database(Job)
         db._connect(config)
-        self.assertEqual(db._OperationalError, 'Dummy MySQL OperationalError')
+        self.assertIsInstance(db._engine, saliweb.backend.engines.MySQLEngine)
+        self.assertEqual(db._engine.errors, ('Dummy MySQL OperationalError',))
         self.assertEqual(db._placeholder, '%s')
         self.assertEqual(db.config, config)
         self.assertEqual(
@@ -116,12 +120,96 @@ class DatabaseTest(unittest.TestCase):
         for bad_index in ('GARBAGE', 'state', 'name_index'):
             self.assertRaises(sqlite3.OperationalError, c.execute,
                               'DROP INDEX ' + bad_index)
+        for index in ('runner_id_index', 'state_submit_index',
+                      'state_archive_index', 'state_expire_index',
+                      'child_index', 'parent_index'):
+            c.execute('DROP INDEX ' + index)
         c.execute('DROP TABLE jobs')
         c.execute('DROP TABLE dependencies')
         self.assertRaises(sqlite3.OperationalError, c.execute,
                           'DROP TABLE GARBAGE')
         db.conn.commit()
 
+    def test_add_index(self):
+        """Test Database.add_index()"""
+        db = MemoryDatabase(Job)
+        db.add_index(MySQLIndex('user_email_index', ['user', 'contact_email']))
+        db._connect(None)
+        db._create_tables()
+        indexes = db._get_table_indexes('jobs')
+        self.assertEqual(indexes['user_email_index'],
+                         ('user', 'contact_email'))
+        self.assertEqual(indexes['state_submit_index'],
+                         ('state', 'submit_time'))
+        self.assertEqual(indexes['state_index'], ('state',))
+        self.assertNotIn('name_index', indexes)
+
+    def test_expired_history(self):
+        """Check the history table for expired jobs"""
+        db = MemoryDatabase(Job)
+        db.set_expired_history()
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        job = list(db._get_all_jobs_in_state('ARCHIVED'))[0]
+        db._change_job_state(job._metadata, 'ARCHIVED', 'EXPIRED')
+        job._metadata['directory'] = None
+        db._expire_job(job._metadata)
+        self.assertEqual(db._count_all_jobs_in_state('ARCHIVED'), 0)
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 1)
+        c = db.conn.cursor()
+        c.execute('SELECT COUNT(*) FROM jobs')
+        self.assertEqual(c.fetchone()[0], 8)
+
+        # Only fields kept in the history table are available
+        job, = list(db._get_all_jobs_in_state('EXPIRED', fields=['user',
+                                                                 'url']))
+        self.assertEqual(sorted(job._metadata.keys()), ['name', 'user'])
+        job, = list(db._get_all_jobs_in_state('EXPIRED',
+                                              name='ready-for-expire'))
+        self.assertEqual(job.name, 'ready-for-expire')
+        self.assertIsNone(job.directory)
+        self.assertEqual(list(db._get_all_jobs_in_state('EXPIRED',
+                                                        name='garbage')), [])
+        job._metadata['contact_email'] = 'test@test.com'
+        db._update_job(job._metadata, 'EXPIRED')
+        job, = list(db._get_all_jobs_in_state('EXPIRED'))
+        self.assertEqual(job._metadata['contact_email'], 'test@test.com')
+        self.assertEqual(db._get_job_names('EXPIRED'), {'ready-for-expire'})
+        db._delete_job(job._metadata, 'EXPIRED')
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 0)
+
+    def test_missing_indexes(self):
+        """Test Database._get_missing_indexes() and _add_index()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        self.assertEqual(db._get_missing_indexes(), [])
+        c = db.conn.cursor()
+        c.execute('DROP INDEX runner_id_index')
+        c.execute('DROP INDEX state_expire_index')
+        c.execute('DROP INDEX parent_index')
+        missing = db._get_missing_indexes()
+        self.assertEqual(missing,
+                         [('jobs', MySQLIndex('runner_id_index',
+                                              ['runner_id'])),
+                          ('dependencies', MySQLIndex('parent_index',
+                                                      ['parent'])),
+                          ('jobs', MySQLIndex('state_expire_index',
+                                              ['state', 'expire_time']))])
+        for table, index in missing:
+            db._add_index(table, index)
+        self.assertEqual(db._get_missing_indexes(), [])
+        # An index with the wrong fields should be replaced
+        c.execute('DROP INDEX state_expire_index')
+        c.execute('CREATE INDEX state_expire_index ON jobs (expire_time)')
+        missing = db._get_missing_indexes()
+        self.assertEqual(missing,
+                         [('jobs', MySQLIndex('state_expire_index',
+                                              ['state', 'expire_time']))])
+        db._add_index(*missing[0])
+        self.assertEqual(db._get_missing_indexes(), [])
+
     def test_execute(self):
         """Test Database._execute method"""
         class DummyError(Exception):
@@ -148,16 +236,23 @@ class DatabaseTest(unittest.TestCase):
             def cursor(self):
                 return DummyCursor(self)
 
+        class DummyEngine(saliweb.backend.engines.MySQLEngine):
+            errors = (DummyError,)
+
+            def __init__(self, db):
+                self.db = db
+
+            def connect(self, config):
+                return DummyConnection(self.db)
+
         class DummyDatabase(saliweb.backend.Database):
             in_query = False
 
             def add_field(self, field):
                 pass
 
-            def _connect(self, config):
-                self.config = config
-                self._OperationalError = DummyError
-                self.conn = DummyConnection(self)
+            def get_engine(self, config):
+                return DummyEngine(self)
 
         db = DummyDatabase(None)
         db._connect(None)
@@ -180,6 +275,18 @@ class DatabaseTest(unittest.TestCase):
         self.assertNotEqual(id(db.conn), id(oldconn))
         self.assertIsInstance(c, DummyCursor)
 
+        # If uncommitted changes were lost with the connection, the query
+        # should not be tried again
+        db.in_query = False
+        db._write('UPDATE jobs SET test=1')
+        oldconn = db.conn
+        self.assertRaises(DummyError, db._execute, 'reconnect succeeds')
+        self.assertNotEqual(id(db.conn), id(oldconn))
+        # A new connection has no uncommitted changes
+        db.in_query = False
+        c = db._execute('reconnect succeeds')
+        self.assertIsInstance(c, DummyCursor)
+
     def test_drop_tables(self):
         """Check Database._drop_tables()"""
         db = MemoryDatabase(Job)
@@ -209,6 +316,37 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(db._count_all_jobs_in_state('RUNNING'), 2)
         self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 0)
 
+    def test_get_next_old_job_time(self):
+        """Check Database._get_next_old_job_time()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        self.assertIsNone(db._get_next_old_job_time())
+        # Times are stored in the database to the nearest second
+        utcnow = testutil._utcnow().replace(microsecond=0)
+        c = db.conn.cursor()
+        for name, state, archive, expire in (
+                ('job1', 'COMPLETED', 3, 9), ('job2', 'COMPLETED', 2, 8),
+                ('job3', 'ARCHIVED', 0, 4), ('job4', 'COMPLETED', None, None),
+                ('job5', 'RUNNING', 1, 1)):
+            c.execute("INSERT INTO jobs(name,state,submit_time,archive_time,"
+                      "expire_time,directory,url) VALUES(?,?,?,?,?,?,?)",
+                      (name, state, utcnow,
+                       None if archive is None
+                       else utcnow + datetime.timedelta(days=archive),
+                       None if expire is None
+                       else utcnow + datetime.timedelta(days=expire),
+                       '/', 'http://testurl'))
+        db.conn.commit()
+        # Only the archive time of completed jobs and the expire time of
+        # archived jobs should be considered
+        self.assertEqual(db._get_next_old_job_time(),
+                         utcnow + datetime.timedelta(days=2))
+        c.execute("UPDATE jobs SET state='ARCHIVED' WHERE name='job2'")
+        db.conn.commit()
+        self.assertEqual(db._get_next_old_job_time(),
+                         utcnow + datetime.timedelta(days=3))
+
     def test_order_by(self):
         """Test Database._get_all_jobs_in_state() order_by parameter"""
         db = MemoryDatabase(Job)
@@ -216,14 +354,38 @@ class DatabaseTest(unittest.TestCase):
         db._create_tables()
         make_test_jobs(db.conn)
         jobs = list(db._get_all_jobs_in_state('RUNNING'))
-        # Jobs should come out in the same order they were inserted
-        self.assertEqual([x._metadata['name'] for x in jobs], ['job2', 'job3'])
+        # Without order_by, the order is decided by the database (e.g. by
+        # which index it uses)
+        self.assertEqual(sorted(x._metadata['name'] for x in jobs),
+                         ['job2', 'job3'])
 
         jobs = list(db._get_all_jobs_in_state('RUNNING',
                                               order_by='submit_time'))
         # Jobs should be sorted by submit time
         self.assertEqual([x._metadata['name'] for x in jobs], ['job3', 'job2'])
 
+    def test_get_job_names(self):
+        """Check Database._get_job_names()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        self.assertEqual(db._get_job_names('RUNNING'), {'job2', 'job3'})
+        self.assertEqual(db._get_job_names('EXPIRED'), set())
+
+    def test_limit(self):
+        """Test Database._get_all_jobs_in_state() limit parameter"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        jobs = list(db._get_all_jobs_in_state('RUNNING',
+                                              order_by='submit_time',
+                                              limit=1))
+        self.assertEqual([x._metadata['name'] for x in jobs], ['job3'])
+        jobs = list(db._get_all_jobs_in_state('RUNNING', limit=5))
+        self.assertEqual(len(jobs), 2)
+
     def test_get_jobs(self):
         """Check Database._get_all_jobs_in_state()"""
         db = MemoryDatabase(Job)
@@ -251,6 +413,58 @@ class DatabaseTest(unittest.TestCase):
                                               after_time='expire_time'))
         self.assertEqual(len(jobs), 0)
 
+    def test_get_all_jobs_in_state_fields(self):
+        """Check Database._get_all_jobs_in_state() with fields and stream"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        jobs = list(db._get_all_jobs_in_state('RUNNING', order_by='name',
+                                              fields=['runner_id']))
+        self.assertEqual([j.name for j in jobs], ['job2', 'job3'])
+        self.assertEqual(sorted(jobs[0]._metadata.keys()),
+                         ['name', 'runner_id'])
+        self.assertEqual(jobs[0]._metadata['runner_id'], 'wyntonsge:job-2')
+        self.assertRaises(KeyError, jobs[0]._metadata.__getitem__, 'url')
+
+        # Results should be the same when streamed, in any batch size
+        for batch_size in (1, 2, 1000):
+            db._stream_batch_size = batch_size
+            jobs = db._get_all_jobs_in_state('COMPLETED', order_by='name',
+                                             fields=[], stream=True)
+            self.assertEqual([j.name for j in jobs],
+                             ['never-archive', 'ready-for-archive'])
+        # Jobs are not read until needed
+        jobs = db._get_all_jobs_in_state('COMPLETED', stream=True)
+        self.assertEqual(next(jobs)._metadata['url'], 'http://testurl')
+        jobs.close()
+
+    def test_get_job_rows(self):
+        """Check Database._get_job_rows()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        rows = list(db._get_job_rows('RUNNING', fields=['runner_id'],
+                                     order_by='name'))
+        self.assertEqual(rows, [('job2', 'RUNNING', 'wyntonsge:job-2'),
+                                ('job3', 'RUNNING', 'SGE-job-3')])
+        self.assertEqual(rows[0].name, 'job2')
+        self.assertEqual(rows[0].runner_id, 'wyntonsge:job-2')
+        self.assertRaises(AttributeError, getattr, rows[0], 'url')
+        # Rows are read-only and have no per-instance dict
+        self.assertRaises(AttributeError, setattr, rows[0], 'name', 'foo')
+        self.assertFalse(hasattr(rows[0], '__dict__'))
+        # Row classes are reused for the same fields
+        self.assertIs(type(rows[0]),
+                      type(next(db._get_job_rows('RUNNING',
+                                                 fields=['runner_id']))))
+        rows = list(db._get_job_rows('COMPLETED', order_by='name',
+                                     stream=True))
+        self.assertEqual([r.name for r in rows],
+                         ['never-archive', 'ready-for-archive'])
+        self.assertEqual(rows[0]._fields, ('name', 'state'))
+
     def test_change_job_state(self):
         """Check Database._change_job_state()"""
         db = MemoryDatabase(Job)
@@ -267,6 +481,170 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(len(jobs), 1)
         self.assertEqual(jobs[0]._metadata['runner_id'], 'new-SGE-ID')
 
+    def test_group_commit(self):
+        """Check grouping of job changes into transactions"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        jobs = list(db._get_all_jobs_in_state('RUNNING'))
+        # Without group commit, each change is committed
+        with db._unit_of_work():
+            db._change_job_state(jobs[0]._metadata, 'RUNNING', 'FAILED')
+            self.assertFalse(db.conn.in_transaction)
+        # Limit can be overridden for a single unit of work
+        job = list(db._get_all_jobs_in_state('FAILED'))[0]
+        with db._unit_of_work(max_changes=10):
+            db._change_job_state(job._metadata, 'FAILED', 'RUNNING')
+            self.assertTrue(db.conn.in_transaction)
+            db._change_job_state(job._metadata, 'RUNNING', 'FAILED')
+        self.assertFalse(db.conn.in_transaction)
+        self.assertEqual(db._group_commit, 1)
+        db.set_group_commit(2)
+        with db._unit_of_work():
+            db._change_job_state(jobs[1]._metadata, 'RUNNING', 'FAILED')
+            self.assertTrue(db.conn.in_transaction)
+            job = list(db._get_all_jobs_in_state('INCOMING'))[0]
+            db._change_job_state(job._metadata, 'INCOMING', 'FAILED')
+            # Limit reached, so should be committed
+            self.assertFalse(db.conn.in_transaction)
+            self.assertEqual(db._uow_journal, [])
+            job = list(db._get_all_jobs_in_state('ARCHIVED'))[0]
+            job._metadata['runner_id'] = 'new-SGE-ID'
+            db._update_job(job._metadata, 'ARCHIVED')
+            self.assertTrue(db.conn.in_transaction)
+        self.assertFalse(db.conn.in_transaction)
+        self.assertIsNone(db._uow_journal)
+        self.assertEqual(db._count_all_jobs_in_state('FAILED'), 3)
+
+    def test_group_commit_exception(self):
+        """Check that changes are kept if a unit of work fails"""
+        db = MemoryDatabase(Job)
+        db.set_group_commit(100)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+
+        def change_and_fail():
+            with db._unit_of_work():
+                for job in db._get_all_jobs_in_state('RUNNING'):
+                    db._change_job_state(job._metadata, 'RUNNING', 'FAILED')
+                db._execute('UPDATE garbage SET name=1')
+        self.assertRaises(sqlite3.OperationalError, change_and_fail)
+        self.assertFalse(db.conn.in_transaction)
+        self.assertIsNone(db._uow_journal)
+        self.assertEqual(db._count_all_jobs_in_state('FAILED'), 2)
+
+    def test_group_commit_reconnect(self):
+        """Check that uncommitted changes survive a lost connection"""
+        class FileDatabase(saliweb.backend.Database):
+            def get_engine(self, config):
+                return SQLiteEngine(fname)
+        with testutil.temp_dir() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.db')
+            db = FileDatabase(Job)
+            db.set_group_commit(100)
+            db._connect(None)
+            db._create_tables()
+            make_test_jobs(db.conn)
+            with db._unit_of_work():
+                for job in db._get_all_jobs_in_state('RUNNING'):
+                    db._change_job_state(job._metadata, 'RUNNING', 'FAILED')
+                db._reconnect()
+                self.assertTrue(db.conn.in_transaction)
+            self.assertEqual(db._count_all_jobs_in_state('FAILED'), 2)
+            db._pool.clear()
+            db.conn.close()
+
+    def test_group_commit_commit_reconnect(self):
+        """Check that changes survive a connection lost at commit"""
+        class LostCommitConnection(object):
+            def __init__(self, conn):
+                self.conn = conn
+
+            def __getattr__(self, name):
+                return getattr(self.conn, name)
+
+            def commit(self):
+                # Simulate the connection going away (so that uncommitted
+                # changes are lost) the first time we try to commit
+                if engine.lost < 1:
+                    engine.lost += 1
+                    self.conn.close()
+                    raise sqlite3.OperationalError('connection lost')
+                self.conn.commit()
+
+        class LostCommitEngine(SQLiteEngine):
+            lost = 0
+
+            def connect(self, config):
+                return LostCommitConnection(SQLiteEngine.connect(self, config))
+
+            def is_disconnect(self, err):
+                return str(err) == 'connection lost'
+
+        class FileDatabase(saliweb.backend.Database):
+            def get_engine(self, config):
+                return engine
+        with testutil.temp_dir() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.db')
+            engine = LostCommitEngine(fname)
+            engine.lost = 1
+            db = FileDatabase(Job)
+            db.set_group_commit(100)
+            db._connect(None)
+            db._create_tables()
+            make_test_jobs(db.conn)
+            engine.lost = 0
+            with db._unit_of_work():
+                for job in db._get_all_jobs_in_state('RUNNING'):
+                    db._change_job_state(job._metadata, 'RUNNING', 'FAILED')
+            self.assertEqual(engine.lost, 1)
+            self.assertIsNone(db._uow_journal)
+            self.assertEqual(db._count_all_jobs_in_state('FAILED'), 2)
+            db._pool.clear()
+            db.conn.close()
+
+    def test_get_jobs_by_name(self):
+        """Check Database._get_jobs_by_name()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        db._max_names_per_query = 1
+
+        def names(state, names):
+            return sorted(j.name for j in db._get_jobs_by_name(state, names))
+        self.assertEqual(names('RUNNING', ['job2', 'job3', 'job1']),
+                         ['job2', 'job3'])
+        self.assertEqual(names('RUNNING', []), [])
+        self.assertEqual(list(db._get_all_jobs_in_state('RUNNING',
+                                                        names=[])), [])
+
+    def test_glob_to_like(self):
+        """Check conversion of glob patterns to SQL LIKE patterns"""
+        g = saliweb.backend._glob_to_like
+        self.assertEqual(g('job*'), 'job%')
+        self.assertEqual(g('job?'), 'job_')
+        self.assertEqual(g('a_b%c!'), 'a!_b!%c!!')
+        self.assertEqual(g('job[12]x'), 'job_x')
+        self.assertEqual(g('job[!]]x'), 'job_x')
+        self.assertEqual(g('job[12'), 'job[12')
+
+    def test_get_jobs_name_patterns(self):
+        """Check selection of jobs by name pattern"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+
+        def names(state, patterns):
+            return sorted(j.name for j in db._get_all_jobs_in_state(
+                state, name_patterns=patterns))
+        self.assertEqual(names('RUNNING', ['job*']), ['job2', 'job3'])
+        self.assertEqual(names('RUNNING', ['job3', 'nomatch']), ['job3'])
+        self.assertEqual(names('RUNNING', ['j_b*']), [])
+
     def test_update_job(self):
         """Check Database._update_job()"""
         db = MemoryDatabase(Job)
@@ -281,6 +659,27 @@ class DatabaseTest(unittest.TestCase):
         self.assertIsNot(job, newjob)
         self.assertEqual(newjob._metadata['runner_id'], 'new-SGE-ID')
 
+    def test_update_job_changed_fields(self):
+        """Check that only changed fields are written to the database"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        make_test_jobs(db.conn)
+        job = list(db._get_all_jobs_in_state('INCOMING'))[0]
+        # Modify the database behind the job's back
+        db._execute("UPDATE jobs SET url=?, contact_email=? WHERE name=?",
+                    ('http://newurl', 'foo@bar.com', 'job1'))
+        job._metadata['runner_id'] = 'new-SGE-ID'
+        db._update_job(job._metadata, 'INCOMING')
+        job._metadata['contact_email'] = 'baz@bar.com'
+        db._change_job_state(job._metadata, 'INCOMING', 'FAILED')
+        newjob = list(db._get_all_jobs_in_state('FAILED'))[0]
+        self.assertEqual(newjob._metadata['runner_id'], 'new-SGE-ID')
+        self.assertEqual(newjob._metadata['contact_email'], 'baz@bar.com')
+        # Unchanged fields should not have been overwritten
+        self.assertEqual(newjob._metadata['url'], 'http://newurl')
+        self.assertFalse(job._metadata.needs_sync())
+
     def test_get_job_dependencies(self):
         """Check Database._get_job_dependencies()"""
         db = MemoryDatabase(Job)
@@ -298,6 +697,59 @@ class DatabaseTest(unittest.TestCase):
         self.assertEqual(db._get_job_dependencies(),
                          {'foo': ['bar'], 'a': ['one', 'two']})
 
+    def test_dependency_graph(self):
+        """Check Database._get_dependency_graph()"""
+        db = MemoryDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        query = "INSERT INTO dependencies(child,parent) VALUES(?,?)"
+        db._execute(query, ('a', 'one'))
+        db._execute(query, ('a', 'two'))
+        g = db._get_dependency_graph()
+        self.assertIs(db._get_dependency_graph(), g)
+        self.assertIn('a', g)
+        self.assertEqual(g.children, {'one': {'a'}, 'two': {'a'}})
+        self.assertTrue(db._check_dependency_graph())
+
+        # New dependencies are only read when asked for
+        db._execute(query, ('b', 'one'))
+        self.assertNotIn('b', g)
+        db._refresh_job_dependencies(['b', 'c'])
+        self.assertIn('b', g)
+        self.assertNotIn('c', g)
+        self.assertTrue(db._check_dependency_graph())
+
+        # Large numbers of jobs should be read in several queries
+        db._execute(query, ('d', 'two'))
+        db._max_names_per_query = 2
+        with mock.patch.object(db, '_execute', wraps=db._execute) as m:
+            db._refresh_job_dependencies(['b', 'c', 'd'])
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(g.parents['d'], {'two'})
+        self.assertTrue(db._check_dependency_graph())
+        db._execute('DELETE FROM dependencies WHERE child=?', ('d',))
+        db._refresh_job_dependencies(['d'])
+
+        db._remove_dependency_on('one')
+        self.assertEqual(db._pop_ready_jobs(), {'b'})
+        self.assertEqual(db._pop_ready_jobs(), set())
+        self.assertEqual(g.parents, {'a': {'two'}})
+        self.assertTrue(db._check_dependency_graph())
+
+        # Out of date graph should be reloaded
+        db._execute("DELETE FROM dependencies")
+        db._execute(query, ('d', 'two'))
+        self.assertFalse(db._check_dependency_graph())
+        g = db._get_dependency_graph()
+        self.assertEqual(g.parents, {'d': {'two'}})
+        self.assertEqual(db._pop_ready_jobs(), {'a'})
+
+        # Deleting a job removes dependencies on it
+        md = saliweb.backend._JobMetadata(['name', 'state'], ['two', None])
+        db._delete_job(md, 'COMPLETED')
+        self.assertEqual(g.parents, {})
+        self.assertEqual(db._pop_ready_jobs(), {'d'})
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@ import sys
 from saliweb.backend import InvalidStateError
 from saliweb.backend.deljob import check_valid_state, get_options, delete_job
 from saliweb.backend.deljob import main
+import saliweb.backend.bulk
 from io import StringIO
 
 
@@ -45,16 +46,22 @@ class DelJobTest(unittest.TestCase):
                 sys.stderr = oldstderr
                 sys.argv = old
         self.assertRaises(SystemExit, run_get_options, [])
-        state, jobnames, force = run_get_options(['FAILED', 'testjob1',
-                                                  'job2'])
-        self.assertEqual(state, 'FAILED')
-        self.assertEqual(jobnames, ['testjob1', 'job2'])
-        self.assertEqual(force, False)
+        self.assertRaises(SystemExit, run_get_options, ['FAILED'])
+        args = run_get_options(['FAILED', 'testjob1', 'job2'])
+        self.assertEqual(args.state, 'FAILED')
+        self.assertEqual(args.jobs, ['testjob1', 'job2'])
+        self.assertEqual(args.force, False)
         for arg in ['-f', '--force']:
-            state, jobnames, force = run_get_options([arg, 'FAILED',
-                                                      'testjob'])
-            self.assertEqual(force, True)
-            self.assertEqual(jobnames, ['testjob'])
+            args = run_get_options([arg, 'FAILED', 'testjob'])
+            self.assertEqual(args.force, True)
+            self.assertEqual(args.jobs, ['testjob'])
+        args = run_get_options(['FAILED', '--user', 'foo',
+                                '--older-than', '2d'])
+        self.assertEqual(args.jobs, [])
+        self.assertEqual(args.user, 'foo')
+        self.assertEqual(args.older_than.days, 2)
+        self.assertRaises(SystemExit, run_get_options,
+                          ['FAILED', '--older-than', 'garbage'])
 
     def test_delete_job(self):
         """Test deljob delete_job()"""
@@ -128,9 +135,21 @@ class DelJobTest(unittest.TestCase):
             def get_web_service(self, config):
                 return DummyWebService(self)
 
+        def dummy_select_jobs(web, states, names, user, older_than):
+            web.mod.selected = (states, names, user, older_than)
+            return ['job1', 'job2']
+
+        def dummy_delete_jobs(web, jobs):
+            web.mod.jobs_deleted = jobs
+            return []
+
         old = sys.argv
         olderr = sys.stderr
+        old_select = saliweb.backend.bulk.select_jobs
+        old_delete = saliweb.backend.bulk.delete_jobs
         try:
+            saliweb.backend.bulk.select_jobs = dummy_select_jobs
+            saliweb.backend.bulk.delete_jobs = dummy_delete_jobs
             sio = StringIO()
             sys.stderr = sio
             mod = DummyModule()
@@ -146,7 +165,17 @@ class DelJobTest(unittest.TestCase):
             main(mod)
             self.assertEqual(sio.getvalue(), '')
             self.assertEqual(mod.job_deleted, True)
+
+            # Select jobs in bulk
+            mod = DummyModule()
+            sys.argv = ['testprogram'] + ['-f', 'FAILED', 'test*']
+            main(mod)
+            self.assertEqual(mod.selected, (['FAILED'], ['test*'], None,
+                                            None))
+            self.assertEqual(mod.jobs_deleted, ['job1', 'job2'])
         finally:
+            saliweb.backend.bulk.select_jobs = old_select
+            saliweb.backend.bulk.delete_jobs = old_delete
             sys.argv = old
             sys.stderr = olderr
 
@@ -0,0 +1,252 @@
+import unittest
+import os
+import datetime
+import sqlite3
+from saliweb.backend import (MySQLField, MySQLIndex, Job, Database,
+                             _JobMetadata)
+from saliweb.backend.engines import (MySQLEngine, SQLiteEngine,
+                                     PostgreSQLEngine, _ConnectionPool,
+                                     _PooledCursor)
+import testutil
+
+
+class DummyConfig(object):
+    def __init__(self, db):
+        self.database = {'engine': 'sqlite', 'db': db}
+
+
+class DummyConnection(object):
+    def __init__(self):
+        self.closed = self.rolled_back = False
+
+    def close(self):
+        self.closed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+
+class DummyEngine(object):
+    def __init__(self):
+        self.connections = []
+
+    def connect(self, config):
+        self.connections.append(DummyConnection())
+        return self.connections[-1]
+
+
+class DummyCursor(object):
+    def __init__(self):
+        self.closed = False
+        self.rows = [(1,), (2,), (3,)]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+class EngineTest(unittest.TestCase):
+    """Check SQLEngine classes"""
+
+    def test_mysql_indexes(self):
+        """Test MySQLEngine.get_table_indexes()"""
+        def execute(query, args=()):
+            self.assertEqual(query, 'SHOW INDEX FROM jobs')
+            return [('jobs', 1, 'state_index', 1, 'state'),
+                    ('jobs', 1, 'state_submit_index', 2, 'submit_time'),
+                    ('jobs', 1, 'state_submit_index', 1, 'state')]
+        indexes = MySQLEngine().get_table_indexes(execute, 'jobs')
+        self.assertEqual(indexes, {'state_index': ('state',),
+                                   'state_submit_index': ('state',
+                                                          'submit_time')})
+
+    def test_mysql_schema(self):
+        """Test MySQLEngine schemas"""
+        e = MySQLEngine()
+        f = MySQLField('state', "ENUM('A', 'B')", null=False)
+        self.assertEqual(e.get_field_schema(f),
+                         "state ENUM('A', 'B') NOT NULL DEFAULT ''")
+        i = MySQLIndex('state_index', ['state'])
+        self.assertEqual(e.get_index_schema('jobs', i),
+                         'CREATE INDEX state_index ON jobs (state)')
+        self.assertEqual(e.get_index_schema('jobs', i, online=True),
+                         'CREATE INDEX state_index ON jobs (state) '
+                         'ALGORITHM=INPLACE LOCK=NONE')
+        self.assertEqual(e.get_drop_index_schema('jobs', 'state_index'),
+                         'DROP INDEX state_index ON jobs')
+        self.assertEqual(e.get_replace_select('new', ['a', 'b'], 'a',
+                                              'SELECT a, b FROM old'),
+                         'REPLACE INTO new (a, b) SELECT a, b FROM old')
+
+        class Err(Exception):
+            pass
+        self.assertTrue(e.is_disconnect(Err(2006, 'gone away')))
+        self.assertTrue(e.is_disconnect(Err(2013, 'lost')))
+        self.assertFalse(e.is_disconnect(Err(1064, 'syntax error')))
+
+    def test_postgresql_schema(self):
+        """Test PostgreSQLEngine schemas"""
+        e = PostgreSQLEngine()
+        f = MySQLField('state', "ENUM('A', 'B')", null=False)
+        self.assertEqual(e.get_field_schema(f),
+                         "\"state\" VARCHAR(20) NOT NULL DEFAULT '' "
+                         "CHECK (\"state\" IN ('A', 'B'))")
+        # Original field should be unchanged
+        self.assertEqual(f.type, "ENUM('A', 'B')")
+        self.assertEqual(f.name, 'state')
+        f = MySQLField('submit_time', 'DATETIME')
+        self.assertEqual(e.get_field_schema(f), '"submit_time" TIMESTAMP')
+        # Reserved words must be quoted
+        f = MySQLField('user', 'VARCHAR(40)')
+        self.assertEqual(e.get_field_schema(f), '"user" VARCHAR(40)')
+        i = MySQLIndex('user_index', ['user', 'state'])
+        self.assertEqual(e.get_index_schema('jobs', i),
+                         'CREATE INDEX user_index ON jobs ("user", "state")')
+        self.assertEqual(i.fields, ('user', 'state'))
+        self.assertEqual(
+            e.get_replace_select('new', ['a', 'user'], 'a',
+                                 'SELECT "a", "user" FROM old'),
+            'INSERT INTO new ("a", "user") SELECT "a", "user" FROM old '
+            'ON CONFLICT ("a") DO UPDATE SET "user"=EXCLUDED."user"')
+
+        def execute(query, args=()):
+            self.assertEqual(args, ('jobs',))
+            return [('jobs_pkey',
+                     'CREATE UNIQUE INDEX jobs_pkey ON public.jobs '
+                     'USING btree (name)'),
+                    ('state_submit_index',
+                     'CREATE INDEX state_submit_index ON public.jobs '
+                     'USING btree (state, "submit_time")')]
+        self.assertEqual(e.get_table_indexes(execute, 'jobs'),
+                         {'jobs_pkey': ('name',),
+                          'state_submit_index': ('state', 'submit_time')})
+
+        class Err(Exception):
+            pgcode = None
+        self.assertTrue(e.is_disconnect(Err()))
+        Err.pgcode = '42601'
+        self.assertFalse(e.is_disconnect(Err()))
+
+    def test_postgresql_queries(self):
+        """Test that Database quotes field names for PostgreSQL"""
+        class RecordingCursor(object):
+            def __init__(self, queries):
+                self.queries = queries
+
+            def execute(self, query, args=()):
+                self.queries.append(query)
+
+            def __iter__(self):
+                return iter([])
+
+        class RecordingConnection(object):
+            def __init__(self):
+                self.queries = []
+
+            def cursor(self, name=None):
+                return RecordingCursor(self.queries)
+
+            def commit(self):
+                pass
+
+        class RecordingEngine(PostgreSQLEngine):
+            def connect(self, config):
+                return RecordingConnection()
+
+        class PostgreSQLDatabase(Database):
+            def get_engine(self, config):
+                return RecordingEngine()
+        db = PostgreSQLDatabase(Job)
+        db._connect(None)
+        db._create_tables()
+        queries = db.conn.queries
+        self.assertIn('"user" VARCHAR(40)', queries[0])
+        self.assertNotIn(' user ', queries[0])
+        del queries[:]
+        list(db._get_all_jobs_in_state('RUNNING', user='foo'))
+        self.assertIn(', "user", ', queries[0])
+        self.assertIn('"user"=%s', queries[0])
+        del queries[:]
+        db._count_jobs_in_state_by('RUNNING', ['user', 'contact_email'])
+        self.assertIn('GROUP BY "user", "contact_email"', queries[0])
+        del queries[:]
+        metadata = _JobMetadata(['name', 'state', 'user'],
+                                ['job1', 'RUNNING', 'foo'])
+        metadata['user'] = 'bar'
+        db._update_job(metadata, 'RUNNING')
+        self.assertEqual(queries,
+                         ['UPDATE jobs SET "user"=%s WHERE name=%s'])
+
+    def test_sqlite_file(self):
+        """Test SQLiteEngine with a database file"""
+        with testutil.temp_dir() as tmpdir:
+            fname = os.path.join(tmpdir, 'test.db')
+            db = Database(Job)
+            db._connect(DummyConfig(fname))
+            self.assertIsInstance(db._engine, SQLiteEngine)
+            self.assertEqual(db._placeholder, '?')
+            c = db._execute('PRAGMA journal_mode')
+            self.assertEqual(c.fetchone()[0], 'wal')
+            db._create_tables()
+            self.assertEqual(db._get_table_indexes('jobs')['state_index'],
+                             ('state',))
+            submit = datetime.datetime(2020, 1, 2, 3, 4, 5)
+            db._execute("INSERT INTO jobs (name, passwd, directory, url, "
+                        "state, submit_time) VALUES (?, ?, ?, ?, ?, ?)",
+                        ('job1', 'pw', '/', 'url', 'INCOMING', submit))
+            db.conn.commit()
+            # Read results on a separate connection
+            db._engine.stream_separate_connection = True
+            c = db._execute('SELECT name, submit_time FROM jobs',
+                            stream=True)
+            self.assertIsInstance(c, _PooledCursor)
+            self.assertEqual(c.fetchall(), [('job1', submit)])
+            c.close()
+            c.close()
+            self.assertEqual(len(db._pool._idle), 1)
+            # The connection should not be leaked if the query fails
+            conn = db._pool._idle[0]
+            self.assertRaises(sqlite3.ProgrammingError, db._execute,
+                              'SELECT ?', (), stream=True)
+            self.assertEqual(db._pool._idle, [])
+            self.assertRaises(sqlite3.ProgrammingError, conn.cursor)
+            db._pool.clear()
+            db.conn.close()
+
+    def test_connection_pool(self):
+        """Test _ConnectionPool"""
+        e = DummyEngine()
+        p = _ConnectionPool(e, None, 1)
+        c1 = p.get()
+        c2 = p.get()
+        self.assertEqual(len(e.connections), 2)
+        p.put(c1)
+        # Only one idle connection is kept
+        p.put(c2)
+        self.assertFalse(c1.closed)
+        self.assertTrue(c2.closed)
+        self.assertIs(p.get(), c1)
+        p.put(c1)
+        p.clear()
+        self.assertTrue(c1.closed)
+        self.assertEqual(p._idle, [])
+
+    def test_pooled_cursor(self):
+        """Test _PooledCursor"""
+        e = DummyEngine()
+        p = _ConnectionPool(e, None, 1)
+        conn = p.get()
+        cur = DummyCursor()
+        c = _PooledCursor(cur, conn, p)
+        self.assertEqual(list(c), [(1,), (2,), (3,)])
+        self.assertEqual(p._idle, [])
+        c.close()
+        self.assertTrue(cur.closed)
+        self.assertTrue(conn.rolled_back)
+        self.assertEqual(p._idle, [conn])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,32 +18,145 @@ class EventsTest(unittest.TestCase):
         self.assertEqual(e.get(), 'b')
         self.assertIsNone(e.get(0))
 
+    def test_event_queue_priority(self):
+        """Check priority and coalescing of _EventQueue items"""
+        events = saliweb.backend.events
+        ws = object()
+        e = events._EventQueue()
+        cleanup = events._CleanupIncomingJobsEvent(ws)
+        e.put(cleanup)
+        incoming = events._IncomingJobsEvent(ws)
+        for i in range(5):
+            e.put(incoming if i == 0 else events._IncomingJobsEvent(ws))
+        # Events for a different web service should not be merged
+        other_incoming = events._IncomingJobsEvent(object())
+        e.put(other_incoming)
+        completed = events._CompletedJobEvent(ws, None, 'foo', None)
+        e.put(completed)
+        self.assertEqual(e.stats['depth'], 4)
+        self.assertEqual(e.stats['coalesced'], 4)
+        self.assertEqual(e.get(0), completed)
+        self.assertEqual(e.get(0), incoming)
+        self.assertEqual(e.get(0), other_incoming)
+        self.assertEqual(e.get(0), cleanup)
+        self.assertIsNone(e.get(0))
+        self.assertEqual(e.stats['depth'], 0)
+        self.assertEqual(e.stats['max_depth'], 4)
+        self.assertEqual(e.stats['processed'], 4)
+        self.assertGreaterEqual(e.stats['max_wait'], e.stats['last_wait'])
+        # Once processed, a new event of the same type can be queued
+        e.put(events._IncomingJobsEvent(ws))
+        self.assertEqual(e.stats['depth'], 1)
+
+    def test_event_queue_delay(self):
+        """Check delayed items in the _EventQueue class"""
+        e = saliweb.backend.events._EventQueue()
+        e.put('c', delay=0.1)
+        e.put('b', delay=0.05)
+        e.put('a')
+        self.assertEqual(e.get(0), 'a')
+        self.assertIsNone(e.get(0))
+        self.assertEqual(e.get(1.0), 'b')
+        self.assertEqual(e.get(), 'c')
+        self.assertIsNone(e.get(0.01))
+
+    def test_state_file_recheck_event(self):
+        """Check the _StateFileRecheckEvent class"""
+        class DummyJob(object):
+            def __init__(self, runner_id):
+                self._metadata = {'runner_id': runner_id}
+
+            def _try_complete(self, webservice, recheck):
+                webservice.recheck = recheck
+
+        class DummyWebService(object):
+            def __init__(self):
+                self._deferred_completions = {'r:1': None}
+
+            def get_job_by_name(self, state, name):
+                if name == 'job1':
+                    return DummyJob('r:1')
+
+        ws = DummyWebService()
+        ev = saliweb.backend.events._StateFileRecheckEvent(ws, 'job1', 'r:1',
+                                                           0., 1.)
+        ev.process()
+        self.assertEqual(ws.recheck, ev)
+        self.assertEqual(ws._deferred_completions, {})
+        # Nothing should happen if the job is gone or has been rerun
+        for name, runner_id in (('job2', 'r:1'), ('job1', 'r:2')):
+            ws = DummyWebService()
+            ev = saliweb.backend.events._StateFileRecheckEvent(
+                ws, name, runner_id, 0., 1.)
+            ev.process()
+            self.assertFalse(hasattr(ws, 'recheck'))
+
     def test_incoming_jobs_event(self):
         """Check the _IncomingJobsEvent class"""
         class dummy:
-            def _process_incoming_jobs(self): self.processed = True
+            def _process_incoming_jobs(self, names):
+                self.processed = names
         d = dummy()
         e = saliweb.backend.events._IncomingJobsEvent(d)
         e.process()
-        self.assertEqual(d.processed, True)
+        self.assertIsNone(d.processed)
+        e = saliweb.backend.events._IncomingJobsEvent(d, {'job1'})
+        e.merge(saliweb.backend.events._IncomingJobsEvent(d, {'job2'}))
+        e.process()
+        self.assertEqual(d.processed, {'job1', 'job2'})
+        # Merging with a full check should give a full check
+        e.merge(saliweb.backend.events._IncomingJobsEvent(d))
+        e.process()
+        self.assertIsNone(d.processed)
+
+    def test_parse_incoming_message(self):
+        """Check _parse_incoming_message()"""
+        p = saliweb.backend.events._parse_incoming_message
+        self.assertEqual(p(b"INCOMING job1"), {'job1'})
+        self.assertEqual(p(b"INCOMING job1\nINCOMING job2\n"),
+                         {'job1', 'job2'})
+        for msg in (b"", b"new job", b"INCOMING", b"FOO job1", b"\xff"):
+            self.assertIsNone(p(msg))
 
     def test_cleanup_incoming_jobs_event(self):
         """Check the _CleanupIncomingJobsEvent class"""
         class dummy:
             def _cleanup_incoming_jobs(self): self.processed = True
+            def _schedule_cleanup_incoming_jobs(self): self.scheduled = True
         d = dummy()
         e = saliweb.backend.events._CleanupIncomingJobsEvent(d)
         e.process()
         self.assertEqual(d.processed, True)
+        # Each cleanup should schedule the next
+        self.assertEqual(d.scheduled, True)
 
     def test_old_jobs_event(self):
         """Check the _OldJobsEvent class"""
         class dummy:
             def _process_old_jobs(self): self.processed = True
+            def _schedule_old_jobs(self): self.scheduled = True
         d = dummy()
-        e = saliweb.backend.events._OldJobsEvent(d)
+        d._old_jobs_due = 42
+        e = saliweb.backend.events._OldJobsEvent(d, 42)
         e.process()
         self.assertEqual(d.processed, True)
+        self.assertEqual(d.scheduled, True)
+
+        # Superseded events should do nothing
+        d = dummy()
+        d._old_jobs_due = 10
+        e = saliweb.backend.events._OldJobsEvent(d, 42)
+        e.process()
+        self.assertFalse(hasattr(d, 'processed'))
+        self.assertFalse(hasattr(d, 'scheduled'))
+
+        # The current event should be kept when coalesced
+        q = saliweb.backend.events._EventQueue()
+        q.put(e)
+        q.put(saliweb.backend.events._OldJobsEvent(d, 10))
+        q.put(saliweb.backend.events._OldJobsEvent(d, 42))
+        self.assertEqual(q.get(timeout=0.).due, 10)
+        self.assertIsNone(q.get(timeout=0.))
 
     def test_completed_job_event(self):
         """Check the _CompletedJobEvent class"""
@@ -74,71 +187,22 @@ class EventsTest(unittest.TestCase):
         # try_complete should not be called if the job ID does not exist
         self.assertEqual(hasattr(ws, 'run_exception'), False)
 
-    def test_old_jobs(self):
-        """Check the _OldJobs class"""
-        class dummy:
-            def _get_oldjob_interval(self): return 0.02
-        q = saliweb.backend.events._EventQueue()
-        ws = dummy()
-        ws._event_queue = q
-        t = saliweb.backend.events._OldJobs(ws)
-        t.start()
-        time.sleep(0.05)
-        # Should have added 2 events
-        for i in range(2):
-            x = q.get(timeout=0.)
-            self.assertIsInstance(x, saliweb.backend.events._OldJobsEvent)
-        self.assertIsNone(q.get(timeout=0.))
-
-    def test_periodic_check(self):
-        """Check the _PeriodicCheck class"""
-        class dummy:
-            pass
-
-        ws = dummy()
-        ws.config = dummy()
-        ws.config.backend = {'check_minutes': 0.02/60.}
-
-        q = saliweb.backend.events._EventQueue()
-        ws._event_queue = q
-        t = saliweb.backend.events._PeriodicCheck(ws)
-        t.start()
-        time.sleep(0.05)
-        # Should have added 2 events
-        for i in range(2):
-            x = q.get(timeout=0.)
-            self.assertIsInstance(
-                x, saliweb.backend.events._PeriodicCheckEvent)
-        self.assertIsNone(q.get(timeout=0.))
-
     def test_periodic_check_event(self):
         """Check the _PeriodicCheckEvent class"""
         class dummy:
             def _process_completed_jobs(self): self.completed = True
+            def _check_dependencies(self): self.depends = True
             def _process_incoming_jobs(self): self.incoming = True
+            def _schedule_periodic_check(self): self.scheduled = True
         d = dummy()
         e = saliweb.backend.events._PeriodicCheckEvent(d)
         e.process()
+        # Each check should schedule the next
+        self.assertEqual(d.scheduled, True)
         self.assertEqual(d.completed, True)
+        self.assertEqual(d.depends, True)
         self.assertEqual(d.incoming, True)
 
-    def test_cleanup_incoming_jobs(self):
-        """Check the _CleanupIncomingJobs class"""
-        class dummy:
-            def _get_cleanup_incoming_job_times(self): return (0.02, 0.02)
-        q = saliweb.backend.events._EventQueue()
-        ws = dummy()
-        ws._event_queue = q
-        t = saliweb.backend.events._CleanupIncomingJobs(ws)
-        t.start()
-        time.sleep(0.05)
-        # Should have added 2 events
-        for i in range(2):
-            x = q.get(timeout=0.)
-            self.assertIsInstance(
-                x, saliweb.backend.events._CleanupIncomingJobsEvent)
-        self.assertIsNone(q.get(timeout=0.))
-
     def test_incoming_jobs(self):
         """Check the _IncomingJobs class"""
         class dummy:
@@ -161,10 +225,78 @@ class EventsTest(unittest.TestCase):
         s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         s.connect('test.sock')
         s.send(b"new job")
+        s.shutdown(socket.SHUT_WR)
+        # Connection should be closed by the listener
+        self.assertEqual(s.recv(1), b"")
+        s.close()
         time.sleep(0.05)
-        # Should have added 1 event
+        # Should have added 1 event; message was not understood, so all
+        # jobs should be checked
         x = q.get(timeout=0.)
         self.assertIsInstance(x, saliweb.backend.events._IncomingJobsEvent)
+        self.assertIsNone(x.names)
+        self.assertIsNone(q.get(timeout=0.))
+
+        # Multiple job names can be sent on a single connection
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect('test.sock')
+        s.sendall(b"INCOMING job1\nINCOMING job2\n")
+        s.close()
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect('test.sock')
+        s.sendall(b"INCOMING job3")
+        s.close()
+        time.sleep(0.05)
+        # Events should have been merged
+        x = q.get(timeout=0.)
+        self.assertEqual(x.names, {'job1', 'job2', 'job3'})
+        self.assertIsNone(q.get(timeout=0.))
+
+        # A slow client should not hold up other clients
+        slow = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        slow.connect('test.sock')
+        slow.sendall(b"INCOMING job4")
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect('test.sock')
+        s.sendall(b"INCOMING job5")
+        s.close()
+        time.sleep(0.05)
+        x = q.get(timeout=0.)
+        self.assertEqual(x.names, {'job5'})
+        self.assertIsNone(q.get(timeout=0.))
+        slow.close()
+        time.sleep(0.05)
+        x = q.get(timeout=0.)
+        self.assertEqual(x.names, {'job4'})
+        self.assertIsNone(q.get(timeout=0.))
+        os.unlink('test.sock')
+
+    def test_incoming_jobs_timeout(self):
+        """Check that _IncomingJobs stops waiting for a slow client"""
+        class dummy:
+            pass
+
+        ws = dummy()
+        if os.path.exists('test.sock'):
+            os.unlink('test.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind('test.sock')
+        sock.listen(5)
+
+        q = saliweb.backend.events._EventQueue()
+        ws._event_queue = q
+        t = saliweb.backend.events._IncomingJobs(ws, sock)
+        t._read_timeout = 0.1
+        t.start()
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.connect('test.sock')
+        s.sendall(b"INCOMING job1")
+        # Connection should be closed by the listener after the timeout
+        self.assertEqual(s.recv(1), b"")
+        s.close()
+        time.sleep(0.05)
+        x = q.get(timeout=0.)
+        self.assertEqual(x.names, {'job1'})
         self.assertIsNone(q.get(timeout=0.))
         os.unlink('test.sock')
 
@@ -2,6 +2,7 @@ import unittest
 import sys
 from saliweb.backend.failjob import check_daemon_running, get_options, fail_job
 from saliweb.backend.failjob import main
+import saliweb.backend.bulk
 from io import StringIO
 
 
@@ -49,6 +50,9 @@ class FailJobTest(unittest.TestCase):
             args = run_get_options([arg, 'testjob'])
             self.assertEqual(args.email, False)
             self.assertEqual(args.jobnames, ['testjob'])
+        args = run_get_options(['-s', 'RUNNING', '--state', 'INCOMING'])
+        self.assertEqual(args.jobnames, [])
+        self.assertEqual(args.states, ['RUNNING', 'INCOMING'])
 
     def test_fail_job(self):
         """Test failjob fail_job()"""
@@ -126,9 +130,20 @@ class FailJobTest(unittest.TestCase):
             def get_web_service(self, config):
                 return DummyWebService(self)
 
+        def dummy_select_jobs(web, states, names, user, older_than):
+            web.mod.selected = (states, names, user, older_than)
+            return ['job1', 'job2']
+
+        def dummy_fail_jobs(web, jobs, email):
+            web.mod.jobs_failed = (jobs, email)
+
         old = sys.argv
         olderr = sys.stderr
+        old_select = saliweb.backend.bulk.select_jobs
+        old_fail = saliweb.backend.bulk.fail_jobs
         try:
+            saliweb.backend.bulk.select_jobs = dummy_select_jobs
+            saliweb.backend.bulk.fail_jobs = dummy_fail_jobs
             sio = StringIO()
             sys.stderr = sio
             mod = DummyModule()
@@ -144,7 +159,25 @@ class FailJobTest(unittest.TestCase):
             main(mod)
             self.assertEqual(sio.getvalue(), '')
             self.assertEqual(mod.job_failed, True)
+
+            # Select jobs in bulk
+            mod = DummyModule()
+            sys.argv = ['testprogram'] + ['-f', '-n', '-s', 'RUNNING', 'a*']
+            main(mod)
+            self.assertEqual(mod.selected, (['RUNNING'], ['a*'], None, None))
+            self.assertEqual(mod.jobs_failed, (['job1', 'job2'], False))
+            mod = DummyModule()
+            sys.argv = ['testprogram'] + ['-f', 'a*']
+            main(mod)
+            # Finished jobs should not be failed unless asked for
+            self.assertEqual(mod.selected[0],
+                             ['INCOMING', 'PREPROCESSING', 'RUNNING',
+                              'POSTPROCESSING', 'FINALIZING'])
+            sys.argv = ['testprogram'] + ['-f', '-s', 'garbage']
+            self.assertRaises(saliweb.backend.InvalidStateError, main, mod)
         finally:
+            saliweb.backend.bulk.select_jobs = old_select
+            saliweb.backend.bulk.fail_jobs = old_fail
             sys.argv = old
             sys.stderr = olderr
 
@@ -4,11 +4,14 @@ import logging
 import datetime
 import os
 import re
+import shutil
 import tempfile
 import testutil
 from memory_database import MemoryDatabase
 from saliweb.backend import WebService, Job, InvalidStateError, Runner
 from saliweb.backend import MySQLField
+import saliweb.backend.mover
+import saliweb.backend.archiver
 from config import Config
 from io import StringIO
 
@@ -67,6 +70,9 @@ class MyJob(Job):
         log = self.logger  # Make sure self.logger is populated
         if self.name == 'fail-preprocess':
             raise ValueError('Failure in preprocessing')
+        if self.name == 'exit-preprocess':
+            # Only used with hooks in worker processes
+            os._exit(1)
         if self.name == 'log-preprocess':
             self.logger.debug("debug message")
             self.logger.info("info message")
@@ -161,6 +167,18 @@ class MyJob(Job):
             return True
 
 
+def process_events(web):
+    """Process all events, including delayed ones, in the queue"""
+    while True:
+        e = web._event_queue.get(timeout=0.2)
+        if e is None:
+            # Wait for any hooks still running in worker processes
+            if web._job_tasks:
+                continue
+            break
+        e.process()
+
+
 def add_incoming_job(db, name):
     c = db.conn.cursor()
     jobdir = os.path.join(db.config.directories['INCOMING'], name)
@@ -173,6 +191,17 @@ def add_incoming_job(db, name):
     return jobdir
 
 
+def set_job_moving(db, name, state, moving_to, directory=None,
+                   runner_id=None):
+    c = db.conn.cursor()
+    c.execute("UPDATE jobs SET state=?,moving_to=?,runner_id=? WHERE name=?",
+              (state, moving_to, runner_id, name))
+    if directory is not None:
+        c.execute("UPDATE jobs SET directory=? WHERE name=?",
+                  (directory, name))
+    db.conn.commit()
+
+
 def add_running_job(db, name, completed):
     c = db.conn.cursor()
     jobdir = os.path.join(db.config.directories['RUNNING'], name)
@@ -282,7 +311,8 @@ def add_finalizing_job(db, name):
     return jobdir
 
 
-def setup_webservice(archive='30d', expire='90d'):
+def setup_webservice(archive='30d', expire='90d', history=False,
+                     move_workers=0):
     tmpdir = tempfile.mkdtemp()
     incoming = os.path.join(tmpdir, 'incoming')
     preprocessing = os.path.join(tmpdir, 'preprocessing')
@@ -292,9 +322,12 @@ def setup_webservice(archive='30d', expire='90d'):
     os.mkdir(failed)
     db = MemoryDatabase(MyJob)
     db.add_field(MySQLField('testfield', 'TEXT'))
+    if history:
+        expire += '\nhistory: True'
     conf = Config(StringIO(basic_config
                            % (incoming, preprocessing, failed, archive,
                               expire)))
+    conf.backend['move_workers'] = move_workers
     web = WebService(conf, db)
     db._create_tables()
     return db, conf, web, tmpdir
@@ -352,6 +385,41 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del injobdir
 
+    def test_group_commit_startup(self):
+        """Check startup of incoming jobs in a single transaction"""
+        db, conf, web, tmpdir = setup_webservice()
+        db.set_group_commit(100)
+        injobdir = add_incoming_job(db, 'job1')
+        with db._unit_of_work():
+            web._process_incoming_jobs()
+            self.assertTrue(db.conn.in_transaction)
+        self.assertFalse(db.conn.in_transaction)
+        job = web.get_job_by_name('RUNNING', 'job1')
+        runjobdir = os.path.join(conf.directories['RUNNING'], 'job1')
+        self.assertEqual(job.directory, runjobdir)
+        self.assertEqual(job._metadata['runner_id'], 'mock:MyJob ID')
+        os.unlink(os.path.join(runjobdir, 'preproc'))
+        os.unlink(os.path.join(runjobdir, 'job-output'))
+        os.rmdir(runjobdir)
+        cleanup_webservice(conf, tmpdir)
+        del injobdir
+
+    def test_sharded_directories(self):
+        """Check moving jobs between flat and sharded directories"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.sharded_directories = True
+        # Job in the flat layout should be moved into the sharded layout
+        injobdir = add_incoming_job(db, 'job1')
+        web._process_incoming_jobs()
+        job = web.get_job_by_name('RUNNING', 'job1')
+        self.assertEqual(job.directory,
+                         os.path.join(conf.directories['RUNNING'], '0f', 'a5',
+                                      'job1'))
+        self.assertTrue(os.path.isdir(job.directory))
+        self.assertFalse(os.path.exists(injobdir))
+        shutil.rmtree(os.path.join(conf.directories['RUNNING'], '0f'))
+        cleanup_webservice(conf, tmpdir)
+
     def test_sanity_check_no_directory(self):
         """Make sure that sanity checks catch jobs without directories"""
         utcnow = testutil._utcnow()
@@ -558,6 +626,10 @@ class JobTest(unittest.TestCase):
         self.assertIsNotNone(job._metadata['end_time'])
         self.assertIsNotNone(job._metadata['archive_time'])
         self.assertIsNotNone(job._metadata['expire_time'])
+        # A check for old jobs should have been scheduled for archival
+        self.assertAlmostEqual(web._old_jobs_due,
+                               job._metadata['archive_time'],
+                               delta=datetime.timedelta(seconds=1))
         # postprocess, finalize, complete methods in MyJob should
         # have triggered
         os.unlink(os.path.join(compjobdir, 'postproc'))
@@ -589,6 +661,7 @@ class JobTest(unittest.TestCase):
         # archive/expire times should still be NULL
         self.assertIsNone(job._metadata['archive_time'])
         self.assertIsNone(job._metadata['expire_time'])
+        self.assertIsNone(web._old_jobs_due)
         os.unlink(os.path.join(jobdir, 'postproc'))
         os.unlink(os.path.join(jobdir, 'finalize'))
         os.unlink(os.path.join(jobdir, 'complete'))
@@ -678,6 +751,17 @@ class JobTest(unittest.TestCase):
         db, conf, web, tmpdir = setup_webservice()
         runjobdir = add_running_job(db, 'fail-batch-complete', completed=False)
         web._process_completed_jobs()
+        # Job should not fail until the job-state file has been checked
+        # several times
+        job = web.get_job_by_name('RUNNING', 'fail-batch-complete')
+        self.assertIsNotNone(job)
+        self.assertEqual(web.state_file_deferrals, 1)
+        # Periodic checks should not schedule more checks
+        web._completion_polls.clear()
+        web._process_completed_jobs()
+        self.assertEqual(web.state_file_deferrals, 1)
+        process_events(web)
+        self.assertGreater(web.state_file_deferrals, 2)
 
         # Job should now have moved from RUNNING to FAILED
         job = web.get_job_by_name('FAILED', 'fail-batch-complete')
@@ -695,6 +779,26 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del runjobdir
 
+    def test_batch_state_file_delay(self):
+        """Check jobs whose job-state file is updated late"""
+        db, conf, web, tmpdir = setup_webservice()
+        runjobdir = add_running_job(db, 'fail-batch-complete', completed=False)
+        web._process_completed_jobs()
+        job = web.get_job_by_name('RUNNING', 'fail-batch-complete')
+        self.assertIsNotNone(job)
+        with open(os.path.join(runjobdir, 'job-state'), 'w') as f:
+            print("DONE", file=f)
+        process_events(web)
+        # Job should now have moved from RUNNING to COMPLETED
+        job = web.get_job_by_name('COMPLETED', 'fail-batch-complete')
+        compjobdir = os.path.join(conf.directories['COMPLETED'],
+                                  'fail-batch-complete')
+        self.assertEqual(job.directory, compjobdir)
+        for f in ('postproc', 'finalize', 'complete', 'batch_complete'):
+            os.unlink(os.path.join(compjobdir, f))
+        os.rmdir(compjobdir)
+        cleanup_webservice(conf, tmpdir)
+
     def test_batch_exception(self):
         """Make sure that exceptions in check_completed are handled"""
         db, conf, web, tmpdir = setup_webservice()
@@ -714,6 +818,198 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del runjobdir
 
+    def test_hook_workers_complete(self):
+        """Check job run and completion with hooks in worker processes"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.backend['hook_workers'] = 2
+        injobdir = add_incoming_job(db, 'job1')
+        runjobdir = add_running_job(db, 'job2', completed=True)
+        web._process_incoming_jobs()
+        web._process_completed_jobs()
+        # Hooks are running in the background
+        self.assertEqual(sorted(web._job_tasks.values()),
+                         ['complete', 'run'])
+        process_events(web)
+        self.assertEqual(web._job_tasks, {})
+
+        # Changes made by hooks in child processes should be kept
+        job = web.get_job_by_name('RUNNING', 'job1')
+        self.assertEqual(job._metadata['testfield'], 'run')
+        self.assertEqual(job._metadata['runner_id'], 'mock:MyJob ID')
+        os.unlink(os.path.join(job.directory, 'preproc'))
+        os.unlink(os.path.join(job.directory, 'job-output'))
+        os.rmdir(job.directory)
+        job = web.get_job_by_name('COMPLETED', 'job2')
+        self.assertEqual(job._metadata['testfield'], 'complete')
+        self.assertIsNotNone(job._metadata['expire_time'])
+        for f in ('postproc', 'finalize', 'complete', 'batch_complete'):
+            os.unlink(os.path.join(job.directory, f))
+        os.rmdir(job.directory)
+        cleanup_webservice(conf, tmpdir)
+        del injobdir, runjobdir
+
+    def test_hook_workers_failure(self):
+        """Check hook failure with hooks in worker processes"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.backend['hook_workers'] = 1
+        injobdir = add_incoming_job(db, 'fail-preprocess')
+        web._process_incoming_jobs()
+        process_events(web)
+
+        job = web.get_job_by_name('FAILED', 'fail-preprocess')
+        # Traceback should be that from the child process
+        self.assert_fail_msg('Python exception:.*Traceback.*preprocess.*'
+                             'ValueError: Failure in preprocessing', job)
+        os.rmdir(job.directory)
+        cleanup_webservice(conf, tmpdir)
+        del injobdir
+
+    def test_hook_workers_exit(self):
+        """Check hook worker process that exits unexpectedly"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.backend['hook_workers'] = 1
+        add_incoming_job(db, 'exit-preprocess')
+        web._process_incoming_jobs()
+        process_events(web)
+        job = web.get_job_by_name('FAILED', 'exit-preprocess')
+        self.assert_fail_msg('Hook process for preprocess exited '
+                             'unexpectedly', job)
+        os.rmdir(job.directory)
+
+        # A new pool should be started for subsequent hooks
+        add_incoming_job(db, 'job1')
+        web._process_incoming_jobs()
+        process_events(web)
+        job = web.get_job_by_name('RUNNING', 'job1')
+        self.assertEqual(job._metadata['testfield'], 'run')
+        shutil.rmtree(job.directory)
+        web._hook_pool.shutdown()
+        cleanup_webservice(conf, tmpdir)
+
+    def test_move_workers(self):
+        """Check job run with directories moved in the background"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=2)
+        old_same = saliweb.backend.mover._same_filesystem
+        try:
+            for same_filesystem in (True, False):
+                saliweb.backend.mover._same_filesystem = \
+                    lambda a, b: same_filesystem
+                injobdir = add_incoming_job(db, 'job1')
+                web._process_incoming_jobs()
+                # Job should change state, but stay in its old directory
+                # until the move finishes
+                self.assertEqual(list(web._job_tasks.values()), ['run'])
+                job = web.get_job_by_name('PREPROCESSING', 'job1')
+                self.assertEqual(job.directory, injobdir)
+                # The move should have been recorded in the database
+                preprocdir = os.path.join(conf.directories['PREPROCESSING'],
+                                          'job1')
+                self.assertEqual(job._metadata['moving_to'], preprocdir)
+                self.assertEqual(db._get_moving_jobs(),
+                                 {'job1': 'PREPROCESSING'})
+                process_events(web)
+                self.assertEqual(web._job_tasks, {})
+                self.assertEqual(db._get_moving_jobs(), {})
+                job = web.get_job_by_name('RUNNING', 'job1')
+                self.assertEqual(job.directory,
+                                 os.path.join(conf.directories['RUNNING'],
+                                              'job1'))
+                self.assertIsNone(job._metadata['moving_to'])
+                self.assertEqual(job._metadata['runner_id'], 'mock:MyJob ID')
+                self.assertFalse(os.path.exists(injobdir))
+                shutil.rmtree(job.directory)
+                job._delete_row()
+        finally:
+            saliweb.backend.mover._same_filesystem = old_same
+        cleanup_webservice(conf, tmpdir)
+
+    def test_move_workers_failure(self):
+        """Check failed background move of a job directory"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=1)
+        injobdir = add_incoming_job(db, 'job1')
+        os.rmdir(conf.directories['PREPROCESSING'])
+        with open(conf.directories['PREPROCESSING'], 'w') as fh:
+            fh.write('not a directory')
+        web._process_incoming_jobs()
+        process_events(web)
+        # Job should have failed, from its original directory
+        job = web.get_job_by_name('FAILED', 'job1')
+        self.assert_fail_msg('Python exception:.*FileExistsError', job)
+        self.assertIsNone(job._metadata['moving_to'])
+        os.rmdir(job.directory)
+        os.unlink(conf.directories['PREPROCESSING'])
+        os.mkdir(conf.directories['PREPROCESSING'])
+        cleanup_webservice(conf, tmpdir)
+        del injobdir
+
+    def test_recover_move_copy(self):
+        """Check recovery of a job interrupted while being copied"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=1)
+        injobdir = add_incoming_job(db, 'job1')
+        preprocdir = os.path.join(conf.directories['PREPROCESSING'], 'job1')
+        partial = saliweb.backend.mover.get_partial_directory(preprocdir)
+        os.mkdir(partial)
+        set_job_moving(db, 'job1', 'PREPROCESSING', preprocdir)
+        web._recover_moves()
+        # Partial copy should be removed and the job left where it was
+        self.assertFalse(os.path.exists(partial))
+        job = web.get_job_by_name('PREPROCESSING', 'job1')
+        self.assertEqual(job.directory, injobdir)
+        self.assertIsNone(job._metadata['moving_to'])
+        self.assertEqual(db._get_moving_jobs(), {})
+        os.rmdir(injobdir)
+        cleanup_webservice(conf, tmpdir)
+
+    def test_recover_move_remove(self):
+        """Check recovery of a job interrupted before removing old dir"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=1)
+        injobdir = add_incoming_job(db, 'job1')
+        runjobdir = os.path.join(conf.directories['RUNNING'], 'job1')
+        os.mkdir(runjobdir)
+        set_job_moving(db, 'job1', 'RUNNING', injobdir, directory=runjobdir,
+                       runner_id='mock:job1')
+        web._recover_moves()
+        # Old copy should be removed
+        self.assertFalse(os.path.exists(injobdir))
+        job = web.get_job_by_name('RUNNING', 'job1')
+        self.assertEqual(job.directory, runjobdir)
+        self.assertIsNone(job._metadata['moving_to'])
+        os.rmdir(runjobdir)
+        cleanup_webservice(conf, tmpdir)
+
+    def test_recover_move_not_started(self):
+        """Check recovery of a moved job that was never started"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=1)
+        injobdir = add_incoming_job(db, 'job1')
+        runjobdir = os.path.join(conf.directories['RUNNING'], 'job1')
+        # Directory was renamed, but this was not recorded
+        os.rename(injobdir, runjobdir)
+        set_job_moving(db, 'job1', 'RUNNING', runjobdir)
+        web._recover_moves()
+        job = web.get_job_by_name('FAILED', 'job1')
+        self.assert_fail_msg('SanityError: Job job1 was moved to the '
+                             'RUNNING state, but the backend stopped', job)
+        self.assertEqual(job.directory,
+                         os.path.join(conf.directories['FAILED'], 'job1'))
+        self.assertIsNone(job._metadata['moving_to'])
+        os.rmdir(job.directory)
+        cleanup_webservice(conf, tmpdir)
+
+    def test_recover_move_lost(self):
+        """Check recovery of a moving job with no directory"""
+        db, conf, web, tmpdir = setup_webservice(move_workers=1)
+        injobdir = add_incoming_job(db, 'job1')
+        os.rmdir(injobdir)
+        set_job_moving(db, 'job1', 'POSTPROCESSING',
+                       os.path.join(conf.directories['POSTPROCESSING'],
+                                    'job1'))
+        web._recover_moves()
+        job = web.get_job_by_name('FAILED', 'job1')
+        self.assert_fail_msg('SanityError: Directory of job job1 was lost',
+                             job)
+        self.assertIsNone(job.directory)
+        cleanup_webservice(conf, tmpdir)
+
     def test_ok_archive(self):
         """Check successful archival of completed jobs"""
         db, conf, web, tmpdir = setup_webservice()
@@ -731,6 +1027,50 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del injobdir
 
+    def test_compressed_archive(self):
+        """Check archival of completed jobs with compression"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.oldjobs['compress'] = 'gzip'
+        injobdir = add_completed_job(db, 'job1', datetime.timedelta(days=-1))
+        with open(os.path.join(injobdir, 'output'), 'w') as fh:
+            fh.write('test output')
+        web._process_old_jobs()
+
+        job = web.get_job_by_name('ARCHIVED', 'job1')
+        self.assertEqual(job._metadata['testfield'], 'archive')
+        # Job directory should contain only the archive (which includes the
+        # file made by the archive method in MyJob) and its index
+        self.assertEqual(sorted(os.listdir(job.directory)),
+                         ['archive.index', 'archive.tar.gz'])
+        with open(os.path.join(job.directory, 'archive.index')) as fh:
+            self.assertEqual([line.split('\t')[3] for line in fh],
+                             ['archive\n', 'output\n'])
+        shutil.rmtree(job.directory)
+        cleanup_webservice(conf, tmpdir)
+
+    def test_compressed_archive_failure(self):
+        """Check that a failure to compress does not fail the job"""
+        def bad_pack(directory, compression):
+            raise OSError("disk full")
+        db, conf, web, tmpdir = setup_webservice()
+        conf.oldjobs['compress'] = 'gzip'
+        add_completed_job(db, 'job1', datetime.timedelta(days=-1))
+        old_pack = saliweb.backend.archiver.pack_directory
+        try:
+            saliweb.backend.archiver.pack_directory = bad_pack
+            web._process_old_jobs()
+        finally:
+            saliweb.backend.archiver.pack_directory = old_pack
+        # Job should be archived, but left uncompressed
+        job = web.get_job_by_name('ARCHIVED', 'job1')
+        self.assertEqual(sorted(os.listdir(job.directory)),
+                         ['archive', 'framework.log'])
+        with open(os.path.join(job.directory, 'framework.log')) as fh:
+            self.assertIn('Could not compress archived job directory: '
+                          'disk full', fh.read())
+        shutil.rmtree(job.directory)
+        cleanup_webservice(conf, tmpdir)
+
     def test_archive_failure(self):
         """Make sure that archival failures are handled correctly"""
         db, conf, web, tmpdir = setup_webservice()
@@ -778,6 +1118,55 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del injobdir
 
+    def test_expire_removed_directory(self):
+        """Check expiry of a job whose directory was already removed"""
+        db, conf, web, tmpdir = setup_webservice()
+        arcjobdir = add_archived_job(db, 'job1', datetime.timedelta(days=-1))
+        # Simulate a crash after the directory was removed but before the
+        # job was marked EXPIRED
+        os.rmdir(arcjobdir)
+        web._filesystem_sanity_check()
+        web._process_old_jobs()
+        job = web.get_job_by_name('EXPIRED', 'job1')
+        self.assertIsNone(job.directory)
+        os.unlink('expire')
+        cleanup_webservice(conf, tmpdir)
+
+    def test_expire_history(self):
+        """Check expiry of archived jobs into the history table"""
+        db, conf, web, tmpdir = setup_webservice(history=True)
+        injobdir = add_archived_job(db, 'job1', datetime.timedelta(days=-1))
+        injobdir = add_archived_job(db, 'fail-expire',
+                                    datetime.timedelta(days=-1))
+        add_expired_job(db, 'oldjob1')
+        add_expired_job(db, 'oldjob2')
+        web._max_history_moves = 1
+        web._process_old_jobs()
+        os.unlink('expire')
+
+        # Only the successfully expired job, and one job that expired
+        # previously, should have moved to the history table
+        self.assertEqual(web.get_job_by_name('EXPIRED', 'job1').directory,
+                         None)
+        self.assertIsNotNone(web.get_job_by_name('FAILED', 'fail-expire'))
+        c = db.conn.cursor()
+        c.execute("SELECT name FROM jobs WHERE state='EXPIRED'")
+        self.assertEqual(len(c.fetchall()), 1)
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 2)
+        self.assertTrue(web._expired_backlog)
+        # Remaining previously expired job should be moved next time
+        web._process_old_jobs()
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 3)
+        web._process_old_jobs()
+        self.assertFalse(web._expired_backlog)
+        self.assertEqual(
+            sorted(j.name for j in db._get_all_jobs_in_state('EXPIRED')),
+            ['job1', 'oldjob1', 'oldjob2'])
+        web.get_job_by_name('EXPIRED', 'oldjob1').delete()
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 2)
+        cleanup_webservice(conf, tmpdir)
+        del injobdir
+
     def test_never_expire(self):
         """Check for jobs that never expire"""
         db, conf, web, tmpdir = setup_webservice()
@@ -808,6 +1197,39 @@ class JobTest(unittest.TestCase):
         cleanup_webservice(conf, tmpdir)
         del injobdir
 
+    def test_parallel_old_jobs(self):
+        """Check archival and expiry of old jobs by a worker pool"""
+        db, conf, web, tmpdir = setup_webservice()
+        conf.backend['oldjob_workers'] = 2
+        conf.oldjobs['compress'] = 'gzip'
+        for i in range(3):
+            add_completed_job(db, 'comp%d' % i, datetime.timedelta(days=-1))
+            add_archived_job(db, 'arc%d' % i,
+                             datetime.timedelta(days=-1 - i))
+        web._max_old_jobs = 2
+        web._process_old_jobs()
+        # Only two jobs should have been archived and expired in the first
+        # pass (the oldest, for expiry)
+        self.assertTrue(web._more_old_jobs)
+        self.assertEqual(db._count_all_jobs_in_state('ARCHIVED'), 3)
+        self.assertEqual(
+            sorted(j.name for j in db._get_all_jobs_in_state('EXPIRED')),
+            ['arc1', 'arc2'])
+        web._process_old_jobs()
+        self.assertEqual(db._count_all_jobs_in_state('EXPIRED'), 3)
+        self.assertEqual(db._count_all_jobs_in_state('COMPLETED'), 0)
+        # The jobs archived in the first pass are not yet due to expire
+        jobs = list(db._get_all_jobs_in_state('ARCHIVED'))
+        self.assertEqual(len(jobs), 3)
+        for job in jobs:
+            self.assertEqual(sorted(os.listdir(job.directory)),
+                             ['archive.index', 'archive.tar.gz'])
+            shutil.rmtree(job.directory)
+        web._process_old_jobs()
+        self.assertFalse(web._more_old_jobs)
+        os.unlink('expire')
+        cleanup_webservice(conf, tmpdir)
+
     def test_ok_resubmit(self):
         """Check successful resubmission of failed jobs"""
         db, conf, web, tmpdir = setup_webservice()
@@ -36,7 +36,7 @@ class Tests(unittest.TestCase):
                 self.name = name
 
         class DummyDatabase(object):
-            def _get_all_jobs_in_state(self, state, order_by):
+            def _get_job_rows(self, state, order_by, stream):
                 if state == 'FAILED':
                     return [DummyJob('foo'), DummyJob('bar')]
                 elif state == 'PREPROCESSING':
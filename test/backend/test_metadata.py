@@ -34,10 +34,16 @@ class MetadataTest(unittest.TestCase):
         self.assertRaises(KeyError, m.__setitem__, 'nokey', 'bar')
         m['key1'] = 'value1'
         self.assertEqual(m.needs_sync(), False)
+        self.assertEqual(m.dirty_keys(), [])
         m['key1'] = 'value2'
         self.assertEqual(m.needs_sync(), True)
+        self.assertEqual(m.dirty_keys(), ['key1'])
+        m['key2'] = 'value3'
+        m['key1'] = 'value4'
+        self.assertEqual(sorted(m.dirty_keys()), ['key1', 'key2'])
         m.mark_synced()
         self.assertEqual(m.needs_sync(), False)
+        self.assertEqual(m.dirty_keys(), [])
 
 
 if __name__ == '__main__':
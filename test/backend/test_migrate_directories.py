@@ -0,0 +1,111 @@
+import unittest
+import sys
+import os
+import shutil
+from saliweb.backend.migrate_directories import (get_options, main,
+                                                 get_new_directory)
+from test_job import (setup_webservice, cleanup_webservice, add_failed_job,
+                      add_incoming_job, add_running_job)
+from io import StringIO
+
+
+class DummyModule(object):
+    def __init__(self, conf, web):
+        self.config = conf
+        self.web = web
+
+    def get_web_service(self, config):
+        return self.web
+
+
+def run_main(mod, args):
+    old = sys.argv
+    oldout = sys.stdout
+    try:
+        sys.stdout = StringIO()
+        sys.argv = ['testprogram'] + args
+        main(mod)
+        return sys.stdout.getvalue()
+    finally:
+        sys.argv = old
+        sys.stdout = oldout
+
+
+class Tests(unittest.TestCase):
+
+    def test_get_options(self):
+        """Test migrate_directories get_options()"""
+        old = sys.argv
+        try:
+            sys.argv = ['testprogram']
+            self.assertEqual(get_options().dry_run, False)
+            sys.argv = ['testprogram', '-n']
+            self.assertEqual(get_options().dry_run, True)
+        finally:
+            sys.argv = old
+
+    def test_get_new_directory(self):
+        """Test get_new_directory()"""
+        class Config(object):
+            sharded_directories = True
+        conf = Config()
+        self.assertEqual(get_new_directory(conf, 'job1', '/foo/job1'),
+                         '/foo/0f/a5/job1')
+        self.assertEqual(get_new_directory(conf, 'job1', '/foo/0f/a5/job1/'),
+                         '/foo/0f/a5/job1')
+        conf.sharded_directories = False
+        self.assertEqual(get_new_directory(conf, 'job1', '/foo/0f/a5/job1'),
+                         '/foo/job1')
+        self.assertEqual(get_new_directory(conf, 'job1', '/foo/job1'),
+                         '/foo/job1')
+
+    def test_main(self):
+        """Test migrate_directories main()"""
+        db, conf, web, tmpdir = setup_webservice()
+        mod = DummyModule(conf, web)
+        faildir = add_failed_job(db, 'job1')
+        indir = add_incoming_job(db, 'job2')
+        rundir = add_running_job(db, 'job3', completed=False)
+        conf.sharded_directories = True
+        # Dry run should not move anything
+        out = run_main(mod, ['--dry-run'])
+        self.assertEqual(len(out.splitlines()), 2)
+        self.assertTrue(os.path.isdir(faildir))
+        self.assertEqual(web.get_job_by_name('FAILED', 'job1').directory,
+                         faildir)
+
+        out = run_main(mod, [])
+        self.assertEqual(len(out.splitlines()), 2)
+        job1 = web.get_job_by_name('FAILED', 'job1')
+        job2 = web.get_job_by_name('INCOMING', 'job2')
+        self.assertEqual(job1.directory,
+                         conf._get_job_directory('FAILED', 'job1'))
+        self.assertEqual(job2.directory,
+                         conf._get_job_directory('INCOMING', 'job2'))
+        self.assertTrue(os.path.isdir(job1.directory))
+        self.assertFalse(os.path.exists(faildir))
+        # Running jobs should not be moved
+        self.assertEqual(web.get_job_by_name('RUNNING', 'job3').directory,
+                         rundir)
+        self.assertEqual(run_main(mod, []),
+                         "All job directories are in the configured layout.\n")
+
+        # Jobs can also be moved back to the flat layout
+        conf.sharded_directories = False
+        run_main(mod, [])
+        self.assertEqual(web.get_job_by_name('FAILED', 'job1').directory,
+                         faildir)
+        self.assertTrue(os.path.isdir(indir))
+
+        # Backend must not be running
+        web.get_running_pid = lambda: 42
+        self.assertRaises(ValueError, run_main, mod, [])
+
+        for d in os.listdir(tmpdir):
+            for sub in os.listdir(os.path.join(tmpdir, d)):
+                shutil.rmtree(os.path.join(tmpdir, d, sub))
+        cleanup_webservice(conf, tmpdir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+import sys
+from saliweb.backend import MySQLIndex
+from saliweb.backend.migrate_indexes import get_options, main
+from io import StringIO
+
+
+class DummyDatabase(object):
+    def __init__(self):
+        self.missing = [('jobs', MySQLIndex('runner_id_index',
+                                            ['runner_id'])),
+                        ('jobs', MySQLIndex('state_submit_index',
+                                            ['state', 'submit_time']))]
+        self.added = []
+
+    def _get_missing_indexes(self):
+        return [m for m in self.missing if m not in self.added]
+
+    def _add_index(self, table, index):
+        self.added.append((table, index))
+
+
+class DummyWebService(object):
+    def __init__(self, mod):
+        self.db = mod.db
+
+
+class DummyModule(object):
+    config = 'testconfig'
+
+    def __init__(self):
+        self.db = DummyDatabase()
+
+    def get_web_service(self, config):
+        return DummyWebService(self)
+
+
+def run_main(mod, args):
+    old = sys.argv
+    oldout = sys.stdout
+    try:
+        sys.stdout = StringIO()
+        sys.argv = ['testprogram'] + args
+        main(mod)
+        return sys.stdout.getvalue()
+    finally:
+        sys.argv = old
+        sys.stdout = oldout
+
+
+class Tests(unittest.TestCase):
+
+    def test_get_options(self):
+        """Test migrate_indexes get_options()"""
+        old = sys.argv
+        try:
+            sys.argv = ['testprogram']
+            self.assertEqual(get_options().dry_run, False)
+            sys.argv = ['testprogram', '-n']
+            self.assertEqual(get_options().dry_run, True)
+        finally:
+            sys.argv = old
+
+    def test_main(self):
+        """Test migrate_indexes main()"""
+        mod = DummyModule()
+        expected = ("CREATE INDEX runner_id_index ON jobs (runner_id);\n"
+                    "CREATE INDEX state_submit_index ON jobs "
+                    "(state, submit_time);\n")
+        # Dry run should not change the database
+        self.assertEqual(run_main(mod, ['--dry-run']), expected)
+        self.assertEqual(mod.db.added, [])
+        self.assertEqual(run_main(mod, []), expected)
+        self.assertEqual(mod.db.added, mod.db.missing)
+        self.assertEqual(run_main(mod, []),
+                         "All database indexes are present.\n")
+
+
+if __name__ == '__main__':
+    unittest.main()
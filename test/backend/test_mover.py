@@ -0,0 +1,100 @@
+import unittest
+import os
+import saliweb.backend.mover
+from saliweb.backend.mover import copy_tree, move_directory
+import testutil
+
+
+def make_job_directory(topdir):
+    os.mkdir(topdir)
+    os.mkdir(os.path.join(topdir, 'subdir'))
+    for fname, contents in (('input', 'test input'),
+                            ('subdir/output', 'x' * 100000),
+                            ('empty', '')):
+        with open(os.path.join(topdir, fname), 'w') as fh:
+            fh.write(contents)
+    os.symlink('input', os.path.join(topdir, 'link'))
+    os.symlink('subdir', os.path.join(topdir, 'dirlink'))
+
+
+class MoverTest(unittest.TestCase):
+    """Check moving of job directories"""
+
+    def assert_job_directory(self, topdir):
+        with open(os.path.join(topdir, 'subdir', 'output')) as fh:
+            self.assertEqual(fh.read(), 'x' * 100000)
+        self.assertEqual(os.path.getsize(os.path.join(topdir, 'empty')), 0)
+        self.assertEqual(os.readlink(os.path.join(topdir, 'link')), 'input')
+        self.assertEqual(os.readlink(os.path.join(topdir, 'dirlink')),
+                         'subdir')
+
+    def test_copy_tree(self):
+        """Test copy_tree()"""
+        with testutil.temp_dir() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            dst = os.path.join(tmpdir, 'dst')
+            make_job_directory(src)
+            copy_tree(src, dst, workers=4)
+            self.assert_job_directory(dst)
+            self.assert_job_directory(src)
+            self.assertEqual(os.stat(src).st_mtime, os.stat(dst).st_mtime)
+
+    def test_copy_tree_verify(self):
+        """Test copy_tree() verification"""
+        def bad_copy(src, dst):
+            with open(dst, 'w') as fh:
+                fh.write('truncated')
+        with testutil.temp_dir() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            make_job_directory(src)
+            old_copy = saliweb.backend.mover._copy_file
+            try:
+                saliweb.backend.mover._copy_file = bad_copy
+                self.assertRaises(OSError, copy_tree, src,
+                                  os.path.join(tmpdir, 'dst'), 1)
+            finally:
+                saliweb.backend.mover._copy_file = old_copy
+
+    def test_move_same_filesystem(self):
+        """Test move_directory() within a filesystem"""
+        with testutil.temp_dir() as tmpdir:
+            src = os.path.join(tmpdir, 'src')
+            dst = os.path.join(tmpdir, 'ab', 'cd', 'dst')
+            make_job_directory(src)
+            self.assertFalse(move_directory(src, dst, 4))
+            self.assertFalse(os.path.exists(src))
+            self.assert_job_directory(dst)
+
+    def test_move_other_filesystem(self):
+        """Test move_directory() between filesystems"""
+        old_same = saliweb.backend.mover._same_filesystem
+        old_copy = saliweb.backend.mover.copy_tree
+        try:
+            saliweb.backend.mover._same_filesystem = lambda a, b: False
+            with testutil.temp_dir() as tmpdir:
+                src = os.path.join(tmpdir, 'src')
+                dst = os.path.join(tmpdir, 'dst')
+                make_job_directory(src)
+                # Leftovers from an interrupted move should be replaced
+                os.mkdir(os.path.join(tmpdir, '.dst.moving'))
+                self.assertTrue(move_directory(src, dst, 4))
+                # Source should be left for the caller to remove
+                self.assert_job_directory(src)
+                self.assert_job_directory(dst)
+                self.assertEqual(sorted(os.listdir(tmpdir)), ['dst', 'src'])
+
+                # Failed copies should be cleaned up
+                def bad_copy(src, dst, workers):
+                    os.mkdir(dst)
+                    raise OSError("copy failed")
+                saliweb.backend.mover.copy_tree = bad_copy
+                self.assertRaises(OSError, move_directory, src,
+                                  os.path.join(tmpdir, 'dst2'), 4)
+                self.assertEqual(sorted(os.listdir(tmpdir)), ['dst', 'src'])
+        finally:
+            saliweb.backend.mover._same_filesystem = old_same
+            saliweb.backend.mover.copy_tree = old_copy
+
+
+if __name__ == '__main__':
+    unittest.main()
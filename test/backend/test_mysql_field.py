@@ -1,5 +1,5 @@
 import unittest
-from saliweb.backend import MySQLField
+from saliweb.backend import MySQLField, MySQLIndex
 
 
 class MySQLFieldTest(unittest.TestCase):
@@ -74,5 +74,28 @@ class MySQLFieldTest(unittest.TestCase):
         self.assertTrue(not a == b)
 
 
+class MySQLIndexTest(unittest.TestCase):
+    """Check MySQLIndex class"""
+
+    def test_get_schema(self):
+        """Check MySQLIndex.get_schema()"""
+        index = MySQLIndex('state_time_index', ['state', 'submit_time'])
+        self.assertEqual(index.fields, ('state', 'submit_time'))
+        self.assertEqual(
+            index.get_schema('jobs'),
+            "CREATE INDEX state_time_index ON jobs (state, submit_time)")
+
+    def test_equals(self):
+        """Check MySQLIndex equality"""
+        a = MySQLIndex('testname', ['state', 'submit_time'])
+        self.assertEqual(a, MySQLIndex('testname', ('state', 'submit_time')))
+        self.assertTrue(not a != MySQLIndex('testname',
+                                            ['state', 'submit_time']))
+        self.assertNotEqual(a, MySQLIndex('othername',
+                                          ['state', 'submit_time']))
+        self.assertNotEqual(a, MySQLIndex('testname',
+                                          ['submit_time', 'state']))
+
+
 if __name__ == '__main__':
     unittest.main()
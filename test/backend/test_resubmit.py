@@ -1,6 +1,7 @@
 import unittest
 import sys
 from saliweb.backend.resubmit import main
+import saliweb.backend.bulk
 from io import StringIO
 
 
@@ -33,9 +34,22 @@ class ResubmitTest(unittest.TestCase):
             def get_web_service(self, config):
                 return DummyWebService(self)
 
+        def dummy_select_jobs(web, states, names, user, older_than):
+            web.mod.selected = (states, names, user, older_than)
+            return ['job1', 'job2']
+
+        def dummy_resubmit_jobs(web, jobs):
+            web.mod.jobs_resubmitted = jobs
+            return jobs
+
         old = sys.argv
         olderr = sys.stderr
+        oldout = sys.stdout
+        old_select = saliweb.backend.bulk.select_jobs
+        old_resubmit = saliweb.backend.bulk.resubmit_jobs
         try:
+            saliweb.backend.bulk.select_jobs = dummy_select_jobs
+            saliweb.backend.bulk.resubmit_jobs = dummy_resubmit_jobs
             sys.stderr = StringIO()
             mod = DummyModule()
             sys.argv = ['testprogram']
@@ -56,9 +70,23 @@ class ResubmitTest(unittest.TestCase):
             main(mod)
             self.assertEqual(sio.getvalue(), '')
             self.assertEqual(mod.job_resub, True)
+
+            # Select jobs in bulk
+            sio = StringIO()
+            sys.stdout = sio
+            mod = DummyModule()
+            sys.argv = ['testprogram'] + ['--user', 'foo']
+            main(mod)
+            self.assertEqual(mod.selected, (['FAILED'], [], 'foo', None))
+            self.assertEqual(mod.jobs_resubmitted, ['job1', 'job2'])
+            self.assertEqual(sio.getvalue(), 'Resubmitted 2 job(s)\n')
+            self.assertEqual(mod.job_resub, False)
         finally:
+            saliweb.backend.bulk.select_jobs = old_select
+            saliweb.backend.bulk.resubmit_jobs = old_resubmit
             sys.argv = old
             sys.stderr = olderr
+            sys.stdout = oldout
 
 
 if __name__ == '__main__':
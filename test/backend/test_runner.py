@@ -20,9 +20,18 @@ class DummyDRMAAModule(object):
 
     class Session(object):
         TIMEOUT_WAIT_FOREVER = 'forever'
+        JOB_IDS_SESSION_ANY = 'any'
+
+
+class DummyJobInfo(object):
+    def __init__(self, jobid):
+        self.jobId = jobid
+        self.wasAborted = False
 
 
 class DummyDRMAASession(object):
+    submitted = []
+
     def jobStatus(self, jobid):
         if jobid == 'donejob':
             raise DummyDRMAAModule.InvalidJobException()
@@ -42,16 +51,18 @@ class DummyDRMAASession(object):
         DummyDRMAASession.deleted_template = jt
 
     def runBulkJobs(self, jt, first, last, step):
-        return ['dummyJob.%d' % x for x in range(first, last+step, step)]
+        jobids = ['dummyJob.%d' % x for x in range(first, last+step, step)]
+        DummyDRMAASession.submitted.extend(jobids)
+        return jobids
 
     def runJob(self, jt):
+        DummyDRMAASession.submitted.append('dummyJob')
         return 'dummyJob'
 
-    def synchronize(self, jobids, timeout, cleanup):
-        pass
-
-    def wait(self, jobids, timeout):
-        return True
+    def wait(self, jobid, timeout):
+        if not DummyDRMAASession.submitted:
+            raise DummyDRMAAModule.InvalidJobException()
+        return DummyJobInfo(DummyDRMAASession.submitted.pop(0))
 
 
 class TestRunner(WyntonSGERunner):
@@ -238,6 +249,87 @@ else:
         self.assertEqual(TestSLURMRunner._check_completed('waitedjob', ''),
                          False)
 
+    @testutil.run_in_tempdir
+    def test_prefetch_status(self):
+        """Check SGERunner._prefetch_status()"""
+        with open('qstat', 'w') as qstat:
+            qstat.write("""#!%s
+import sys
+with open('qstat.log', 'a') as fh:
+    fh.write(' '.join(sys.argv[1:3]) + '\\n')
+if sys.argv[1] == '-xml':
+    print('''<?xml version='1.0'?>
+<job_info>
+  <queue_info>
+    <job_list state="running"><JB_job_number>runningbulk</JB_job_number>
+    </job_list>
+  </queue_info>
+  <job_info>
+    <job_list state="pending"><JB_job_number>pendingbulk</JB_job_number>
+    </job_list>
+  </job_info>
+</job_info>''')
+else:
+    print("Following jobs do not exist:")
+    sys.exit(1)
+""" % sys.executable)
+        os.chmod('qstat', 0o755)
+        TestRunner._qstat = os.path.join(os.getcwd(), 'qstat')
+        TestRunner._prefetch_status(['runningbulk.1-10:1',
+                                     'pendingbulk.1-10:1',
+                                     'donebulk.1-10:1', 'donejob'])
+        try:
+            for jobid, done in (('runningbulk.1-10:1', False),
+                                ('pendingbulk.1-10:1', False),
+                                ('donebulk.1-10:1', True)):
+                self.assertEqual(TestRunner._check_completed(jobid, ''),
+                                 done)
+            # Jobs not in the cache should be queried individually
+            self.assertEqual(TestRunner._check_completed('otherbulk.1-2:1',
+                                                         ''), True)
+        finally:
+            TestRunner._clear_status_cache()
+        with open('qstat.log') as fh:
+            self.assertEqual(fh.read(), '-xml -u\n-j otherbulk\n')
+        # Failure of the bulk query should fall back to individual queries
+        TestRunner._qstat = '/not/exist'
+        TestRunner._prefetch_status(['runningbulk.1-10:1'])
+        self.assertIsNone(TestRunner._status_cache)
+        # Nothing to do if there are no bulk jobs
+        TestRunner._prefetch_status(['donejob'])
+        self.assertIsNone(TestRunner._status_cache)
+
+    @testutil.run_in_tempdir
+    def test_slurm_prefetch_status(self):
+        """Check SLURMRunner._prefetch_status()"""
+        with open('squeue', 'w') as squeue:
+            squeue.write("""#!%s
+print("runningbulk")
+print("")
+""" % sys.executable)
+        os.chmod('squeue', 0o755)
+        TestSLURMRunner._squeue = os.path.join(os.getcwd(), 'squeue')
+        TestSLURMRunner._prefetch_status(['runningbulk_1-10:1',
+                                          'donebulk_1-10:1'])
+        try:
+            self.assertEqual(
+                TestSLURMRunner._check_completed('runningbulk_1-10:1', ''),
+                False)
+            self.assertEqual(
+                TestSLURMRunner._check_completed('donebulk_1-10:1', ''),
+                True)
+        finally:
+            TestSLURMRunner._clear_status_cache()
+
+    def test_get_task_count(self):
+        """Check Runner._get_task_count()"""
+        self.assertEqual(saliweb.backend.LocalRunner._get_task_count('42'), 1)
+        self.assertEqual(TestRunner._get_task_count('123'), 1)
+        self.assertEqual(TestRunner._get_task_count('123.1-10:1'), 10)
+        self.assertEqual(TestRunner._get_task_count('123.4-10:2'), 4)
+        self.assertEqual(TestRunner._get_task_count('123.garbage'), 1)
+        self.assertEqual(TestSLURMRunner._get_task_count('123_1-3:1'), 3)
+
     def test_get_drmaa(self):
         """Check SGERunner._get_drmaa()"""
         class DummyDRMAA(object):
@@ -278,7 +370,7 @@ else:
                              os.path.join(tmpdir, 'sge-script.sh'))
             self.assertEqual(jt.workingDirectory, r._directory)
 
-        # Make sure the waiter threads get time to finish
+        # Make sure the reaper thread gets time to finish
         time.sleep(0.1)
         e1 = ws._event_queue.get(timeout=0.)
         e2 = ws._event_queue.get(timeout=0.)
@@ -327,7 +419,7 @@ else:
                              os.path.join(tmpdir, 'sge-script.sh'))
             self.assertEqual(jt.workingDirectory, r._directory)
 
-        # Make sure the waiter threads get time to finish
+        # Make sure the reaper thread gets time to finish
         time.sleep(0.1)
         e1 = ws._event_queue.get(timeout=0.)
         e2 = ws._event_queue.get(timeout=0.)
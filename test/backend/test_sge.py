@@ -4,7 +4,7 @@ import os
 import sys
 import saliweb.backend
 import saliweb.backend.events
-from saliweb.backend.cluster import _DRMAAJobWaiter, _SGETasks, _DRMAAWrapper
+from saliweb.backend.cluster import _DRMAAReaper, _SGETasks, _DRMAAWrapper
 
 
 class SGETest(unittest.TestCase):
@@ -42,8 +42,8 @@ class SGETest(unittest.TestCase):
         self.assertRaises(ValueError, t.get_run_id,
                           ['foo.1', 'foo.2', 'foo.3'])
 
-    def test_drmaa_waiter(self):
-        """Check the _DRMAAJobWaiter class"""
+    def test_drmaa_reaper(self):
+        """Check the _DRMAAReaper class"""
         events = []
 
         class DummyWebService(object):
@@ -57,22 +57,30 @@ class SGETest(unittest.TestCase):
             def remove(self, key):
                 events.append('remove job dict ' + key)
 
+        class DummyJobInfo(object):
+            def __init__(self, jobid):
+                self.jobId = jobid
+                self.wasAborted = jobid.endswith('fail')
+
         class DummyDRMAAModule(object):
             def __init__(self):
                 class Dummy(object):
                     pass
                 self.Session = Dummy()
                 self.Session.TIMEOUT_WAIT_FOREVER = 'forever'
+                self.Session.JOB_IDS_SESSION_ANY = 'any'
 
-        class DummyDRMAASession(object):
-            def synchronize(self, jobids, timeout, cleanup):
-                events.append('sync %s timeout %s cleanup %s'
-                              % (str(jobids), timeout, str(cleanup)))
+        finished = []
 
+        class DummyDRMAASession(object):
             def wait(self, jobid, timeout):
-                events.append('wait %s timeout %s'
-                              % (str(jobid), timeout))
-                return jobid != 'jobN.fail'
+                events.append('wait %s timeout %s' % (jobid, timeout))
+                while not finished:
+                    time.sleep(0.01)
+                j = finished.pop(0)
+                if j == 'error':
+                    raise RuntimeError("DRMAA error")
+                return DummyJobInfo(j)
 
         class DummyRunner(object):
             _waited_jobs = DummyJobList()
@@ -83,37 +91,65 @@ class SGETest(unittest.TestCase):
                 return DummyDRMAAModule(), DummyDRMAASession()
 
         ws = DummyWebService()
-        runner = DummyRunner()
-        w = _DRMAAJobWaiter(ws, ['jobN.1', 'jobN.2'], runner, 'jobN.1-2:1')
-        w.start()
-        # Give thread time to run (should finish more or less instantly)
+        r = _DRMAAReaper(DummyRunner)
+        r.start()
+        # Job finishing before being added should be handled
+        finished.append('jobM')
+        r.add(ws, ['jobN.1', 'jobN.2'], 'jobN.1-2:1')
+        time.sleep(0.05)
+        r.add(ws, ['jobM'], 'jobM')
+        finished.extend(['jobN.2', 'jobN.1'])
         time.sleep(0.1)
         e = ws._event_queue.get(timeout=0.)
+        self.assertEqual(e.runid, 'jobM')
+        self.assertIsNone(e.run_exception)
+        e = ws._event_queue.get(timeout=0.)
         self.assertEqual(e.runid, 'jobN.1-2:1')
         self.assertIsNone(e.run_exception)
+        self.assertIsNone(ws._event_queue.get(timeout=0.))
+        self.assertEqual(events.count('get drmaa'), 1)
+        self.assertEqual(events.count('wait any timeout forever'), 3)
         self.assertEqual(
-            events,
-            ['add job dict jobN.1-2:1', 'get drmaa',
-             "sync ['jobN.1', 'jobN.2'] timeout forever cleanup False",
-             "wait jobN.1 timeout forever",
-             "wait jobN.2 timeout forever",
-             'remove job dict jobN.1-2:1'])
+            [e for e in events if 'job dict' in e],
+            ['add job dict jobN.1-2:1', 'add job dict jobM',
+             'remove job dict jobM', 'remove job dict jobN.1-2:1'])
         events[:] = []
 
-        w = _DRMAAJobWaiter(ws, ['jobN.1', 'jobN.fail'], runner, 'jobN.1-2:1')
-        w.start()
-        # Give thread time to run (should finish more or less instantly)
+        r.add(ws, ['jobN.1', 'jobN.fail'], 'jobN.1-2:1')
+        finished.extend(['jobN.fail', 'jobN.1'])
         time.sleep(0.1)
         e = ws._event_queue.get(timeout=0.)
         self.assertEqual(e.runid, 'jobN.1-2:1')
         self.assertIsInstance(e.run_exception, saliweb.backend.RunnerError)
+        self.assertIn('jobN.fail', str(e.run_exception))
+        events[:] = []
+
+        # Errors in DRMAA should be retried
+        r._retry_delay = 0.001
+        r._max_failures = 2
+        r.add(ws, ['jobO'], 'jobO')
+        finished.extend(['error', 'jobO'])
+        time.sleep(0.1)
+        e = ws._event_queue.get(timeout=0.)
+        self.assertEqual(e.runid, 'jobO')
+        self.assertEqual(
+            events,
+            ['add job dict jobO', "wait any timeout forever",
+             "wait any timeout forever", 'remove job dict jobO'])
+        events[:] = []
+
+        # Repeated errors should hand all runs back to the backend to poll,
+        # without claiming that they finished
+        r.add(ws, ['jobP.1', 'jobP.2'], 'jobP.1-2:1')
+        finished.extend(['error', 'error'])
+        time.sleep(0.1)
+        self.assertIsNone(ws._event_queue.get(timeout=0.))
         self.assertEqual(
             events,
-            ['add job dict jobN.1-2:1', 'get drmaa',
-             "sync ['jobN.1', 'jobN.fail'] timeout forever cleanup False",
-             "wait jobN.1 timeout forever",
-             "wait jobN.fail timeout forever",
-             'remove job dict jobN.1-2:1'])
+            ['add job dict jobP.1-2:1', "wait any timeout forever",
+             "wait any timeout forever", 'remove job dict jobP.1-2:1'])
+        self.assertEqual(r._runs, {})
+        self.assertEqual(r._runids, {})
 
     def test_drmaa_wrapper(self):
         """Check the _DRMAAWrapper class"""
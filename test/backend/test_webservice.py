@@ -6,6 +6,7 @@ import datetime
 import time
 import sys
 import contextlib
+from unittest import mock
 from test_database import make_test_jobs
 from memory_database import MemoryDatabase
 from config import Config
@@ -60,14 +61,56 @@ class LoggingJob(Job):
 
     def _try_archive(self):
         job_log.append((self.name, 'archive'))
+        yield from ()
 
     def _try_expire(self):
         job_log.append((self.name, 'expire'))
+        yield from ()
 
     def _sanity_check(self):
         job_log.append((self.name, 'sanity_check'))
 
 
+class SimulatedJob(Job):
+    """Test Job subclass that starts running immediately, and records
+       when each job was started"""
+    start_ticks = {}
+    tick = 0
+
+    def _try_run(self, webservice):
+        SimulatedJob.start_ticks[self.name] = SimulatedJob.tick
+        webservice.db._execute("UPDATE jobs SET state='RUNNING' "
+                               "WHERE name=?", (self.name,))
+
+
+def simulate_skewed_load(policy, running=2):
+    """Simulate one user submitting many jobs just before two other users
+       submit a single job each. Return the number of scheduling
+       cycles each job waited before being started. In each cycle, every
+       running job finishes."""
+    db = MemoryDatabase(SimulatedJob)
+    conf = Config(StringIO(basic_config % {'directory': '/'}))
+    conf.limits['running'] = running
+    web = WebService(conf, db)
+    web.scheduling_policy = policy
+    web.create_database_tables()
+    submit_time = testutil._utcnow()
+    jobs = [('heavy%d' % i, 'heavy', None) for i in range(20)] \
+        + [('light1', None, 'light1@test.com'), ('light2', 'light2', None)]
+    for i, (name, user, email) in enumerate(jobs):
+        db._execute("INSERT INTO jobs(name,user,contact_email,state,"
+                    "submit_time,directory,url) VALUES(?,?,?,?,?,?,?)",
+                    (name, user, email, 'INCOMING',
+                     submit_time + datetime.timedelta(seconds=i), '/',
+                     'http://testurl'))
+    SimulatedJob.start_ticks = {}
+    for SimulatedJob.tick in range(len(jobs)):
+        web._process_incoming_jobs()
+        db._execute("UPDATE jobs SET state='COMPLETED' "
+                    "WHERE state='RUNNING'")
+    return SimulatedJob.start_ticks
+
+
 @contextlib.contextmanager
 def mock_setfacl(tmpdir, fail=False):
     setfacl = os.path.join(tmpdir, 'setfacl')
@@ -204,6 +247,70 @@ class WebServiceTest(unittest.TestCase):
         # job1 should not run because it depends on job2
         self.assertEqual(job_log, [])
 
+    def test_incoming_depends_ready(self):
+        """Check that jobs are started once their dependencies complete"""
+        global job_log
+        job_log = []
+        db, conf, web = self._setup_webservice()
+        web._incoming_backlog = False
+        query = "INSERT INTO dependencies(child,parent) VALUES(?,?)"
+        db._execute(query, ('job1', 'job2'))
+        db._execute(query, ('job1', 'job3'))
+        # Dependencies of newly submitted jobs should be read
+        web._process_incoming_jobs({'job1'})
+        self.assertEqual(job_log, [])
+        self.assertIn('job1', db._get_dependency_graph())
+
+        # job1 is not ready until both job2 and job3 complete
+        for name, ready in (('job2', set()), ('job3', {'job1'})):
+            job = web.get_job_by_name('RUNNING', name)
+            db._update_job(job._metadata, 'COMPLETED')
+            web._queue_ready_jobs()
+            e = web._event_queue.get(timeout=0.)
+            if ready:
+                self.assertEqual(e.names, ready)
+            else:
+                self.assertIsNone(e)
+        e.process()
+        self.assertEqual(job_log, [('job1', 'run')])
+
+    def test_incoming_depends_backlog(self):
+        """Check dependencies of new jobs when there is a backlog"""
+        global job_log
+        job_log = []
+        db, conf, web = self._setup_webservice()
+        # Read the dependency graph before the new job is submitted
+        db._get_dependency_graph()
+        utcnow = testutil._utcnow()
+        db._execute("INSERT INTO jobs(name,state,submit_time,directory,url) "
+                    "VALUES(?,?,?,?,?)", ('newjob', 'INCOMING', utcnow, '/',
+                                          'http://testurl'))
+        db._execute("INSERT INTO dependencies(child,parent) VALUES(?,?)",
+                    ('newjob', 'job2'))
+        # All incoming jobs should be checked, since there is a backlog,
+        # but newjob should still wait for job2
+        self.assertTrue(web._incoming_backlog)
+        web._process_incoming_jobs({'newjob'})
+        self.assertFalse(web._incoming_backlog)
+        self.assertEqual(job_log, [('job1', 'run')])
+        self.assertIn('newjob', db._get_dependency_graph())
+
+    def test_check_dependencies(self):
+        """Check WebService._check_dependencies()"""
+        global job_log
+        job_log = []
+        db, conf, web = self._setup_webservice()
+        query = "INSERT INTO dependencies(child,parent) VALUES(?,?)"
+        db._execute(query, ('job1', 'job2'))
+        web._process_incoming_jobs()
+        self.assertEqual(job_log, [])
+        # Remove the dependency behind the backend's back
+        db._execute("DELETE FROM dependencies")
+        web._check_dependencies()
+        web._queue_ready_jobs()
+        e = web._event_queue.get(timeout=0.)
+        self.assertEqual(e.names, {'job1'})
+
     def test_max_running(self):
         """Make sure that limits.running is honored"""
 
@@ -235,6 +342,167 @@ class WebServiceTest(unittest.TestCase):
         web._process_incoming_jobs()
         self.assertEqual(job_log, [('job1', 'run')])
 
+    def test_process_incoming_by_name(self):
+        """Check WebService._process_incoming_jobs() with job names"""
+        global job_log
+
+        def setup_two_incoming():
+            global job_log
+            job_log = []
+            db, conf, web = self._setup_webservice()
+            conf.limits['running'] = 10
+            c = db.conn.cursor()
+            c.execute("INSERT INTO jobs(name,state,submit_time, "
+                      "directory,url) VALUES(?,?,?,?,?)",
+                      ('injob2', 'INCOMING', testutil._utcnow(),
+                       '/', 'http://testurl'))
+            db.conn.commit()
+            return db, conf, web
+
+        # On startup, all jobs should be checked
+        db, conf, web = setup_two_incoming()
+        web._process_incoming_jobs({'injob2'})
+        self.assertEqual(job_log, [('job1', 'run'), ('injob2', 'run')])
+        self.assertFalse(web._incoming_backlog)
+
+        # Otherwise, only the named jobs should be checked
+        db, conf, web = setup_two_incoming()
+        web._incoming_backlog = False
+        # All of the named jobs should be read in a single query
+        with mock.patch.object(db, '_get_all_jobs_in_state',
+                               wraps=db._get_all_jobs_in_state) as m:
+            web._process_incoming_jobs({'injob2', 'nosuchjob'})
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(job_log, [('injob2', 'run')])
+
+        # If the job limit was hit, all jobs should be checked next time
+        db, conf, web = setup_two_incoming()
+        conf.limits['running'] = 3
+        web._process_incoming_jobs()
+        self.assertEqual(job_log, [('job1', 'run')])
+        self.assertTrue(web._incoming_backlog)
+        job_log = []
+        conf.limits['running'] = 10
+        web._process_incoming_jobs({'nosuchjob'})
+        self.assertEqual(job_log, [('job1', 'run'), ('injob2', 'run')])
+
+    def test_max_running_tasks(self):
+        """Make sure that limits.running_tasks is honored"""
+
+        def setup_two_incoming(running_tasks):
+            global job_log
+            job_log = []
+            db, conf, web = self._setup_webservice()
+            conf.limits['running_tasks'] = running_tasks
+            c = db.conn.cursor()
+            # job2 is an array job with 10 tasks
+            c.execute("UPDATE jobs SET runner_id=? WHERE name=?",
+                      ('wyntonsge:123.1-10:1', 'job2'))
+            c.execute("INSERT INTO jobs(name,state,submit_time, "
+                      "directory,url) VALUES(?,?,?,?,?)",
+                      ('injob2', 'INCOMING', testutil._utcnow(),
+                       '/', 'http://testurl'))
+            db.conn.commit()
+            return db, conf, web
+
+        # No jobs should be run if the limit is already met
+        db, conf, web = setup_two_incoming(11)
+        # Only the runner IDs of running jobs should be read
+        with mock.patch.object(Job, '__init__', side_effect=AssertionError):
+            self.assertEqual(web._count_running_tasks(), 11)
+        web._process_incoming_jobs()
+        self.assertEqual(job_log, [])
+
+        # Only one incoming job should be run if the limit is reached
+        db, conf, web = setup_two_incoming(12)
+        web._process_incoming_jobs()
+        self.assertEqual(job_log, [('job1', 'run')])
+
+        # Both incoming jobs should be run if the limit permits it
+        db, conf, web = setup_two_incoming(20)
+        web._process_incoming_jobs()
+        self.assertEqual(job_log, [('job1', 'run'), ('injob2', 'run')])
+
+    def test_fair_share(self):
+        """Check FairShareSchedulingPolicy under a skewed load"""
+        fifo = simulate_skewed_load(saliweb.backend.SchedulingPolicy())
+        fair = simulate_skewed_load(
+            saliweb.backend.FairShareSchedulingPolicy())
+        # All jobs should run eventually
+        self.assertEqual(len(fifo), 22)
+        self.assertEqual(len(fair), 22)
+        # With FIFO, light users wait for all of the heavy user's jobs
+        self.assertEqual((fifo['light1'], fifo['light2']), (10, 10))
+        # With fair share, light users get the next free slots
+        self.assertEqual((fair['light1'], fair['light2']), (0, 1))
+        self.assertEqual(max(fair.values()), 10)
+
+    def test_fair_share_ties(self):
+        """Check FairShareSchedulingPolicy tie-breaking"""
+        class DummyJob(object):
+            def __init__(self, name, user):
+                self.name = name
+                self._metadata = {'user': user}
+
+        class DummyDatabase(object):
+            def _count_jobs_in_state_by(self, state, fields):
+                return {}
+
+        class DummyWebService(object):
+            db = DummyDatabase()
+        policy = saliweb.backend.FairShareSchedulingPolicy(fields=['user'])
+        # Jobs are given in submit order; ties go to the user whose oldest
+        # job was submitted first, not to the oldest remaining job
+        jobs = [DummyJob('a1', 'a'), DummyJob('b1', 'b'),
+                DummyJob('b2', 'b'), DummyJob('a2', 'a')]
+        self.assertEqual(
+            [j.name for j in policy.order_jobs(DummyWebService(), jobs)],
+            ['a1', 'b1', 'a2', 'b2'])
+
+    def test_fair_share_running(self):
+        """FairShareSchedulingPolicy should favor users with no running jobs"""
+        db, conf, web = self._setup_webservice()
+        web.scheduling_policy = saliweb.backend.FairShareSchedulingPolicy()
+        c = db.conn.cursor()
+        # job2 (running) and job1 (incoming) belong to the same user
+        c.execute("UPDATE jobs SET user='heavy' WHERE name IN (?,?)",
+                  ('job1', 'job2'))
+        c.execute("INSERT INTO jobs(name,state,submit_time,user, "
+                  "directory,url) VALUES(?,?,?,?,?,?)",
+                  ('injob2', 'INCOMING', testutil._utcnow(), 'light',
+                   '/', 'http://testurl'))
+        db.conn.commit()
+        jobs = list(db._get_all_jobs_in_state('INCOMING',
+                                              order_by='submit_time'))
+        self.assertEqual([j.name for j in jobs], ['job1', 'injob2'])
+        self.assertEqual(
+            [j.name for j in web.scheduling_policy.order_jobs(web, jobs)],
+            ['injob2', 'job1'])
+
+        # If both users have a running job, the earliest submission wins
+        c.execute("UPDATE jobs SET user='light' WHERE name=?", ('job3',))
+        db.conn.commit()
+        self.assertEqual(
+            [j.name for j in web.scheduling_policy.order_jobs(web, jobs)],
+            ['job1', 'injob2'])
+
+        # Reducing the heavy user's weight should favor the light user
+        class WeightedPolicy(saliweb.backend.FairShareSchedulingPolicy):
+            def get_weight(self, key):
+                return 0.5 if key == ('user', 'heavy') else 1
+        web.scheduling_policy = WeightedPolicy(fields=['user'])
+        self.assertEqual(
+            [j.name for j in web.scheduling_policy.order_jobs(web, jobs)],
+            ['injob2', 'job1'])
+
+        # Weights must be positive
+        class ZeroWeightPolicy(saliweb.backend.FairShareSchedulingPolicy):
+            def get_weight(self, key):
+                return 0 if key == ('user', 'heavy') else 1
+        web.scheduling_policy = ZeroWeightPolicy(fields=['user'])
+        self.assertRaises(ValueError, list,
+                          web.scheduling_policy.order_jobs(web, jobs))
+
     def test_fatal_error_propagated(self):
         """Make sure that fatal errors are propagated"""
         db, conf, web = self._setup_webservice()
@@ -277,7 +545,61 @@ class WebServiceTest(unittest.TestCase):
         job_log = []
         db, conf, web = self._setup_webservice()
         web._process_completed_jobs()
-        self.assertEqual(job_log, [('job2', 'complete'), ('job3', 'complete')])
+        # Jobs are processed in index order, not necessarily insertion order
+        self.assertEqual(sorted(job_log),
+                         [('job2', 'complete'), ('job3', 'complete')])
+
+    def test_process_completed_waited(self):
+        """Check that _process_completed_jobs() skips waited jobs"""
+        global job_log
+        job_log = []
+        db, conf, web = self._setup_webservice()
+        waited = saliweb.backend.WyntonSGERunner._waited_jobs
+        waited.add('job-2')
+        try:
+            web._process_completed_jobs()
+        finally:
+            waited.remove('job-2')
+        self.assertEqual(job_log, [('job3', 'complete')])
+
+    def test_process_completed_prefetch(self):
+        """Check that _process_completed_jobs() prefetches job status"""
+        global job_log
+        job_log = []
+        db, conf, web = self._setup_webservice()
+        calls = []
+        runnercls = saliweb.backend.WyntonSGERunner
+
+        def prefetch(cls, jobids):
+            calls.append(('prefetch', jobids))
+
+        def clear(cls):
+            calls.append('clear')
+        runnercls._prefetch_status = classmethod(prefetch)
+        runnercls._clear_status_cache = classmethod(clear)
+        try:
+            web._process_completed_jobs()
+        finally:
+            del runnercls._prefetch_status
+            del runnercls._clear_status_cache
+        # job3 has an invalid runner ID, so is not prefetched
+        self.assertEqual(calls, [('prefetch', ['job-2']), 'clear'])
+        # Jobs are processed in index order, not necessarily insertion order
+        self.assertEqual(sorted(job_log),
+                         [('job2', 'complete'), ('job3', 'complete')])
+
+    def test_process_completed_backoff(self):
+        """Check that _process_completed_jobs() polls less often over time"""
+        global job_log
+        db, conf, web = self._setup_webservice()
+        polled = []
+        for i in range(8):
+            job_log = []
+            web._process_completed_jobs()
+            polled.append(len(job_log))
+        # Jobs that are still running should be polled on the first check,
+        # then every other check, then every 4th check
+        self.assertEqual(polled, [2, 0, 2, 0, 0, 0, 2, 0])
 
     def test_process_old(self):
         """Check WebService._process_old_jobs()"""
@@ -288,6 +610,82 @@ class WebServiceTest(unittest.TestCase):
         self.assertEqual(job_log, [(u'ready-for-archive', 'archive'),
                                    (u'ready-for-expire', 'expire')])
 
+    def test_schedule_old_jobs(self):
+        """Check WebService._schedule_old_jobs()"""
+        def get_delays(q):
+            return sorted(d[0] - time.time() for d in q.delayed)
+        db, conf, web = self._setup_webservice()
+        web._event_queue = q = saliweb.backend.events._EventQueue()
+        # Jobs are already due, so should be checked after the retry delay
+        web._schedule_old_jobs()
+        delays = get_delays(q)
+        self.assertEqual(len(delays), 1)
+        self.assertAlmostEqual(delays[0], 60., delta=5.)
+        # A later check should not be scheduled
+        web._schedule_old_jobs(testutil._utcnow()
+                               + datetime.timedelta(days=1))
+        self.assertEqual(len(q.delayed), 1)
+        # An earlier one should
+        due = testutil._utcnow() + datetime.timedelta(seconds=30)
+        web._schedule_old_jobs(due)
+        self.assertEqual(web._old_jobs_due, due)
+        delays = get_delays(q)
+        self.assertEqual(len(delays), 2)
+        self.assertAlmostEqual(delays[0], 30., delta=5.)
+
+        # Nothing to schedule if there are no old jobs
+        db._execute("DELETE FROM jobs")
+        web._event_queue = q = saliweb.backend.events._EventQueue()
+        web._schedule_old_jobs()
+        self.assertIsNone(web._old_jobs_due)
+        self.assertEqual(len(q.delayed), 0)
+        # ... unless there is a backlog of expired jobs
+        web._expired_backlog = True
+        web._schedule_old_jobs()
+        delays = get_delays(q)
+        self.assertEqual(len(delays), 1)
+        self.assertAlmostEqual(delays[0], web._get_oldjob_interval(),
+                               delta=5.)
+
+    def test_run_old_job_tasks(self):
+        """Check WebService._run_old_job_tasks()"""
+        def task(name, log):
+            log.append(name + ' start')
+            result = yield lambda: name + ' action'
+            log.append(result)
+            try:
+                yield lambda: 1 / 0
+            except ZeroDivisionError:
+                log.append(name + ' error')
+
+        def empty_task(log):
+            log.append('empty')
+            yield from ()
+        db, conf, web = self._setup_webservice()
+        for workers in (0, 2):
+            conf.backend['oldjob_workers'] = workers
+            log = []
+            web._run_old_job_tasks([task('a', log), empty_task(log),
+                                    task('b', log)])
+            # Each task should be run up to its first action before any
+            # are resumed, and should see the result or exception from
+            # its own actions
+            self.assertEqual(log, ['a start', 'empty', 'b start',
+                                   'a action', 'b action',
+                                   'a error', 'b error'])
+
+    def test_schedule_more_old_jobs(self):
+        """Check WebService._schedule_old_jobs() with more jobs to do"""
+        db, conf, web = self._setup_webservice()
+        web._event_queue = q = saliweb.backend.events._EventQueue()
+        web._more_old_jobs = True
+        web._schedule_old_jobs()
+        # Next pass should be queued to run straight away
+        self.assertEqual(len(q.delayed), 0)
+        e = q.get(timeout=0.)
+        self.assertIsInstance(e, saliweb.backend.events._OldJobsEvent)
+        self.assertEqual(e.due, web._old_jobs_due)
+
     def test_all_processing(self):
         """Check WebService.do_all_processing()"""
         global job_log
@@ -387,6 +785,120 @@ class WebServiceTest(unittest.TestCase):
         db.conn.commit()
         self.assertRaises(SanityError, web._filesystem_sanity_check)
 
+    @testutil.run_in_tempdir
+    def test_filesystem_sanity_check_expiring(self):
+        """Check _filesystem_sanity_check() with removed expired job dir"""
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db, conf, web = self._setup_webservice('.')
+        c = db.conn.cursor()
+        utcnow = testutil._utcnow()
+        c.execute("INSERT INTO jobs(name,state,submit_time,expire_time, "
+                  "directory,url) VALUES(?,?,?,?,?,?)",
+                  ('expiring', 'ARCHIVED', utcnow,
+                   utcnow - datetime.timedelta(days=1), '/not/exist',
+                   'http://testurl'))
+        db.conn.commit()
+        # Directory is not needed for an ARCHIVED job that should be expired
+        web._filesystem_sanity_check()
+        c.execute("UPDATE jobs SET expire_time=? WHERE name='expiring'",
+                  (utcnow + datetime.timedelta(days=1),))
+        db.conn.commit()
+        self.assertRaises(SanityError, web._filesystem_sanity_check)
+
+    @testutil.run_in_tempdir
+    def test_filesystem_sanity_check_sharded(self):
+        """Check WebService._filesystem_sanity_check() with sharded dirs"""
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db, conf, web = self._setup_webservice('.')
+        c = db.conn.cursor()
+        utcnow = testutil._utcnow()
+        # Jobs in both flat and sharded layouts; a flat job directory whose
+        # name looks like a shard should not be treated as one
+        for name, jobdir in (('shardjob', 'incoming/e9/e4/shardjob'),
+                             ('ab', 'incoming/ab')):
+            os.makedirs(os.path.join(jobdir, 'cd'))
+            c.execute("INSERT INTO jobs(name,state,submit_time,directory,url) "
+                      "VALUES(?,?,?,?,?)", (name, 'INCOMING', utcnow, jobdir,
+                                            'http://testurl'))
+        db.conn.commit()
+        web._filesystem_sanity_check()
+        # Empty shard directories are fine
+        os.makedirs('incoming/12/34')
+        web._filesystem_sanity_check()
+        # Garbage files and directories in shards are not
+        with open('incoming/12/34/garbage-file', 'w') as fh:
+            fh.write('test')
+        self.assertRaises(SanityError, web._filesystem_sanity_check)
+        os.unlink('incoming/12/34/garbage-file')
+        os.mkdir('incoming/12/34/garbage-job')
+        self.assertRaises(SanityError, web._filesystem_sanity_check)
+        os.rmdir('incoming/12/34/garbage-job')
+        os.mkdir('incoming/12/garbage-job')
+        self.assertRaises(SanityError, web._filesystem_sanity_check)
+
+    @testutil.run_in_tempdir
+    def test_clean_shutdown_marker(self):
+        """Check writing and reading the clean shutdown marker"""
+        db, conf, web = self._setup_webservice('.')
+        self.assertIsNone(web._read_clean_shutdown_marker())
+        web._write_clean_shutdown_marker()
+        self.assertTrue(os.path.exists('state_file.clean'))
+        marker_time, counts = web._read_clean_shutdown_marker()
+        self.assertAlmostEqual(marker_time, time.time(), delta=10.)
+        self.assertEqual(counts, {'INCOMING': 1, 'RUNNING': 2,
+                                  'PREPROCESSING': 1, 'POSTPROCESSING': 1,
+                                  'FINALIZING': 1, 'COMPLETED': 2,
+                                  'ARCHIVED': 1})
+        # Marker should only be used once
+        self.assertFalse(os.path.exists('state_file.clean'))
+        self.assertIsNone(web._read_clean_shutdown_marker())
+        # Bad markers should be ignored
+        with open('state_file.clean', 'w') as fh:
+            fh.write('garbage\n')
+        self.assertIsNone(web._read_clean_shutdown_marker())
+        self.assertFalse(os.path.exists('state_file.clean'))
+
+    @testutil.run_in_tempdir
+    def test_filesystem_sanity_check_clean_shutdown(self):
+        """Check WebService._filesystem_sanity_check() after clean shutdown"""
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db, conf, web = self._setup_webservice('.')
+        web._write_clean_shutdown_marker()
+        marker = web._read_clean_shutdown_marker()
+        # Nothing changed since the marker, so directories are not checked
+        with open('incoming/garbage-file', 'w') as fh:
+            fh.write('test')
+        os.utime('incoming', (marker[0] - 100., marker[0] - 100.))
+        os.utime('preprocessing', (marker[0] - 100., marker[0] - 100.))
+        web._filesystem_sanity_check(marker)
+        self.assertEqual(web._get_changed_directories(
+            {'incoming': ['INCOMING']}, *marker), {})
+        # Directory changed since the marker
+        os.utime('incoming', (marker[0] + 100., marker[0] + 100.))
+        self.assertRaises(SanityError, web._filesystem_sanity_check, marker)
+        os.unlink('incoming/garbage-file')
+        os.utime('incoming', (marker[0] - 100., marker[0] - 100.))
+        web._filesystem_sanity_check(marker)
+        # Database changed since the marker
+        c = db.conn.cursor()
+        utcnow = testutil._utcnow()
+        c.execute("INSERT INTO jobs(name,state,submit_time,directory,url) "
+                  "VALUES(?,?,?,?,?)", ('badjobdir', 'INCOMING', utcnow,
+                                        '/not/exist', 'http://testurl'))
+        db.conn.commit()
+        self.assertEqual(web._get_changed_directories(
+            {'incoming': ['INCOMING'], 'preprocessing': ['FAILED']},
+            *marker), {'incoming': ['INCOMING']})
+        self.assertRaises(SanityError, web._filesystem_sanity_check, marker)
+        c.execute("DELETE FROM jobs WHERE name='badjobdir'")
+        db.conn.commit()
+        # Extra directories are found too
+        os.mkdir('incoming/garbage-job')
+        self.assertRaises(SanityError, web._filesystem_sanity_check, marker)
+
     @testutil.run_in_tempdir
     def test_filesystem_sanity_check_nojobdir(self):
         """Check WebService._filesystem_sanity_check() with no job dir"""
@@ -415,8 +927,9 @@ class WebServiceTest(unittest.TestCase):
         os.mkdir('incoming')
         os.mkdir('preprocessing')
         db, conf, web = self._setup_webservice('.')
-        # Make directory with no corresponding job database row
+        # Make directories with no corresponding job database row
         os.mkdir('incoming/badjob')
+        os.mkdir('incoming/badjob2')
         # Make job with non-existing directory
         c = db.conn.cursor()
         utcnow = testutil._utcnow()
@@ -428,12 +941,65 @@ class WebServiceTest(unittest.TestCase):
         db.conn.commit()
         web._cleanup_dir = _cleanup_dir
         web._cleanup_incoming_jobs()
-        self.assertEqual(len(cleaned_dirs), 1)
+        cleaned_dirs.sort()
+        self.assertEqual(len(cleaned_dirs), 2)
         self.assertTrue(cleaned_dirs[0][0].endswith('/incoming/badjob'))
+        self.assertTrue(cleaned_dirs[1][0].endswith('/incoming/badjob2'))
         self.assertEqual(cleaned_dirs[0][1], 3600.)
         # Cleanup of zero directories should also work
         web._cleanup_incoming_jobs()
 
+    @testutil.run_in_tempdir
+    def test_cleanup_incoming_jobs_sharded(self):
+        """Test WebSerivce._cleanup_incoming_jobs() with sharded dirs"""
+        cleaned_dirs = []
+
+        def _cleanup_dir(dir, age):
+            cleaned_dirs.append(dir)
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db, conf, web = self._setup_webservice('.')
+        os.makedirs('incoming/e9/e4/shardjob')
+        os.makedirs('incoming/12/34/badjob')
+        os.makedirs('incoming/ab/cd')
+        c = db.conn.cursor()
+        utcnow = testutil._utcnow()
+        for name in ('shardjob', 'ab'):
+            c.execute("INSERT INTO jobs(name,state,submit_time,directory,url) "
+                      "VALUES(?,?,?,?,?)", (name, 'INCOMING', utcnow,
+                                            '/not/exist', 'http://testurl'))
+        db.conn.commit()
+        web._cleanup_dir = _cleanup_dir
+        web._cleanup_incoming_jobs()
+        self.assertEqual(cleaned_dirs, ['./incoming/12/34/badjob'])
+
+    @testutil.run_in_tempdir
+    def test_cleanup_incoming_jobs_moving(self):
+        """Test _cleanup_incoming_jobs() with directories being moved"""
+        cleaned_dirs = []
+
+        def _cleanup_dir(dir, age):
+            cleaned_dirs.append(dir)
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db = MemoryDatabase(LoggingJob)
+        conf = Config(StringIO(basic_config % {'directory': '.'}))
+        conf.backend['move_workers'] = 1
+        web = WebService(conf, db)
+        web.create_database_tables()
+        os.mkdir('incoming/movingjob')
+        os.mkdir('incoming/badjob')
+        c = db.conn.cursor()
+        utcnow = testutil._utcnow()
+        c.execute("INSERT INTO jobs(name,state,submit_time,directory,url, "
+                  "moving_to) VALUES(?,?,?,?,?,?)",
+                  ('movingjob', 'PREPROCESSING', utcnow, 'incoming/movingjob',
+                   'http://testurl', 'preprocessing/movingjob'))
+        db.conn.commit()
+        web._cleanup_dir = _cleanup_dir
+        web._cleanup_incoming_jobs()
+        self.assertEqual(cleaned_dirs, ['./incoming/badjob'])
+
     @testutil.run_in_tempdir
     def test_cleanup_dir(self):
         """Test WebService._cleanup_dir() method"""
@@ -463,10 +1029,38 @@ class WebServiceTest(unittest.TestCase):
         # Cleanup of non-existent directory should be OK
         web._cleanup_dir("baddir", 0.05)
 
+    @testutil.run_in_tempdir
+    def test_cleanup_dir_nested(self):
+        """Test WebService._cleanup_dir() with nested subdirectories"""
+        os.mkdir('incoming')
+        os.mkdir('preprocessing')
+        db, conf, web = self._setup_webservice('.')
+        old = time.time() - 1000.
+        for d in ('dir1', 'dir2'):
+            os.makedirs(os.path.join(d, 'sub1', 'sub2'))
+            for f in ('file1', 'sub1/file2', 'sub1/sub2/file3'):
+                with open(os.path.join(d, f), 'w') as fh:
+                    fh.write('test')
+        # Everything in dir1 is old; dir2 has a recently-modified file
+        # deep in a subdirectory (e.g. an upload still in progress)
+        for d in ('dir1', 'dir2'):
+            for f in ('sub1/sub2/file3', 'sub1/sub2', 'sub1/file2', 'sub1',
+                      'file1', '.'):
+                if d != 'dir2' or f != 'sub1/sub2/file3':
+                    os.utime(os.path.join(d, f), (old, old))
+        web._cleanup_dir("dir1", 100.)
+        web._cleanup_dir("dir2", 100.)
+        self.assertFalse(os.path.exists("dir1"))
+        self.assertTrue(os.path.exists("dir2"))
+        self.assertTrue(saliweb.backend._modified_since("dir2", old + 10.))
+        self.assertFalse(saliweb.backend._modified_since(
+            "dir2", time.time() + 10.))
+
     def test_periodic_actions(self):
         """Test WebService._do_periodic_actions() method"""
         threads = []
         events = []
+        units = []
 
         class DummyEvent(object):
             def __init__(self, name):
@@ -476,9 +1070,27 @@ class WebServiceTest(unittest.TestCase):
                 events.append(self.name)
         queue = [None, DummyEvent('foo'), DummyEvent('bar'), None]
 
+        class DummyDatabase(object):
+            def _pop_ready_jobs(self):
+                return set()
+
+            @contextlib.contextmanager
+            def _unit_of_work(self):
+                units.append(list(events))
+                yield
+
         class DummyWebService(WebService):
             def __init__(self):
-                pass
+                self.db = DummyDatabase()
+
+            def _schedule_periodic_check(self):
+                threads.append('periodic')
+
+            def _schedule_cleanup_incoming_jobs(self):
+                threads.append('cleanup')
+
+            def _schedule_old_jobs(self):
+                threads.append('oldjobs')
 
         def make_thread(name):
             class DummyThread(object):
@@ -491,21 +1103,24 @@ class WebServiceTest(unittest.TestCase):
 
         class DummyEvents(object):
             class _EventQueue(object):
+                stats = {'last_wait': 0., 'depth': 0}
+
                 def get(self, timeout):
                     return queue.pop()
         e = DummyEvents()
-        for t in ['_PeriodicCheck', '_IncomingJobs', '_OldJobs',
-                  '_CleanupIncomingJobs']:
-            setattr(e, t, make_thread(t))
+        e._IncomingJobs = make_thread('_IncomingJobs')
         oldev = saliweb.backend.events
         w = DummyWebService()
         try:
             saliweb.backend.events = e
             # queue is finite, so will hit the end eventually (IndexError)
             self.assertRaises(IndexError, w._do_periodic_actions, None)
-            self.assertEqual(threads, ['_PeriodicCheck', '_IncomingJobs',
-                                       '_OldJobs', '_CleanupIncomingJobs'])
+            # Only incoming jobs need a thread; the rest are scheduled
+            self.assertEqual(threads, ['_IncomingJobs', 'periodic',
+                                       'cleanup', 'oldjobs'])
             self.assertEqual(events, ['bar', 'foo'])
+            # Each event should be processed in its own unit of work
+            self.assertEqual(units, [[], ['bar']])
         finally:
             saliweb.backend.events = oldev
 
@@ -0,0 +1,83 @@
+"""Web service module used by a script generated by _make_script() that
+   runs job hooks in worker processes (see test_make.py). This is copied
+   to webservice.py, and also acts as the script's
+   saliweb.backend.hooktest module."""
+
+import os
+import sys
+from io import StringIO
+import saliweb.backend
+from saliweb.backend.engines import SQLiteEngine
+
+config_text = """
+[general]
+admin_email: testadmin@salilab.org
+service_name: test_service
+socket: test.socket
+
+[backend]
+user: test
+state_file: state_file
+check_minutes: 10
+hook_workers: 1
+
+[database]
+db: test.db
+frontend_config: frontend.conf
+backend_config: backend.conf
+
+[directories]
+install: /
+incoming: incoming
+preprocessing: preprocessing
+completed: completed
+
+[oldjobs]
+archive: 30d
+expire: 90d
+"""
+
+
+class Job(saliweb.backend.Job):
+    def preprocess(self):
+        self._metadata['testfield'] = str(os.getpid())
+        self.skip_run()
+
+
+class Database(saliweb.backend.Database):
+    def get_engine(self, config):
+        return SQLiteEngine(':memory:')
+
+
+def main(webservice):
+    for d in ('incoming', 'preprocessing', 'completed'):
+        os.mkdir(d)
+    with open('backend.conf', 'w') as fh:
+        fh.write('[backend_db]\nuser: test\npasswd: test\n')
+    db = Database(Job)
+    db.add_field(saliweb.backend.MySQLField('testfield', 'TEXT'))
+    web = saliweb.backend.WebService(
+        saliweb.backend.Config(StringIO(config_text)), db)
+    db._create_tables()
+    jobdir = os.path.abspath(os.path.join('incoming', 'job1'))
+    os.mkdir(jobdir)
+    db.conn.execute("INSERT INTO jobs(name,state,submit_time,directory,url) "
+                    "VALUES('job1','INCOMING',?,?,'url')",
+                    (saliweb.backend._utcnow(), jobdir))
+    db.conn.commit()
+    web._process_incoming_jobs()
+    # Wait for the hook to finish in the worker process
+    while True:
+        e = web._event_queue.get(timeout=0.2)
+        if e is not None:
+            e.process()
+        elif not web._job_tasks:
+            break
+    web._hook_pool.shutdown()
+    job = web.get_job_by_name('COMPLETED', 'job1')
+    print("main pid %d hook pid %s" % (os.getpid(),
+                                       job._metadata['testfield']))
+
+
+saliweb.backend.hooktest = sys.modules['saliweb.backend.hooktest'] \
+    = sys.modules[__name__]
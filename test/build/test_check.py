@@ -503,11 +503,18 @@ class CheckTest(unittest.TestCase):
             "DATETIME, finalize_time DATETIME, end_time DATETIME, "
             "archive_time DATETIME, expire_time DATETIME, "
             "runner_id VARCHAR(200), failure TEXT);\n"
-            "CREATE INDEX state_index ON testdb.jobs (state);\n"
             "CREATE TABLE testdb.dependencies (child VARCHAR(40) NOT NULL "
             "DEFAULT '', parent VARCHAR(40) NOT NULL DEFAULT '');\n"
+            "CREATE INDEX state_index ON testdb.jobs (state);\n"
+            "CREATE INDEX runner_id_index ON testdb.jobs (runner_id);\n"
             "CREATE INDEX child_index ON testdb.dependencies (child);\n"
             "CREATE INDEX parent_index ON testdb.dependencies (parent);\n"
+            "CREATE INDEX state_submit_index ON testdb.jobs "
+            "(state, submit_time);\n"
+            "CREATE INDEX state_archive_index ON testdb.jobs "
+            "(state, archive_time);\n"
+            "CREATE INDEX state_expire_index ON testdb.jobs "
+            "(state, expire_time);\n"
             "GRANT SELECT ON testdb.jobs to 'frontuser'@'localhost'\n"
             "    IDENTIFIED BY 'frontpwd';\n"
             "GRANT INSERT (name,user,passwd,directory,contact_email,url,"
@@ -517,6 +524,19 @@ class CheckTest(unittest.TestCase):
             "    TO 'frontuser'@'localhost';\n")
         os.unlink(o)
 
+        o = saliweb.build._generate_admin_mysql_script('testdb', backend,
+                                                       frontend, history=True)
+        with open(o) as fh:
+            contents = fh.read()
+        self.assertTrue(contents.endswith(
+            "CREATE TABLE testdb.expired_jobs (name VARCHAR(40) PRIMARY KEY "
+            "NOT NULL DEFAULT '', user VARCHAR(40), passwd CHAR(10), "
+            "contact_email VARCHAR(100), submit_time DATETIME NOT NULL, "
+            "end_time DATETIME, expire_time DATETIME);\n"
+            "GRANT SELECT ON testdb.expired_jobs to 'frontuser'@'localhost';\n"
+            ))
+        os.unlink(o)
+
     def test_check_mysql_schema(self):
         """Test _check_mysql_schema function"""
         class DummyConf:
@@ -526,6 +546,7 @@ class CheckTest(unittest.TestCase):
         dbfields = []
         conf = DummyConf()
         conf.track_hostname = True
+        conf.backend = {'move_workers': 0}
         ret, stderr = run_catch_stderr(
             saliweb.build._check_mysql_schema, env, conf, dbfields, 'jobs')
         self.assertEqual(ret, None)
@@ -594,6 +615,56 @@ class CheckTest(unittest.TestCase):
         self.assertEqual(ret, None)
         self.assertEqual(env.exitval, None)
 
+        # Background moves need an extra field
+        env = DummyEnv('testuser')
+        conf.backend['move_workers'] = 2
+        ret, stderr = run_catch_stderr(
+            saliweb.build._check_mysql_schema, env, conf, dbfields, 'jobs')
+        self.assertEqual(env.exitval, 1)
+        self.assertIn('the backend has 18 fields', stderr)
+        self.assertIn('moving_to TEXT', stderr)
+
+    def test_check_mysql_indexes(self):
+        """Test _check_mysql_indexes function"""
+        class DummyConf:
+            track_hostname = False
+            backend = {'move_workers': 0}
+        conf = DummyConf()
+        # All indexes present (extra indexes are ignored)
+        env = DummyEnv('testuser')
+        dbindexes = [('dependencies', 1, 'parent_index', 1, 'parent'),
+                     ('dependencies', 1, 'child_index', 1, 'child'),
+                     ('dependencies', 1, 'other_index', 1, 'child')]
+        ret, stderr = run_catch_stderr(
+            saliweb.build._check_mysql_indexes, env, conf, dbindexes,
+            'dependencies')
+        self.assertEqual(stderr, '')
+        self.assertEqual(ret, None)
+        self.assertEqual(env.exitval, None)
+
+        # Missing or mismatched indexes should only give a warning
+        env = DummyEnv('testuser')
+        dbindexes = [('jobs', 0, 'PRIMARY', 1, 'name'),
+                     ('jobs', 1, 'state_index', 1, 'state'),
+                     ('jobs', 1, 'state_submit_index', 1, 'state'),
+                     ('jobs', 1, 'state_archive_index', 2, 'archive_time'),
+                     ('jobs', 1, 'state_archive_index', 1, 'state'),
+                     ('jobs', 1, 'state_expire_index', 1, 'expire_time'),
+                     ('jobs', 1, 'state_expire_index', 2, 'state')]
+        ret, stderr = run_catch_stderr(
+            saliweb.build._check_mysql_indexes, env, conf, dbindexes, 'jobs')
+        self.assertEqual(ret, None)
+        self.assertEqual(env.exitval, None)
+        self.assertTrue(re.search(
+            "'jobs' database table is missing indexes.*"
+            'migrate_indexes.py.*'
+            r'CREATE INDEX runner_id_index ON jobs \(runner_id\);\s+'
+            r'CREATE INDEX state_submit_index ON jobs '
+            r'\(state, submit_time\);\s+'
+            r'CREATE INDEX state_expire_index ON jobs '
+            r'\(state, expire_time\)\s+$', stderr, re.DOTALL),
+            'regex match failed on ' + stderr)
+
     def test_get_sorted_grant(self):
         """Test _get_sorted_grant function"""
         self.assertEqual(saliweb.build._get_sorted_grant('test grant'),
@@ -130,7 +130,7 @@ class InstallTest(unittest.TestCase):
             return e
         e = make_env()
         saliweb.build._InstallAdminTools(e)
-        self.assertEqual(len(e.command_target), 7)
+        self.assertEqual(len(e.command_target), 9)
 
         e = make_env()
         saliweb.build._InstallAdminTools(e, ['myjob'])
@@ -1,7 +1,11 @@
 import unittest
 import re
 import os
+import sys
+import shutil
+import subprocess
 import saliweb.build
+import testutil
 
 
 class MakeTest(unittest.TestCase):
@@ -49,6 +53,34 @@ class MakeTest(unittest.TestCase):
                             'regex match failed on ' + f)
             os.unlink(t)
 
+    def test_make_script_hook_workers(self):
+        """Test running hooks in worker processes from a generated script"""
+        class DummyEnv(object):
+            def Execute(self, cmd):
+                pass
+
+        class DummyTarget(object):
+            path = 'hooktest.py'
+
+            def __str__(self):
+                return self.path
+        fixture = os.path.abspath('hook_webservice.py')
+        pypath = os.path.dirname(os.path.dirname(saliweb.__file__))
+        with testutil.temp_working_dir():
+            saliweb.build._make_script(DummyEnv(), [DummyTarget()], [])
+            shutil.copy(fixture, 'webservice.py')
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join((pypath, os.getcwd()))
+            p = subprocess.run([sys.executable, 'hooktest.py'], env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+            self.assertEqual(p.returncode, 0, p.stderr)
+            # The hook should have been run in another process, and the
+            # service itself only run once
+            m = re.match(r'main pid (\d+) hook pid (\d+)$', p.stdout)
+            self.assertIsNotNone(m, p.stdout + p.stderr)
+            self.assertNotEqual(m.group(1), m.group(2))
+
     def test_make_cgi_script(self):
         """Test _make_cgi_script() function"""
         class DummySource(object):
@@ -31,6 +31,7 @@ key6=my=value
 install= installvalue
 incoming=incomingvalue
 running=runningvalue
+sharded=True
 END
     $fh->close() or die "Cannot close temporary file: $!";
 
@@ -57,6 +58,8 @@ END
        'directory key for job state INCOMING should be caps');
     is($config->{directories}->{RUNNING}, 'runningvalue',
        'directory key for job state RUNNING should be caps');
+    is($config->{directories}->{sharded}, 1,
+       '{directories}->{sharded} should be a lowercase boolean');
     is($config->{limits}->{running}, 5,
        'check defaults (limits.running)');
 }
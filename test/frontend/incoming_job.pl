@@ -102,6 +102,20 @@ BEGIN { use_ok('saliweb::frontend'); }
        "            mkdir failure (execute calls)");
 }
 
+# Test try_job_name function with sharded directories
+{
+    my $dir = tempdir( CLEANUP => 1 );
+    my $query = new Dummy::Query;
+    my $dbh = new Dummy::DB;
+    my $config = {};
+    $config->{directories}->{INCOMING} = $dir;
+    $config->{directories}->{sharded} = 1;
+    my $jobdir = saliweb::frontend::IncomingJob::try_job_name(
+                                     "new-job", $query, $dbh, $config);
+    is($jobdir, "$dir/1b/a4/new-job", "try_job_name (sharded)");
+    ok(-d "$dir/1b/a4/new-job", "             (sharded, dir)");
+}
+
 # Test _generate_results_url function
 {
     my $frontend = {cgiroot=>'mycgiroot'};
@@ -29,6 +29,10 @@ class DictCursor(object):
                         'passwd': self.args[1], 'archive_time': None,
                         'directory': '/test/job',
                         'contact_email': 'test@test.com'}
+        elif (self.sql == 'SELECT name FROM expired_jobs WHERE name=%s '
+                          'AND passwd=%s'):
+            if self.args[0] == 'history-job':
+                return {'name': self.args[0]}
         elif (self.sql == 'SELECT first_name,last_name,email,institution,'
                           'modeller_key FROM servers.users WHERE user_name=%s '
                           'AND password=%s'):
@@ -370,6 +370,18 @@ class Tests(unittest.TestCase):
         j = saliweb.frontend.get_completed_job('completed-job', 'passwd')
         self.assertEqual(j.email, 'test@test.com')
 
+        # Jobs in the history table should only be found if it is enabled
+        self.assertRaises(saliweb.frontend._ResultsBadJobError,
+                          saliweb.frontend.get_completed_job,
+                          'history-job', 'passwd')
+        flask.current_app.config['OLDJOBS_HISTORY'] = 'True'
+        self.assertRaises(saliweb.frontend._ResultsGoneError,
+                          saliweb.frontend.get_completed_job,
+                          'history-job', 'passwd')
+        self.assertRaises(saliweb.frontend._ResultsBadJobError,
+                          saliweb.frontend.get_completed_job,
+                          'bad-job', 'passwd')
+
         flask.current_app = None
 
     def test_get_servers_cookie_info(self):
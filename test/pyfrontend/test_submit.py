@@ -3,7 +3,9 @@ import unittest
 import os
 import socket
 import re
+import subprocess
 from saliweb.frontend import submit
+import saliweb.backend
 import saliweb.frontend
 import contextlib
 import tempfile
@@ -58,12 +60,16 @@ class Tests(unittest.TestCase):
                 self.execute_calls = 0
 
             def execute(self, sql, args):
+                self.sql = sql
                 self.jobname = args[0]
                 self.execute_calls += 1
 
             def fetchone(self):
                 if self.jobname == 'existing-job':
                     return (1,)
+                elif (self.jobname.startswith('expired-job')
+                      and 'expired_jobs' in self.sql):
+                    return (1,)
                 elif self.jobname == 'justmade-job' and self.execute_calls > 1:
                     return (1,)
                 else:
@@ -95,8 +101,72 @@ class Tests(unittest.TestCase):
             nm = submit._try_job_name("new-job", cur)
             self.assertTrue(os.path.isdir(nm))
             self.assertEqual(cur.execute_calls, 2)
+
+            # Expired job names can be reused unless the history table
+            # is used
+            cur = MockCursor()
+            nm = submit._try_job_name("expired-job", cur)
+            self.assertTrue(os.path.isdir(nm))
+            flask.current_app.config['OLDJOBS_HISTORY'] = 'true'
+            cur = MockCursor()
+            self.assertEqual(submit._try_job_name("expired-job2", cur), None)
         flask.current_app = None
 
+    def test_try_job_name_sharded(self):
+        """Test _try_job_name function with sharded directories"""
+        class MockCursor(object):
+            def execute(self, sql, args):
+                pass
+
+            def fetchone(self):
+                return (0,)
+
+        class MockApp(object):
+            def __init__(self, tmpdir):
+                self.config = {'DIRECTORIES_INCOMING': tmpdir,
+                               'DIRECTORIES_SHARDED': 'True'}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            flask.current_app = MockApp(tmpdir)
+            nm = submit._try_job_name("new-job", MockCursor())
+            self.assertEqual(nm, os.path.join(tmpdir, '1b', 'a4', 'new-job'))
+            self.assertTrue(os.path.isdir(nm))
+        flask.current_app = None
+
+    def test_shard_cross_language(self):
+        """Check that all frontends and the backend agree on job shards"""
+        names = ['new-job', 'job20240101', 'A_b-9', 'x' * 40]
+
+        class MockApp(object):
+            config = {'DIRECTORIES_INCOMING': '/in',
+                      'DIRECTORIES_SHARDED': 'True'}
+        flask.current_app = MockApp()
+        try:
+            py = [submit._get_job_directory(n) for n in names]
+        finally:
+            flask.current_app = None
+        backend = [os.path.join('/in', saliweb.backend._get_job_shard(n), n)
+                   for n in names]
+        self.assertEqual(py, backend)
+
+        topdir = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        script = ('use saliweb::frontend; my $c = '
+                  '{directories => {INCOMING => "/in", sharded => 1}}; '
+                  'print join("\\n", map {'
+                  'saliweb::frontend::IncomingJob::_get_job_directory($_, $c)'
+                  '} @ARGV);')
+        try:
+            p = subprocess.run(
+                ['perl', '-I' + os.path.join(topdir, 'perl'),
+                 '-I' + os.path.join(topdir, 'test', 'frontend'),
+                 '-e', script] + names, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+        except OSError:
+            self.skipTest("perl is not available")
+        if p.returncode != 0:
+            self.skipTest("Perl frontend cannot be loaded: " + p.stderr)
+        self.assertEqual(p.stdout.split('\n'), py)
+
     def test_get_job_name_directory(self):
         """Test _get_job_name_directory function"""
         with mock_app():